@@ -0,0 +1,374 @@
+""" benchmark.py - timings of fpath operations.
+
+Times the common operations on paths (parsing, joining, slicing,
+comparing, hashing, str(), transform, stat, copy, walk), each next to the
+same done with os and pathlib, on synthetic trees of a few shapes built in
+a temporary directory (on tmpfs where there is one, so the disk doesn't
+get measured). Reports operations per second, and memory per path object.
+
+Run as:
+    python benchmark.py
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json --threshold 0.1
+
+With --compare, the fpath timings are compared with those saved, and the
+exit status is 1 if any got slower by more than the threshold (a
+fraction). With --relative, what is saved and compared is how fpath does
+relative to the fastest of os and pathlib, which depends less on the
+machine. A baseline records whether it was saved with --relative, and is
+only compared with results of the same kind.
+"""
+
+import argparse
+import gc
+import json
+import os
+import pathlib
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fpath import Path, File, Dir, encode_paths, decode_paths
+
+
+def best_time(func, *args, **kwargs):
+    """Returns the best of a few timings of func(*args, **kwargs), in
+    seconds."""
+    repeat = kwargs.pop('repeat', 3)
+    best = None
+    for n in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def walk_like_paths(n, width=20):
+    """Returns n paths such as a walk of a tree of the given width would
+    yield: Dirs followed by the Files in them."""
+    paths = []
+    i = 0
+    while len(paths) < n:
+        d = Dir('/data/share/projects/p{0}/d{1}'.format(i // width, i % width))
+        paths.append(d)
+        for j in range(width):
+            paths.append(File(d + 'file{0}.dat'.format(j)))
+        i += 1
+    return paths[:n]
+
+
+# --- Trees
+
+# Shapes of the synthetic trees: depth and width of the directory tree,
+# files per directory, their size, and links per directory (to a file and
+# to a directory, alternately)
+SHAPES = {
+    'deep': dict(depth=40, width=1, files=5, size=64, links=0),
+    'wide': dict(depth=1, width=1, files=5000, size=64, links=0),
+    'small': dict(depth=3, width=6, files=40, size=1024, links=0),
+    'links': dict(depth=3, width=5, files=10, size=64, links=10),
+}
+
+
+def scratch_dir():
+    """Returns a new temporary directory, on tmpfs if there is one."""
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return tempfile.mkdtemp(prefix='fpath-bench-', dir=shm)
+    return tempfile.mkdtemp(prefix='fpath-bench-')
+
+
+def make_tree(root, depth, width, files, size, links, seed=0):
+    """Builds a tree under root: 'width' subdirectories per directory,
+    'depth' levels deep, each directory holding 'files' files of 'size'
+    bytes and 'links' symbolic links. The same seed builds the same tree.
+
+    Returns the number of entries made."""
+    rnd = random.Random(seed)
+    made = 0
+    level = [root]
+    for d in range(depth + 1):
+        next_level = []
+        for parent in level:
+            for f in range(files):
+                with open(os.path.join(parent, 'f%04d.dat' % f), 'wb') as out:
+                    out.write(bytes(rnd.getrandbits(8) for _ in range(size)))
+            made += files
+            for l in range(links):
+                target = ('f%04d.dat' % rnd.randrange(files) if l % 2 == 0
+                          or d == depth else 'd%03d' % rnd.randrange(width))
+                os.symlink(target, os.path.join(parent, 'l%04d' % l))
+            made += links
+            if d < depth:
+                for w in range(width):
+                    sub = os.path.join(parent, 'd%03d' % w)
+                    os.mkdir(sub)
+                    next_level.append(sub)
+                made += width
+        level = next_level
+    return made
+
+
+# --- Benchmarks
+
+def sample_strings(n, seed=0):
+    """Returns n path strings of varied depth and names."""
+    rnd = random.Random(seed)
+    strings = []
+    for i in range(n):
+        parts = ['data'] + ['d%d' % rnd.randrange(50)
+                            for _ in range(rnd.randrange(1, 8))]
+        strings.append('/' + '/'.join(parts) + '/file%d.txt' % i)
+    return strings
+
+
+def bench_ops(n, repeat):
+    """Times operations on paths alone, which don't touch the disk."""
+    strings = sample_strings(n)
+    paths = [Path(s) for s in strings]
+    purepaths = [pathlib.PurePosixPath(s) for s in strings]
+    others = [Path(s) for s in strings]
+    otherpure = [pathlib.PurePosixPath(s) for s in strings]
+    # Equal strings, but other objects: s[:] is s itself
+    otherstrings = [''.join(list(s)) for s in strings]
+    ops = {
+        'parse': {
+            'fpath': lambda: [Path(s) for s in strings],
+            'pathlib': lambda: [pathlib.PurePosixPath(s) for s in strings],
+            'os': lambda: [os.path.normpath(s) for s in strings]},
+        'join': {
+            'fpath': lambda: [p + 'x.dat' for p in paths],
+            'pathlib': lambda: [p / 'x.dat' for p in purepaths],
+            'os': lambda: [os.path.join(s, 'x.dat') for s in strings]},
+        'slice': {
+            'fpath': lambda: [p[:-1] for p in paths],
+            'pathlib': lambda: [p.parent for p in purepaths],
+            'os': lambda: [os.path.dirname(s) for s in strings]},
+        'compare': {
+            'fpath': lambda: [p == q for p, q in zip(paths, others)],
+            'pathlib': lambda: [p == q for p, q in zip(purepaths, otherpure)],
+            'os': lambda: [s == t for s, t in zip(strings, otherstrings)]},
+        'hash': {
+            'fpath': lambda: [hash(p) for p in paths],
+            'pathlib': lambda: [hash(pathlib.PurePosixPath(s))
+                                for s in strings],
+            'os': lambda: [hash(s) for s in strings]},
+        'str': {
+            'fpath': lambda: [str(p) for p in paths],
+            'pathlib': lambda: [str(p) for p in purepaths],
+            'os': lambda: [str(s) for s in strings]},
+    }
+    return [(name, impl, n / best_time(func, repeat=repeat))
+            for name, impls in ops.items() for impl, func in impls.items()]
+
+
+def bench_disk(root, repeat):
+    """Times operations on the files of a tree under root."""
+    names = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        names.extend(os.path.join(dirpath, f) for f in filenames)
+        names.extend(os.path.join(dirpath, d) for d in dirnames)
+    n = len(names)
+    files = [name for name in names if os.path.isfile(name)][:500]
+    copies = scratch_dir()
+
+    def copy(func):
+        for i, name in enumerate(files):
+            func(name, os.path.join(copies, str(i)))
+
+    ops = {
+        'transform': {
+            'fpath': lambda: [Path(s).transform() for s in names],
+            'pathlib': lambda: [pathlib.Path(s).is_dir() for s in names],
+            'os': lambda: [os.path.isdir(s) for s in names]},
+        'stat': {
+            'fpath': lambda: [File(s).stat().size for s in names],
+            'pathlib': lambda: [pathlib.Path(s).stat().st_size
+                                for s in names],
+            'os': lambda: [os.stat(s).st_size for s in names]},
+    }
+    results = [(name, impl, n / best_time(func, repeat=repeat))
+               for name, impls in ops.items() for impl, func in impls.items()]
+    try:
+        for impl, func in (('fpath', lambda s, d: File(s).copy(d)),
+                           ('os', shutil.copy)):
+            results.append(('copy', impl, len(files) /
+                            best_time(copy, func, repeat=repeat)))
+    finally:
+        shutil.rmtree(copies)
+    return results
+
+
+def bench_walk(root, shape, repeat):
+    """Times walking the tree under root, of the named shape."""
+    n = sum(len(d) + len(f) for _, d, f in os.walk(root))
+    name = 'walk-' + shape
+    walks = {
+        'fpath': lambda: list(Dir(root).walk('fdl')),
+        'pathlib': lambda: list(pathlib.Path(root).rglob('*')),
+        'os': lambda: [os.path.join(d, f) for d, dirs, files in os.walk(root)
+                       for f in files + dirs],
+    }
+    return [(name, impl, n / best_time(func, repeat=repeat))
+            for impl, func in walks.items()]
+
+
+def bench_codec(n=100000, repeat=3):
+    """Compares encode_paths/decode_paths with pickle, for paths as yielded
+    by a walk."""
+    paths = walk_like_paths(n)
+    encoded = encode_paths(paths)
+    pickled = pickle.dumps(paths, pickle.HIGHEST_PROTOCOL)
+    results = []
+    for impl, dumps, loads, data in (
+            ('fpath', encode_paths, decode_paths, encoded),
+            ('pickle', lambda p: pickle.dumps(p, pickle.HIGHEST_PROTOCOL),
+             pickle.loads, pickled)):
+        results.append(('encode', impl, n / best_time(dumps, paths,
+                                                      repeat=repeat)))
+        results.append(('decode', impl, n / best_time(loads, data,
+                                                      repeat=repeat)))
+        print('  {0:8s} codec: {1:6.1f} bytes/path'.format(
+            impl, len(data) / float(n)))
+    return results
+
+
+def memory_per_object(n):
+    """Returns the bytes allocated per path object, made from a string, for
+    fpath, pathlib and plain strings."""
+    strings = sample_strings(n)
+    sizes = {}
+    for impl, make in (('fpath', Path), ('pathlib', pathlib.PurePosixPath),
+                       ('os', lambda s: (s + '.')[:-1])):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [make(s) for s in strings]
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        sizes[impl] = (after - before) / float(n)
+        del objects
+    return sizes
+
+
+# --- Baselines
+
+def relative(results):
+    """Returns the fpath results as fractions of the fastest other result
+    for the same operation."""
+    fastest = {}
+    for name, impl, rate in results:
+        if impl != 'fpath':
+            fastest[name] = max(fastest.get(name, 0), rate)
+    return [(name, impl, rate / fastest[name]) for name, impl, rate in results
+            if impl == 'fpath' and fastest.get(name)]
+
+
+def compare(results, baseline, threshold):
+    """Returns the (name, saved, now) of the fpath results more than
+    threshold slower than those in baseline, the dict of results saved by
+    --save."""
+    regressions = []
+    for name, impl, rate in results:
+        key = '%s/%s' % (name, impl)
+        if impl == 'fpath' and key in baseline and \
+                rate < baseline[key] * (1 - threshold):
+            regressions.append((name, baseline[key], rate))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of fpath.')
+    parser.add_argument('-n', type=int, default=20000,
+                        help='paths per operation on paths (default 20000)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timings per benchmark, of which the best is '
+                        'kept (default 3)')
+    parser.add_argument('--shapes', default=','.join(sorted(SHAPES)),
+                        help='comma separated tree shapes to walk, of: %s'
+                        % ', '.join(sorted(SHAPES)))
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown counted as a regression, as a '
+                        'fraction (default 0.1)')
+    parser.add_argument('--relative', action='store_true',
+                        help='save and compare fpath relative to os and '
+                        'pathlib rather than in operations per second')
+    args = parser.parse_args(argv)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if 'results' not in baseline:
+            # Saved before the mode was recorded, which was always absolute
+            baseline = {'relative': False, 'results': baseline}
+        if baseline['relative'] != args.relative:
+            parser.error('{0} was saved {1} --relative; compare it with '
+                         'results of the same kind'.format(
+                             args.compare,
+                             'with' if baseline['relative'] else 'without'))
+
+    results = bench_ops(args.n, args.repeat)
+    results.extend(bench_codec(args.n, args.repeat))
+    root = scratch_dir()
+    try:
+        shapes = [s for s in args.shapes.split(',') if s]
+        for shape in shapes:
+            tree = os.path.join(root, shape)
+            os.mkdir(tree)
+            made = make_tree(tree, **SHAPES[shape])
+            print('  tree {0}: {1} entries'.format(shape, made))
+            results.extend(bench_walk(tree, shape, args.repeat))
+        if shapes:
+            results.extend(bench_disk(os.path.join(root, shapes[0]),
+                                      args.repeat))
+    finally:
+        shutil.rmtree(root)
+
+    print('{0:12s} {1:>14s} {2:>14s} {3:>14s}'.format(
+        'operation', 'fpath ops/s', 'pathlib ops/s', 'os|pickle ops/s'))
+    table = {}
+    for name, impl, rate in results:
+        table.setdefault(name, {})[impl] = rate
+    for name, rates in table.items():
+        print('{0:12s} {1:>14s} {2:>14s} {3:>14s}'.format(name, *[
+            '{0:,.0f}'.format(rates[impl]) if impl in rates else '-'
+            for impl in ('fpath', 'pathlib', 'os' if 'os' in rates
+                         else 'pickle')]))
+    print('memory per object: ' + ', '.join(
+        '{0} {1:.0f} bytes'.format(impl, size)
+        for impl, size in sorted(memory_per_object(args.n).items())))
+
+    if args.relative:
+        results = relative(results)
+    status = 0
+    if baseline is not None:
+        regressions = compare(results, baseline['results'], args.threshold)
+        for name, saved, now in regressions:
+            print('REGRESSION {0}: {1:,.2f} -> {2:,.2f} ({3:+.0%})'.format(
+                name, saved, now, now / saved - 1))
+        if regressions:
+            status = 1
+        else:
+            print('no regressions above {0:.0%}'.format(args.threshold))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'relative': args.relative,
+                       'results': dict(('%s/%s' % (name, impl), rate)
+                                       for name, impl, rate in results)},
+                      f, indent=1, sort_keys=True)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,13 +22,64 @@ import os
 import stat
 import itertools
 import string
+import array
+import bisect
+import builtins
+import contextvars
+import operator
+import pickle
+import queue
+import errno
+import fnmatch
+import functools
+import hashlib
+import io
+import json
+import logging
+import mmap
+import struct
+import multiprocessing
+import random
+import re
+import select
 import shutil
+import statistics
+import tarfile
+import tempfile
+import threading
+import time
+import types
+import zlib
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime
 from time import mktime
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import sqlite3
+except ImportError:
+    # Only needed by FileIndex
+    sqlite3 = None
+
+try:
+    import fcntl
+except ImportError:
+    # Only needed to lock CacheDir indexes; not on Windows
+    fcntl = None
+
+# Only needed for compressed files
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
 
 import sys
-if sys.version_info[0] > 2:
-    unicode = str
+
+_log = logging.getLogger(__name__)
 
 class Stats(object):
     """A class for managing the properties of a file or directory.
@@ -36,7 +87,7 @@ class Stats(object):
     Properties are read from os.stat(), and set with the appropriate methods.
     """
     def __init__(self, path, usecache = True, followlinks = True):
-        """path may be a Path object (or descendant), a str, or unicode path.
+        """path may be a Path object (or descendant), or a str.
         
         With cache enabled, it makes one stat call on creation, and uses that 
         to return each property.
@@ -46,6 +97,9 @@ class Stats(object):
     With followlinks = False, an os.lstat() call is used, returning properties 
     on the link file itself instead of the file or directory it is pointing to."""
         self._path = Path(path)
+        # Paths yielded by Dir.fwalk are stat()ed relative to their
+        # directory, while the walk keeps it open
+        self._dirfd_cell = getattr(path, '_dirfd_cell', (None,))
         self._usecache = usecache
         self._followlinks = followlinks
         self._cached = None
@@ -56,13 +110,38 @@ class Stats(object):
         """Private method for returning os.stat(), os.lstat(), or cached version, depending on necessity."""
         if not force and self._usecache and self._cached:
             return self._cached
+        elif self._dirfd is not None:
+            self._cached = os.stat(self._path[-1], dir_fd=self._dirfd,
+                                   follow_symlinks=self._followlinks)
+            return self._cached
         elif self._followlinks:
-            self._cached = os.stat(unicode(self._path))
+            self._cached = os.stat(str(self._path))
             return self._cached
         else:
-            self._cached = os.lstat(unicode(self._path))
+            self._cached = os.lstat(str(self._path))
             return self._cached
     
+    @classmethod
+    def _from_stat(cls, path, st, followlinks=True):
+        """Private constructor, for a Stats of path using st, the result of
+        a stat() call already made."""
+        self = cls.__new__(cls)
+        self._path = path
+        self._dirfd_cell = (None,)
+        self._usecache = True
+        self._followlinks = followlinks
+        self._cached = st
+        return self
+
+    @property
+    def _dirfd(self):
+        return self._dirfd_cell[0]
+
+    def _changed(self):
+        """Private method for marking the cached stat() out of date after a
+        change; it is refreshed on the next property access, not right away."""
+        self._cached = None
+
     @property
     def isdir(self):
         return stat.S_ISDIR(self._stat().st_mode)
@@ -82,8 +161,8 @@ class Stats(object):
     
     @mode.setter
     def mode(self, mode):
-        os.chmod(unicode(self._path), mode)
-        self._stat(True)
+        os.chmod(str(self._path), mode)
+        self._changed()
 
     @property
     def owner(self):
@@ -93,13 +172,23 @@ class Stats(object):
     @owner.setter
     def owner(self, ids):
         (uid, gid) = ids
-        os.chown(unicode(self._path), uid, gid)
-        self._stat(True)
+        os.chown(str(self._path), uid, gid)
+        self._changed()
     
     @property
     def size(self):
         """Size in bytes"""
         return self._stat().st_size
+
+    @property
+    def inode(self):
+        """Inode number; together with device, it identifies the file"""
+        return self._stat().st_ino
+
+    @property
+    def device(self):
+        """Device the file is on"""
+        return self._stat().st_dev
     
     @staticmethod
     def _totimestamp(dtime):
@@ -138,8 +227,8 @@ class Stats(object):
             atime = self._totimestamp(atime)
         if isinstance(mtime, datetime):
             mtime = self._totimestamp(mtime)
-        os.utime(unicode(self._path), (atime, mtime))
-        self._stat(True)
+        os.utime(str(self._path), (atime, mtime))
+        self._changed()
     
     @property
     def ctime(self):
@@ -147,6 +236,674 @@ class Stats(object):
         return self._fromtimestamp(self._stat().st_ctime)
 
 
+# Kinds of filesystem objects, as returned by the _*_kind helpers below. They
+# map onto the Dir, File, Link and (for anything else) Path classes.
+_DIR, _FILE, _LINK, _OTHER = 'd', 'f', 'l', 'o'
+
+def _mode_kind(st_mode):
+    """Returns the kind of object described by a st_mode value."""
+    if stat.S_ISLNK(st_mode):
+        return _LINK
+    elif stat.S_ISDIR(st_mode):
+        return _DIR
+    elif stat.S_ISREG(st_mode):
+        return _FILE
+    return _OTHER
+
+def _stat_kind(pathstr, followlinks=True):
+    """Returns the kind of object at pathstr, or None if there is none."""
+    try:
+        if followlinks:
+            st = os.stat(pathstr)
+        else:
+            st = os.lstat(pathstr)
+    except OSError:
+        return None
+    return _mode_kind(st.st_mode)
+
+def _entry_kind(entry, followlinks=True):
+    """Returns the kind of object an os.DirEntry refers to, or None if it
+    is a dangling link (and followlinks is True).
+
+    For anything but links this uses the type information from the
+    directory listing, without any extra system calls."""
+    try:
+        if entry.is_symlink() and not followlinks:
+            return _LINK
+        if entry.is_dir():
+            return _DIR
+        if entry.is_file():
+            return _FILE
+        # Neither file nor directory: either a special object or a link
+        # pointing nowhere, which os.stat would fail on.
+        return _mode_kind(entry.stat().st_mode)
+    except OSError:
+        return None
+
+def _scan_tree(pathstr, prune=None, onerror=None):
+    """Yields (directory path, os.DirEntry) pairs for everything below the
+    directory at pathstr, links not followed. Directories are yielded before
+    what is in them, and not descended into if prune(dirpath, entry) is
+    true.
+
+    A directory which can't be listed is left out, and the OSError passed
+    to onerror if given, as for os.walk."""
+    stack = [pathstr]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError as exc:
+            if onerror is not None:
+                onerror(exc)
+            continue
+        subdirs = []
+        for entry in entries:
+            yield dirpath, entry
+            try:
+                isdir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if isdir and not (prune and prune(dirpath, entry)):
+                subdirs.append(entry.path)
+        stack.extend(reversed(subdirs))
+
+class _ThreadPool(ThreadPoolExecutor):
+    """A ThreadPoolExecutor running each task in the contextvars context it
+    was submitted from, so an Instrumentation follows the work fpath hands
+    to its threads."""
+
+    def submit(self, fn, *args, **kwargs):
+        return ThreadPoolExecutor.submit(
+            self, contextvars.copy_context().run, fn, *args, **kwargs)
+
+def _imap_unordered(pool, func, iterable, window=256):
+    """Yields func(item) for each item, computed on pool, in the order they
+    complete, as soon as each does (or the next item is taken from
+    iterable). At most window items are pending at any time, so iterable
+    is consumed lazily."""
+    done = queue.Queue()
+    pending = 0
+    for item in iterable:
+        pool.submit(func, item).add_done_callback(done.put)
+        pending += 1
+        while pending >= window or not done.empty():
+            pending -= 1
+            yield done.get().result()
+    while pending:
+        pending -= 1
+        yield done.get().result()
+
+
+class _PaddedReader(object):
+    """A read-only file object giving the first size bytes of another, and
+    zeros past its end if it turns out shorter; short tells whether it
+    did."""
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._left = size
+        self.short = False
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        data = b''
+        while len(data) < size and not self.short:
+            chunk = self._fileobj.read(size - len(data))
+            if not chunk:
+                self.short = True
+            data += chunk
+        self._left -= size
+        return data + b'\0' * (size - len(data))
+
+
+class _ChunkQueue(object):
+    """A write-only file object handing what is written to it over to
+    another thread, which iterates over it to get the chunks.
+
+    At most maxsize chunks are queued, so the writer blocks while the reader
+    lags behind. If the reader goes away (see abandon), further writes
+    raise an error instead of blocking forever."""
+    _done = object()
+
+    def __init__(self, maxsize=16):
+        self._queue = queue.Queue(maxsize)
+        self._abandoned = False
+        self._error = None
+
+    def _put(self, item):
+        while not self._abandoned:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def write(self, data):
+        if not self._put(bytes(data)):
+            raise IOError("The reader of the stream went away")
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self, error=None):
+        """Marks the end of the stream, or that the writer failed with
+        error, which is then raised to the reader."""
+        self._error = error
+        self._put(self._done)
+
+    def abandon(self):
+        self._abandoned = True
+
+    def __iter__(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is self._done:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield chunk
+
+
+# Compressions of files, by extension and by the bytes they start with
+_COMPRESSION_EXTENSIONS = {'gz': 'gz', 'tgz': 'gz', 'bz2': 'bz2', 'xz': 'xz'}
+_COMPRESSION_MAGIC = ((b'\x1f\x8b', 'gz'), (b'BZh', 'bz2'),
+                      (b'\xfd7zXZ\x00', 'xz'))
+
+def _compressor(compression, level=None):
+    # Returns a function compressing a block of bytes into a complete
+    # stream, such that streams can be concatenated
+    if compression == 'gz':
+        level = 6 if level is None else level
+        def compress(data):
+            c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return c.compress(data) + c.flush()
+        return compress
+    if compression == 'bz2' and bz2 is not None:
+        return lambda data: bz2.compress(data, 9 if level is None else level)
+    if compression == 'xz' and lzma is not None:
+        return lambda data: lzma.compress(data, preset=level)
+    raise ValueError("Unsupported compression: %r" % (compression,))
+
+def _decompressor(compression):
+    # Returns a function making a new decompressor object for one stream
+    if compression == 'gz':
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'bz2' and bz2 is not None:
+        return bz2.BZ2Decompressor
+    if compression == 'xz' and lzma is not None:
+        return lzma.LZMADecompressor
+    raise ValueError("Unsupported compression: %r" % (compression,))
+
+
+class _DecompressReader(io.RawIOBase):
+    """A readable raw stream of the decompressed contents of the binary file
+    object raw, which may hold several compressed streams one after the
+    other, as written by _BlockCompressWriter."""
+    chunksize = 64 << 10
+
+    def __init__(self, raw, compression):
+        self._raw = raw
+        self._new = _decompressor(compression)
+        self._decompressor = self._new()
+        self._buffer = b''
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        # Decompresses more data into the buffer; leaves it empty at the end
+        self._buffer, self._pos = b'', 0
+        while not self._buffer:
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                if not data:
+                    data = self._raw.read(self.chunksize)
+                if not data:
+                    return
+                self._decompressor = self._new()
+            else:
+                data = self._raw.read(self.chunksize)
+                if not data:
+                    raise EOFError("Compressed file ended before the "
+                                   "end-of-stream marker was reached")
+            self._buffer = self._decompressor.decompress(data)
+
+    def readinto(self, b):
+        if self._pos >= len(self._buffer):
+            self._fill()
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        io.RawIOBase.close(self)
+
+
+class _BlockCompressWriter(io.BufferedIOBase):
+    """A writable stream compressing what is written to it into the binary
+    file object raw, as pigz does: the data is cut into blocks, which are
+    compressed independently on a pool of threads (the codecs release the
+    GIL) and written in order, each as a complete stream. Readers of gzip,
+    bzip2 and xz files read such concatenated streams as one.
+
+    flush() only writes out blocks already compressed; the last, partial
+    block is written on close()."""
+
+    def __init__(self, raw, compression, workers=None, blocksize=1 << 20,
+                 level=None):
+        self._raw = raw
+        self._compress = _compressor(compression, level)
+        self._blocksize = blocksize
+        workers = workers or os.cpu_count() or 1
+        self._pool = _ThreadPool(workers)
+        self._window = 2 * workers
+        self._pending = deque()
+        self._block = bytearray()
+
+    def writable(self):
+        return True
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(self._compress, bytes(block)))
+        while len(self._pending) > self._window:
+            self._raw.write(self._pending.popleft().result())
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._block += data
+        while len(self._block) >= self._blocksize:
+            self._submit(self._block[:self._blocksize])
+            del self._block[:self._blocksize]
+        return len(data)
+
+    def flush(self):
+        while self._pending and self._pending[0].done():
+            self._raw.write(self._pending.popleft().result())
+        self._raw.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._block:
+                self._submit(self._block)
+                self._block = bytearray()
+            while self._pending:
+                self._raw.write(self._pending.popleft().result())
+            io.BufferedIOBase.close(self)
+        finally:
+            self._pool.shutdown()
+            self._raw.close()
+
+
+class _ByteBudget(object):
+    """Bounds the bytes held at once by threads: acquire(n) blocks until n
+    more bytes fit in limit, unless nothing is held, so that anything can be
+    held on its own.
+
+    Once closed, acquire() no longer blocks, and returns False."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.held = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, n):
+        with self._cond:
+            while not self.closed and self.held and \
+                    self.held + n > self.limit:
+                self._cond.wait()
+            if self.closed:
+                return False
+            self.held += n
+            return True
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def release(self, n):
+        with self._cond:
+            self.held -= n
+            self._cond.notify_all()
+
+
+class _Inotify(object):
+    """Wakes a waiting thread up when a file changes, through Linux's
+    inotify (called through ctypes). Events aren't told apart; they only
+    end wait() early. Raises OSError where inotify isn't available."""
+    # Modified, attributes changed, closed, moved or deleted; for
+    # directories, an entry created or moved in
+    FILE_EVENTS = 0x002 | 0x004 | 0x008 | 0x400 | 0x800
+    DIR_EVENTS = 0x100 | 0x080
+
+    def __init__(self):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or None,
+                               use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (ImportError, OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._fd = fd
+
+    def watch(self, path, mask):
+        # Watching what doesn't exist (yet) is left to the polling timeout
+        self._add_watch(self._fd, os.fsencode(path), mask)
+
+    def wait(self, timeout):
+        """Waits for an event, or until timeout seconds have passed."""
+        ready = select.select([self._fd], [], [], timeout)[0]
+        if ready:
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except (IOError, OSError):
+                pass
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _TreeEstimator(object):
+    """Estimates the number of files in a tree and their total size, with
+    Knuth's random probing: each probe goes down one random path from the
+    root, and weighs what it finds at each level by the product of the
+    numbers of subdirectories it chose from on the way. Used by
+    Dir.estimate.
+
+    Directories are listed at most once, and counted as one syscall; the
+    sizes of at most file_sample files per directory are stat()ed, and
+    scaled up to all of its files. A probe which only revisits listed
+    directories is charged one syscall against the budget, so that probing
+    a tree with unlikely branches still ends; once the directories left
+    to list fit in the budget, they are listed instead, for an exact
+    count."""
+    file_sample = 16
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.syscalls = 0
+        self._dirs = {}
+        # Directories found but not listed yet
+        self._unlisted = set()
+
+    def visit(self, pathstr):
+        """Returns (files, bytes, subdirectories) for a directory."""
+        info = self._dirs.get(pathstr)
+        if info is not None:
+            return info
+        self.syscalls += 1
+        self._unlisted.discard(pathstr)
+        files, subdirs = [], []
+        try:
+            with os.scandir(pathstr) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append(entry)
+        except OSError:
+            pass
+        sample = files
+        if len(files) > self.file_sample:
+            sample = self.rng.sample(files, self.file_sample)
+        total = 0
+        for entry in sample:
+            self.syscalls += 1
+            try:
+                total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+        nbytes = total * len(files) / len(sample) if sample else 0
+        info = self._dirs[pathstr] = (len(files), nbytes, subdirs)
+        self._unlisted.update(d for d in subdirs if d not in self._dirs)
+        return info
+
+    def probe(self, root):
+        weight, files, nbytes = 1, 0, 0
+        path = root
+        while True:
+            n, b, subdirs = self.visit(path)
+            files += weight * n
+            nbytes += weight * b
+            if not subdirs:
+                return files, nbytes
+            weight *= len(subdirs)
+            path = self.rng.choice(subdirs)
+
+    def run(self, root, budget):
+        """Probes until budget syscalls have been made, and returns the
+        (files, bytes) of each probe. If the whole tree was listed on the
+        way, a single exact (files, bytes) is returned instead."""
+        self.visit(root)
+        probes = []
+        # Charges for probes which made no syscalls
+        free = 0
+        while self.syscalls + free < budget or not probes:
+            while self._unlisted and \
+                    len(self._unlisted) <= budget - self.syscalls - free:
+                self.visit(next(iter(self._unlisted)))
+            if not self._unlisted:
+                return [self._total(root)], True
+            before = self.syscalls
+            probes.append(self.probe(root))
+            if self.syscalls == before:
+                free += 1
+        return probes, False
+
+    def _total(self, root):
+        files = nbytes = 0
+        stack = [root]
+        while stack:
+            n, b, subdirs = self._dirs[stack.pop()]
+            files += n
+            nbytes += b
+            stack.extend(subdirs)
+        return files, nbytes
+
+
+def _scan_worker(tasks, results, idle, func, mode, batch):
+    """The body of each process of Dir.scan_parallel.
+
+    Takes work units - plain directory path strings - from tasks, walks
+    them depth first, and puts batches of (path string, kind, func result)
+    on results. While other workers are idle, the oldest (and so biggest)
+    subtrees still pending are handed back to the coordinator as new units.
+    Every unit taken is acknowledged with a 'done' message once finished.
+    Batches and errors are sent pickled, so that a result which can't be
+    pickled comes back as an error rather than being lost.
+    """
+    dirs = 'd' in mode
+    files = 'f' in mode
+    links = 'l' in mode or 'L' in mode
+    other = 'o' in mode
+    types = {_DIR: Dir, _FILE: File, _LINK: Link}
+    while True:
+        with idle.get_lock():
+            idle.value += 1
+        unit = tasks.get()
+        with idle.get_lock():
+            idle.value -= 1
+        if unit is None:
+            return
+        pending = [unit]
+        out = []
+        try:
+            while pending:
+                dirpath = pending.pop()
+                try:
+                    with os.scandir(dirpath) as it:
+                        entries = [(e.path, _entry_kind(e, not links))
+                                   for e in it]
+                except OSError:
+                    continue
+                for pathstr, kind in entries:
+                    if kind == _DIR:
+                        pending.append(pathstr)
+                    if not ((kind == _DIR and dirs) or
+                            (kind == _FILE and files) or
+                            (kind == _LINK and links) or
+                            (kind is None and other) or kind == _OTHER):
+                        continue
+                    result = None
+                    if func is not None:
+                        result = func(types.get(kind, Path)(pathstr))
+                    out.append((pathstr, kind, result))
+                    if len(out) >= batch:
+                        results.put(('items', pickle.dumps(out, -1)))
+                        out = []
+                spare = min(idle.value, len(pending) - 1)
+                if spare > 0:
+                    results.put(('split', pending[:spare]))
+                    del pending[:spare]
+            if out:
+                results.put(('items', pickle.dumps(out, -1)))
+        except Exception as exc:
+            results.put(('error', _dumps_error(exc)))
+        results.put(('done', None))
+
+
+def _dumps_error(exc):
+    # Returns exc pickled or, if it can't be pickled and read back, a
+    # RuntimeError describing it
+    try:
+        data = pickle.dumps(exc, -1)
+        pickle.loads(data)
+        return data
+    except Exception:
+        return pickle.dumps(RuntimeError('%s: %s' % (type(exc).__name__, exc)))
+
+
+RmtreeResult = namedtuple('RmtreeResult', 'removed errors')
+MetadataResult = namedtuple('MetadataResult', 'checked changed errors')
+DirTrace = namedtuple('DirTrace', 'path list_seconds stat_seconds entries')
+Estimate = namedtuple('Estimate', 'files bytes files_margin bytes_margin '
+                                  'probes syscalls subdirs')
+
+# Whether directory trees can be removed through directory descriptors
+_FD_RMTREE = (set([os.open, os.unlink, os.rmdir]) <= os.supports_dir_fd and
+              os.scandir in os.supports_fd)
+
+class _TreeRemover(object):
+    """Removes directory trees relative to open directory descriptors,
+    counting what was removed and what failed. Used by Dir.rmtree.
+
+    Directories are opened with O_NOFOLLOW, so links are always removed
+    themselves and never followed, even if one replaces a directory while
+    removing.
+
+    Given a pool of 'workers' threads, subtrees met at any depth are handed
+    to it whenever one of its workers is idle, and removed serially
+    otherwise. As a subtree is only handed over to a worker that is free
+    to start it at once, waiting for it can't deadlock the pool."""
+    _progress_every = 1000
+    _dir_flags = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | \
+                 getattr(os, 'O_NOFOLLOW', 0)
+
+    def __init__(self, progress=None, pool=None, workers=0):
+        self.progress = progress
+        self.removed = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._pool = pool
+        self._idle = workers if pool is not None else 0
+
+    def done(self):
+        with self._lock:
+            self.removed += 1
+            if self.progress and self.removed % self._progress_every == 0:
+                self.progress(self.removed, len(self.errors))
+
+    def error(self, path, exc):
+        with self._lock:
+            self.errors.append((path, exc))
+
+    def open(self, name, dir_fd=None):
+        return os.open(name, self._dir_flags, dir_fd=dir_fd)
+
+    def clear(self, fd, path):
+        """Removes everything in the directory open as fd (at path), and
+        returns whether all of it went."""
+        with os.scandir(fd) as it:
+            entries = list(it)
+        cleared = True
+        # (name, future) of the subtrees handed to the pool
+        split = []
+        try:
+            for entry in entries:
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        os.unlink(entry.name, dir_fd=fd)
+                        self.done()
+                    elif self._claim():
+                        split.append((entry.name, self._pool.submit(
+                            self._split, fd, entry.name, path)))
+                    elif not self.subtree(fd, entry.name, path):
+                        cleared = False
+                except OSError as exc:
+                    self.error(os.path.join(path, entry.name), exc)
+                    cleared = False
+        finally:
+            # fd must stay open until they are done
+            for name, future in split:
+                try:
+                    if not future.result():
+                        cleared = False
+                except OSError as exc:
+                    self.error(os.path.join(path, name), exc)
+                    cleared = False
+        return cleared
+
+    def _claim(self):
+        # Takes an idle worker of the pool, if there is one
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+                return True
+        return False
+
+    def _split(self, parent_fd, name, parent_path):
+        # subtree(), run by a worker taken with _claim()
+        try:
+            return self.subtree(parent_fd, name, parent_path)
+        finally:
+            with self._lock:
+                self._idle += 1
+
+    def subtree(self, parent_fd, name, parent_path):
+        """Removes the directory name (in parent_fd) and everything in it,
+        and returns whether all of it went. If something in it is left, the
+        directory is too, without counting that as another error."""
+        path = os.path.join(parent_path, name)
+        fd = self.open(name, dir_fd=parent_fd)
+        try:
+            cleared = self.clear(fd, path)
+        finally:
+            os.close(fd)
+        if not cleared:
+            return False
+        os.rmdir(name, dir_fd=parent_fd)
+        self.done()
+        return True
+
+
 class _BaseRoot(object):
         """ Represents a start location for a path.
         
@@ -191,7 +948,7 @@ class _BaseRoot(object):
             raise NotImplementedError('__str__ is abstract')
 
         def __cmp__(self, other):
-            if isinstance(other, str) or isinstance(other, unicode):
+            if isinstance(other, str):
                 return -1
             elif isinstance(other, _BaseRoot):
                 return cmp(str(self), str(other))
@@ -201,7 +958,7 @@ class _BaseRoot(object):
 
         def __hash__(self):
             # This allows path objects to be hashable
-            return hash(unicode(self))
+            return hash(str(self))
 
 class BasePath(tuple):
     """ The base, abstract, path type.
@@ -228,12 +985,30 @@ class BasePath(tuple):
     _sep = None
     _altsep = None
 
+    # For paths yielded by Dir.fwalk, a one-item list holding the
+    # descriptor of their directory, set to None once the walk closes it
+    _dirfd_cell = (None,)
+
+    @property
+    def _dirfd(self):
+        # The descriptor of the directory holding this path, while open
+        return self._dirfd_cell[0]
+
     @staticmethod
     def _parse_str(pathstr):
         # Concrete path classes should implement _parse_str to get a path
         # string and return an iterable over path elements.
         raise NotImplementedError('_parse_str is abstract')
 
+    @staticmethod
+    def normcasestr(string):
+        """ Normalize the case of one path element.
+
+        By default path elements are case sensitive, and this returns
+        string unchanged.
+        """
+        return string
+
     @classmethod
     def _normalize_elements(cls, elements):
         # This method gets an iterable over path elements.
@@ -241,7 +1016,7 @@ class BasePath(tuple):
         # that is, curdir elements should be ignored.
         
         for i, element in enumerate(elements):
-            if isinstance(element, str) or isinstance(element, unicode):
+            if isinstance(element, str):
                 if element != cls._curdir:
                     if (not element or
                         cls._sep in element or
@@ -280,7 +1055,7 @@ class BasePath(tuple):
             return tuple.__new__(cls, arg)
         elif isinstance(arg, cls._OSBaseRoot):
             return tuple.__new__(cls, (arg,))
-        elif isinstance(arg, str) or isinstance(arg, unicode):
+        elif isinstance(arg, str):
             return tuple.__new__(cls, cls._parse_str(arg))
         else:
             return tuple.__new__(cls, cls._normalize_elements(arg))
@@ -289,6 +1064,14 @@ class BasePath(tuple):
         # Since paths are immutable, we can cache the string representation
         self._cached_str = None
 
+    @classmethod
+    def _from_elements(cls, elements):
+        # Builds a path from elements that are known to be valid, without
+        # checking them again.
+        path = tuple.__new__(cls, elements)
+        path._cached_str = None
+        return path
+
     def _build_str(self):
         # Return a string representation of self.
         # 
@@ -297,7 +1080,7 @@ class BasePath(tuple):
         if not self:
             return self._curdir
         elif isinstance(self[0], self._OSBaseRoot):
-            return unicode(self[0]) + self._sep.join(self[1:])
+            return str(self[0]) + self._sep.join(self[1:])
         else:
             return self._sep.join(self)
 
@@ -307,15 +1090,9 @@ class BasePath(tuple):
             self._cached_str = self._build_str()
         return str(self._cached_str)
     
-    def __unicode__(self):
-        """ Return a string representation of self. """
-        if self._cached_str is None:
-            self._cached_str = self._build_str()
-        return self._cached_str
-
     def __repr__(self):
         # We want path, not the real class name.
-        return 'Path(%r)' % unicode(self)
+        return 'Path(%r)' % str(self)
 
     @property
     def isabs(self):
@@ -449,12 +1226,17 @@ class BasePath(tuple):
         else:
             return self.__class__(self._Dir.cwd() + self)
 
-    def realpath(self):
+    def realpath(self, cache=None):
         """Returns the canonical path to an object, without any symbolic
-        links"""
-        return self.__class__(os.path.realpath(unicode(self)))
+        links.
 
-    def relpathto(self, dst):
+        cache may be a RealpathCache, in which case directories already
+        resolved through it are not resolved again."""
+        if cache is not None:
+            return cache.resolve(self)
+        return self.__class__(os.path.realpath(str(self)))
+
+    def relpathto(self, dst, cache=None):
         """ Return a relative path from self to dest.
 
         This method examines self.realpath() and dest.realpath(). If
@@ -462,10 +1244,28 @@ class BasePath(tuple):
         Path([path.pardir, path.pardir, ..., dir1, dir2, ...])
         is returned. If they have different root elements,
         dest.realpath() is returned.
+
+        cache may be a RealpathCache, which is passed on to realpath().
         """
-        src = self.realpath()
-        dst = self.__class__(dst).realpath()
+        src = self.realpath(cache)
+        dst = self.__class__(dst).realpath(cache)
+        return self._relative(src, dst)
+
+    def relpathto_many(self, paths, cache=None):
+        """ Return a list of relative paths from self to each of paths.
 
+        Equivalent to [self.relpathto(p) for p in paths], but self is
+        resolved only once, and the paths are resolved through a
+        RealpathCache (a new one unless cache is given).
+        """
+        if cache is None:
+            cache = RealpathCache()
+        src = self.realpath(cache)
+        return [self._relative(src, self.__class__(dst).realpath(cache))
+                for dst in paths]
+
+    def _relative(self, src, dst):
+        # The relpathto() algorithm, on already canonical paths
         if src[0] == dst[0]:
             # They have the same root
             
@@ -487,20 +1287,89 @@ class BasePath(tuple):
     def extension(self):
         return ''.join(self[-1].rsplit('.', 1)[1:])
 
-    def norm(self, user=True, vars=False, real=False):
+    # The elements of home directories, by user name ('' for the current
+    # user, along with $HOME), for norm()
+    _homes = {}
+
+    @classmethod
+    def _home(cls, user):
+        # Returns the elements of the home directory of user, or None if
+        # there is no such user.
+        key = (user, os.environ.get('HOME') if not user else None)
+        if key not in cls._homes:
+            home = os.path.expanduser('~' + user)
+            cls._homes[key] = None if home.startswith('~') else tuple(cls(home))
+        return cls._homes[key]
+
+    def expanduser(self):
+        """Returns the path with a leading ~ or ~user element replaced by
+        the home directory of the user, like os.path.expanduser.
+
+        Home directories are looked up once, and cached."""
+        first = tuple.__getitem__(self, 0) if self else None
+        if not (isinstance(first, str) and first.startswith('~')):
+            return self
+        home = self._home(first[1:])
+        if home is None:
+            return self
+        return self.__class__._from_elements(home + tuple(self)[1:])
+
+    @classmethod
+    def _collapse(cls, elements):
+        # Removes '..' elements along with those before them
+        rooted = bool(elements) and isinstance(elements[0], cls._OSBaseRoot)
+        out = []
+        for element in elements:
+            if element == cls._pardir:
+                if rooted and len(out) == 1:
+                    # The parent of the root is the root
+                    continue
+                if out and out[-1] != cls._pardir:
+                    out.pop()
+                    continue
+            out.append(element)
+        return out
+
+    def norm(self, user=True, vars=False, real=False, collapse=True,
+             cache=None):
         """Returns a Path object equivalent to self, but normalized
         with respect to case, separators, and (optionally) user
-        and home variables."""
-        s = unicode(self)
+        and home variables.
+
+        With collapse = True, '..' elements are removed together with the
+        element before them, as os.path.normpath does. That is only right
+        if that element isn't a symbolic link, so collapse = False leaves
+        them in.
+
+        Normalizing works on the elements of the path rather than its
+        string, except for expanding variables. cache may be a
+        RealpathCache, used when real is True."""
+        path = self
         if user:
-            s = os.path.expanduser(s)
+            path = path.expanduser()
         if vars:
-            s = os.path.expandvars(s)
+            path = self.__class__(os.path.expandvars(str(path)))
         if real:
-            s = os.path.realpath(s)
-        s = os.path.normcase(s)
-        s = os.path.normpath(s)
-        return self.__class__(s)
+            path = path.realpath(cache)
+        elements = path
+        normcasestr = self.__class__.normcasestr
+        if normcasestr is not BasePath.normcasestr:
+            elements = [normcasestr(e) if isinstance(e, str)
+                        else e for e in elements]
+        if collapse and tuple.__contains__(path, self._pardir):
+            elements = self._collapse(elements)
+        if elements is self:
+            return self
+        return self.__class__._from_elements(elements)
+
+    @classmethod
+    def norm_many(cls, paths, user=True, vars=False, real=False,
+                  collapse=True):
+        """Returns a list of the paths normalized as by norm(), sharing a
+        RealpathCache if real is True."""
+        cache = RealpathCache() if real else None
+        return [cls(p).norm(user, vars, real, collapse, cache) for p in paths]
+
     # --- Info about the path
 
     def stat(self, usecache = True, followlinks = True):
@@ -554,15 +1423,98 @@ class BasePath(tuple):
             return self._File(self)
         else:
             return self._Path(self)
-    
+
+    # --- Bulk lookups
+
+    # Paths sharing a parent directory are looked up with a single listing
+    # of that directory once there are at least this many of them; fewer
+    # are stat()ed one by one.
+    _scandir_threshold = 16
+    # Number of single stat() calls handed to a worker at once.
+    _stat_chunk = 64
+
+    @classmethod
+    def _kinds_many(cls, paths, followlinks=True, workers=None):
+        """Private method for looking up the kinds of many paths at once.
+
+        Returns a list of path objects and a list of kinds (see _mode_kind),
+        both in input order; the kind is None for paths that don't exist."""
+        paths = [cls(p) for p in paths]
+        kinds = [None] * len(paths)
+
+        groups = {}
+        singles = []
+        for i, p in enumerate(paths):
+            if (p and not isinstance(p[-1], cls._OSBaseRoot) and
+                    p[-1] != cls._pardir):
+                groups.setdefault(str(p[:-1]), []).append(i)
+            else:
+                singles.append(i)
+        scans = []
+        for parent, idxs in groups.items():
+            if len(idxs) >= cls._scandir_threshold:
+                scans.append((parent, idxs))
+            else:
+                singles.extend(idxs)
+
+        def stat_many(idxs):
+            for i in idxs:
+                kinds[i] = _stat_kind(str(paths[i]), followlinks)
+
+        def scan(job):
+            parent, idxs = job
+            try:
+                with os.scandir(parent) as it:
+                    entries = dict((cls.normcasestr(e.name), e) for e in it)
+            except OSError:
+                # Unreadable (but perhaps searchable) directories can still
+                # be stat()ed through.
+                return stat_many(idxs)
+            for i in idxs:
+                entry = entries.get(cls.normcasestr(paths[i][-1]))
+                if entry is not None:
+                    kinds[i] = _entry_kind(entry, followlinks)
+
+        chunks = [singles[i:i + cls._stat_chunk]
+                  for i in range(0, len(singles), cls._stat_chunk)]
+        with _ThreadPool(workers) as pool:
+            list(pool.map(scan, scans))
+            list(pool.map(stat_many, chunks))
+        return paths, kinds
+
+    @classmethod
+    def exists_many(cls, paths, followlinks=True, workers=None):
+        """Returns a list of booleans, one per path, each True if that path
+        exists.
+
+        Paths are grouped by their parent directory: a directory holding
+        many of the paths is listed once, and the rest are stat()ed on a
+        pool of 'workers' threads.
+
+        With followlinks = False, links pointing to nothing count as
+        existing."""
+        paths, kinds = cls._kinds_many(paths, followlinks, workers)
+        return [kind is not None for kind in kinds]
+
+    @classmethod
+    def transform_many(cls, paths, followlinks=True, workers=None):
+        """Returns a list of Dir, File, Link or Path objects, one per path,
+        as transform() would.
+
+        Paths that do not exist (or are special objects) are returned as
+        Path objects. Lookups are done as in exists_many."""
+        paths, kinds = cls._kinds_many(paths, followlinks, workers)
+        types = {_DIR: cls._Dir, _FILE: cls._File, _LINK: cls._Link}
+        return [types.get(kind, cls._Path)(p) for p, kind in zip(paths, kinds)]
+
     @property
     def ismount(self):
-        return os.path.ismount(unicode(self))
+        return os.path.ismount(str(self))
 
     # --- Modifying operations on files and directories
 
     def rename(self, new):
-        os.rename(unicode(self), unicode(new))
+        os.rename(str(self), str(new))
 
     # Additional methods in subclasses:
     # chown (PosixPath, XXX MacPath)
@@ -573,13 +1525,13 @@ class BasePath(tuple):
 
     def mkdir(self, mode=0o777, all = False):
         if all:
-            os.makedirs(unicode(self), mode)
+            os.makedirs(str(self), mode)
         else:
-            os.mkdir(unicode(self), mode)
+            os.mkdir(str(self), mode)
 
     # --- Modifying operations on files
     def remove(self):
-        os.remove(unicode(self))
+        os.remove(str(self))
 
     def copy(self, dst, copystat=False):
         """ Copy file from self to dst.
@@ -591,17 +1543,17 @@ class BasePath(tuple):
         name as self will be created in that directory.
         """
         dst = self.__class__(dst)
-        if dst.exists() and dst.stat().isdir:
+        if os.path.isdir(str(dst)):
             dst += self[-1]
-        shutil.copyfile(unicode(self), unicode(dst))
+        shutil.copyfile(str(self), str(dst))
         if copystat:
-            shutil.copystat(unicode(self), unicode(dst))
+            shutil.copystat(str(self), str(dst))
         else:
-            shutil.copymode(unicode(self), unicode(dst))
+            shutil.copymode(str(self), str(dst))
 
     def move(self, dst):
         dst = self.__class__(dst)
-        return shutil.move(unicode(self), unicode(dst))
+        return shutil.move(str(self), str(dst))
         
 
     # --- Links
@@ -627,7 +1579,7 @@ class BaseFile(BasePath):
         return BasePath.__init__(self, arg)
 
     def __repr__(self):
-        return 'File(%r)' % unicode(self)
+        return 'File(%r)' % str(self)
     def _getnotend(self, tpl):
         """Allows subclasses to define what class is returned if the slice requested does not include the final path piece"""
         return self._Dir(tpl)
@@ -636,22 +1588,278 @@ class BaseFile(BasePath):
         """ Set the access/modified times of this file to the current time.
         Create the file if it does not exist.
         """
-        fd = os.open(unicode(self), os.O_WRONLY | os.O_CREAT, 0o666)
+        fd = os.open(str(self), os.O_WRONLY | os.O_CREAT, 0o666)
         os.close(fd)
-        os.utime(unicode(self), None)
+        os.utime(str(self), None)
 
     def open(self, *args, **kwargs):
         """Return a file object that can be read or written to.
         
-        Takes the same arguments as the built in 'open' command."""
-        return open(unicode(self), *args, **kwargs)
+        Takes the same arguments as the built in 'open' command, and also:
+
+        compression: None, 'gz', 'bz2', 'xz', or 'auto'. The file is then
+            read or written (de)compressed as a stream. With 'auto', the
+            compression is told from the first bytes of the file when
+            reading, or from the extension when writing; files that look
+            uncompressed are opened as they are.
+        workers: the number of threads compressing blocks when writing.
+        level: the compression level, or None for the codec's default."""
+        compression = kwargs.pop('compression', None)
+        workers = kwargs.pop('workers', None)
+        level = kwargs.pop('level', None)
+        if compression is not None:
+            return self._open_compressed(compression, workers, level,
+                                         *args, **kwargs)
+        return self._open(*args, **kwargs)
+
+    def _open_compressed(self, compression, workers, level, mode='r',
+                         encoding=None, errors=None, newline=None):
+        reading = 'r' in mode
+        if '+' in mode or reading == bool(set('wax') & set(mode)):
+            raise ValueError("Invalid mode for a compressed file: %r" % mode)
+        binmode = mode.replace('t', '').replace('b', '') + 'b'
+        raw = self._open(binmode)
+        try:
+            if compression == 'auto':
+                compression = self._compression(raw if reading else None)
+            if compression is None:
+                stream = raw
+            elif reading:
+                stream = io.BufferedReader(_DecompressReader(raw, compression))
+            else:
+                stream = _BlockCompressWriter(raw, compression, workers,
+                                              level=level)
+        except Exception:
+            raw.close()
+            raise
+        if 'b' in mode:
+            return stream
+        return io.TextIOWrapper(stream, encoding, errors, newline)
+
+    def _compression(self, raw=None):
+        # The compression of the file, from the first bytes in raw (a
+        # buffered binary file), or from the extension
+        if raw is not None:
+            start = raw.peek(6)[:6]
+            for magic, compression in _COMPRESSION_MAGIC:
+                if start.startswith(magic):
+                    return compression
+            return None
+        return _COMPRESSION_EXTENSIONS.get(self.extension.lower())
+
+    def _open(self, *args, **kwargs):
+        if self._dirfd is not None:
+            dirfd = self._dirfd
+            kwargs.setdefault('opener', lambda name, flags:
+                              os.open(name, flags, dir_fd=dirfd))
+            return open(self[-1], *args, **kwargs)
+        return open(str(self), *args, **kwargs)
+
+    @staticmethod
+    def _last_lines(f, n, blocksize):
+        # Returns the last n lines in the binary file f, read backwards in
+        # blocks from its end, and where that end is; f is left there
+        end = pos = f.seek(0, io.SEEK_END)
+        blocks = []
+        newlines = 0
+        while pos > 0 and n > 0:
+            size = min(blocksize, pos)
+            pos -= size
+            f.seek(pos)
+            block = f.read(size)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+            # A newline at the very end closes the last line, rather than
+            # starting another one
+            if newlines - (blocks[0].endswith(b'\n')) >= n:
+                break
+        f.seek(end)
+        data = b''.join(reversed(blocks))
+        return data.splitlines(True)[-n:] if n > 0 else [], end
+
+    def tail(self, n=10, encoding='utf-8', blocksize=64 << 10):
+        """Returns the last n lines of the file, with their line endings.
+
+        The file is read backwards from its end, in blocks of blocksize
+        bytes, only as far as needed to find n lines. Lines are decoded
+        with encoding, or left as bytes if encoding is None."""
+        with self.open('rb') as f:
+            lines = self._last_lines(f, n, blocksize)[0]
+        if encoding is not None:
+            lines = [line.decode(encoding) for line in lines]
+        return lines
+
+    def follow(self, n=0, encoding='utf-8', interval=0.05, max_interval=1.0,
+               timeout=None, blocksize=64 << 10):
+        """Yields the lines appended to the file as they are written, as
+        'tail -F' does, starting with its last n lines.
+
+        Where inotify is available, this waits for the file to change;
+        otherwise it polls, every interval seconds at first, backing off up
+        to max_interval while nothing is written. Stops once nothing has
+        been written for timeout seconds, or never if it is None.
+
+        If the file is rotated (another file is put at its path), the rest
+        of the old one is read, then the new one is followed from its start.
+        If it is truncated, it is followed from its start again.
+
+        Lines are decoded with encoding, or left as bytes if encoding is
+        None. A last line with no newline is only yielded once the file is
+        rotated, or at the timeout."""
+        path = str(self)
+        try:
+            notify = _Inotify()
+        except OSError:
+            notify = None
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            lines, pos = self._last_lines(f, n, blocksize)
+            if lines and not lines[-1].endswith(b'\n'):
+                partial = lines.pop()
+            else:
+                partial = b''
+            for line in lines:
+                yield line if encoding is None else line.decode(encoding)
+            if notify is not None:
+                notify.watch(path, _Inotify.FILE_EVENTS)
+                notify.watch(os.path.dirname(path) or '.', _Inotify.DIR_EVENTS)
+            wait = interval
+            last = time.time()
+            while True:
+                data = f.read(blocksize)
+                if data:
+                    pos += len(data)
+                    lines = (partial + data).splitlines(True)
+                    partial = b''
+                    if not lines[-1].endswith(b'\n'):
+                        partial = lines.pop()
+                    for line in lines:
+                        yield line if encoding is None else line.decode(encoding)
+                    wait = interval
+                    last = time.time()
+                    continue
+                try:
+                    current = Stats(path)
+                except OSError:
+                    # Being rotated; keep the old one until the new one is there
+                    current = None
+                if current is not None and (current.inode, current.device) != \
+                        (st.st_ino, st.st_dev):
+                    if partial:
+                        yield partial if encoding is None \
+                            else partial.decode(encoding)
+                        partial = b''
+                    f.close()
+                    f = open(path, 'rb')
+                    st = os.fstat(f.fileno())
+                    pos = 0
+                    if notify is not None:
+                        notify.watch(path, _Inotify.FILE_EVENTS)
+                    continue
+                if current is not None and current.size < pos:
+                    # Truncated: what is there now was written since
+                    pos = f.seek(0)
+                    partial = b''
+                    continue
+                remaining = None
+                if timeout is not None:
+                    remaining = last + timeout - time.time()
+                    if remaining <= 0:
+                        break
+                if notify is not None:
+                    # Polling too, in case an event was missed
+                    notify.wait(max_interval if remaining is None
+                                else min(max_interval, remaining))
+                else:
+                    time.sleep(wait if remaining is None
+                               else min(wait, remaining))
+                    wait = min(wait * 2, max_interval)
+            if partial:
+                yield partial if encoding is None else partial.decode(encoding)
+        finally:
+            f.close()
+            if notify is not None:
+                notify.close()
+
+    # --- Line indexes
+
+    _line_index_suffix = '.lineidx'
+
+    def _line_index_path(self):
+        # The sidecar file holding the line index of this file
+        return self._File(self[:-1] + ('.' + self[-1] + self._line_index_suffix))
+
+    def line_index(self, every=1024, sidecar=None, use_mmap=False,
+                   rebuild=False):
+        """Returns a LineIndex of this file: the offset of every 'every'th
+        line, from which any line can be found by reading at most 'every'
+        lines.
+
+        The index is kept in a sidecar file (by default, '.NAME.lineidx'
+        next to this one), and built again if this file's size or
+        modification time have changed since, if it was built with another
+        'every', or if rebuild is True. It is built in a single pass
+        over the file, read in blocks or, with use_mmap, through a memory
+        map. If the sidecar can't be written, the index is still returned."""
+        sidecar = self._line_index_path() if sidecar is None \
+            else self._File(sidecar)
+        st = self.stat()._stat()
+        if not rebuild:
+            try:
+                with open(str(sidecar), 'rb') as f:
+                    index = LineIndex.load(f)
+            except (IOError, OSError, ValueError):
+                index = None
+            if index is not None and index.every == every and \
+                    (index.size, index.mtime_ns) == (st.st_size, st.st_mtime_ns):
+                return index
+        with self.open('rb') as f:
+            index = LineIndex.build(f, every, use_mmap)
+        index.mtime_ns = st.st_mtime_ns
+        tmp = str(sidecar) + '.tmp%d' % os.getpid()
+        try:
+            with open(tmp, 'wb') as f:
+                index.dump(f)
+            os.replace(tmp, str(sidecar))
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return index
+
+    def read_lines(self, start, stop=None, encoding='utf-8', index=None):
+        """Returns the lines of the file from line number start (counting
+        from 0) up to, but not including, stop (or the end), with their line
+        endings.
+
+        The file is read from the closest line in its line index (see
+        line_index, which is called if index isn't given), so that reading
+        lines near the end of a huge file costs about as much as reading
+        those at its start. Lines are decoded with encoding, or left as
+        bytes if encoding is None."""
+        if index is None:
+            index = self.line_index()
+        if stop is None or stop > index.lines:
+            stop = index.lines
+        lines = []
+        if start < stop:
+            offset, skip = index.seek(start)
+            with self.open('rb') as f:
+                f.seek(offset)
+                for n in range(skip):
+                    f.readline()
+                for n in range(stop - start):
+                    lines.append(f.readline())
+        if encoding is not None:
+            lines = [line.decode(encoding) for line in lines]
+        return lines
 
     def __add__(self, other):
         raise ValueError("File objects not supported as left operand")
 
 class BaseDir(BasePath):
     def __repr__(self):
-        return 'Dir(%r)' % unicode(self)
+        return 'Dir(%r)' % str(self)
     def _getnotend(self, tpl):
         """Allows subclasses to define what class is returned if the slice requested does not include the final path piece"""
         return self.__class__(tpl)
@@ -663,18 +1871,963 @@ class BaseDir(BasePath):
 
     def chdir(self):
         """Changes current working directory to be this directory"""
-        return os.chdir(unicode(self))
+        return os.chdir(str(self))
     
     def remove(self):
-        os.rmdir(unicode(self))
+        os.rmdir(str(self))
+
+    def rmtree(self, workers=None, progress=None, ignore_errors=False):
+        """Removes this directory and everything in it.
+
+        Entries are removed relative to open directory descriptors, so the
+        kernel doesn't resolve the full path of each one, and subdirectories
+        (at any depth) are removed in parallel on a pool of 'workers'
+        threads, whenever one of them is idle. Links are removed, never
+        followed.
+
+        progress, if given, is called with the number of entries removed
+        and errors met so far, every so often and once at the end.
+
+        Returns a (removed, errors) tuple of counts. Unless ignore_errors
+        is True, the first error is raised once everything that could be
+        removed has been.
+
+        Where directory descriptors aren't supported, this falls back to
+        shutil.rmtree, and removed is None."""
+        path = str(self)
+        if stat.S_ISLNK(os.lstat(path).st_mode):
+            raise OSError("Refusing to remove the tree of a link: %s" % path)
+        if not _FD_RMTREE:
+            errors = []
+            if sys.version_info >= (3, 12):
+                shutil.rmtree(path, onexc=lambda f, p, e: errors.append((p, e)))
+            else:
+                shutil.rmtree(path,
+                              onerror=lambda f, p, e: errors.append((p, e[1])))
+            return self._rmtree_result(None, errors, progress, ignore_errors)
+
+        workers = workers or os.cpu_count() or 1
+        with _ThreadPool(workers) as pool:
+            remover = _TreeRemover(progress, pool, workers)
+            fd = remover.open(path)
+            try:
+                cleared = remover.clear(fd, path)
+            finally:
+                os.close(fd)
+        if cleared:
+            # Otherwise something is left in it
+            try:
+                os.rmdir(path)
+                remover.done()
+            except OSError as exc:
+                remover.error(path, exc)
+        return self._rmtree_result(remover.removed, remover.errors, progress,
+                                   ignore_errors)
+
+    @staticmethod
+    def _rmtree_result(removed, errors, progress, ignore_errors):
+        if progress:
+            progress(removed, len(errors))
+        if errors and not ignore_errors:
+            raise errors[0][1]
+        return RmtreeResult(removed, len(errors))
     
-    def children(self):
-        for child in os.listdir(unicode(self)):
+    # The name of the file marking a move to another filesystem in progress
+    _move_marker = '.fpath-move'
+
+    def move(self, dst, workers=None, checksum=False):
+        """Moves this directory, and everything in it, to dst, and returns
+        the path it was moved to, as a string (as Path.move does).
+
+        As with shutil.move, if dst is an existing directory, this one is
+        moved into it. The whole tree is renamed if it can be. When dst is
+        on another filesystem, the tree is copied over file by file, on a
+        pool of 'workers' threads, and each file is removed from here once
+        its copy is verified: same size and, if checksum is True, same
+        SHA-256 digest. Subdirectories on the same filesystem as dst (mount
+        points) are renamed at once.
+
+        Such a move leaves a marker file in the destination until it is
+        done. If it is interrupted, moving again to the same dst picks up
+        where it stopped; files already there are only kept if their
+        SHA-256 digests match. If it fails, the directories it made at the
+        destination which are still empty are removed, along with the
+        marker if nothing was moved yet. Otherwise, an existing target
+        directory which isn't empty raises an OSError, as shutil.move does.
+        """
+        target = self._Dir(dst)
+        if os.path.isdir(str(target)) and not self._resumes(target):
+            target = self._Dir(target + self[-1])
+        resuming = self._resumes(target)
+        if not resuming:
+            if os.path.lexists(str(target)) and not (
+                    os.path.isdir(str(target)) and
+                    not os.listdir(str(target))):
+                raise OSError(errno.EEXIST, "Destination path already "
+                              "exists: %s" % str(target))
+            try:
+                os.rename(str(self), str(target))
+                return str(target)
+            except OSError as exc:
+                if exc.errno != errno.EXDEV:
+                    raise
+        self._move_across(target, workers, checksum, resuming)
+        return str(target)
+
+    def _resumes(self, target):
+        # Whether target holds an interrupted move of this directory
+        try:
+            with open(str(target + self._move_marker)) as f:
+                return f.read() == str(self.abspath())
+        except (IOError, OSError):
+            return False
+
+    @staticmethod
+    def _same_contents(src, dst, checksum):
+        # Whether dst is a complete copy of the file src
+        try:
+            if os.stat(src).st_size != os.stat(dst).st_size:
+                return False
+        except OSError:
+            return False
+        if not checksum:
+            return True
+        digests = []
+        for path in (src, dst):
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            digests.append(digest.digest())
+        return digests[0] == digests[1]
+
+    def _move_across(self, target, workers, checksum, resuming=False):
+        # The copy-then-delete part of move. Files already at the target
+        # are only taken as copies when resuming an interrupted move.
+        src, dst = str(self.abspath()), str(target)
+        created = not os.path.isdir(dst)
+        if created:
+            os.makedirs(dst)
+        marker = os.path.join(dst, self._move_marker)
+        with open(marker, 'w') as f:
+            f.write(src)
+        dst_dev = os.stat(dst).st_dev
+        # (source, destination) directories, parents first
+        dirs = []
+        try:
+            self._move_tree(src, dst, dst_dev, dirs, workers, checksum,
+                            resuming)
+        except BaseException:
+            # Keep what a later move would resume from, and no more
+            for s, d in reversed(dirs[1:]):
+                try:
+                    os.rmdir(d)
+                except OSError:
+                    pass
+            if os.listdir(dst) == [self._move_marker]:
+                os.remove(marker)
+                if created:
+                    os.rmdir(dst)
+            raise
+        for s, d in reversed(dirs):
+            shutil.copystat(s, d)
+            os.rmdir(s)
+        os.remove(marker)
+
+    def _move_tree(self, src, dst, dst_dev, dirs, workers, checksum,
+                   resuming):
+        # Moves what is in src to dst, appending the (source, destination)
+        # directories to dirs as they are made
+        def jobs():
+            # Recreates the directories, and yields the rest to be moved
+            stack = [(src, dst)]
+            dirs.append((src, dst))
+            while stack:
+                s, d = stack.pop()
+                with os.scandir(s) as it:
+                    entries = list(it)
+                for entry in entries:
+                    spath = entry.path
+                    dpath = os.path.join(d, entry.name)
+                    kind = _entry_kind(entry, followlinks=False)
+                    if kind != _DIR:
+                        yield spath, dpath, kind
+                        continue
+                    if not os.path.lexists(dpath) and \
+                            entry.stat(follow_symlinks=False).st_dev == dst_dev:
+                        try:
+                            os.rename(spath, dpath)
+                            continue
+                        except OSError:
+                            pass
+                    if not os.path.isdir(dpath):
+                        os.mkdir(dpath)
+                    dirs.append((spath, dpath))
+                    stack.append((spath, dpath))
+
+        def move_one(job):
+            spath, dpath, kind = job
+            try:
+                if kind == _LINK:
+                    linkto = os.readlink(spath)
+                    if os.path.lexists(dpath):
+                        os.remove(dpath)
+                    os.symlink(linkto, dpath)
+                elif kind == _FILE:
+                    if not (resuming and
+                            self._same_contents(spath, dpath, True)):
+                        part = dpath + '.fpath-part'
+                        try:
+                            shutil.copy2(spath, part)
+                            os.replace(part, dpath)
+                        except BaseException:
+                            if os.path.lexists(part):
+                                os.remove(part)
+                            raise
+                        if not self._same_contents(spath, dpath, checksum):
+                            raise IOError("The copy of %s to %s doesn't match"
+                                          % (spath, dpath))
+                elif kind is not None:
+                    raise IOError("Can't move special file %s" % spath)
+                else:
+                    # Gone since it was listed
+                    return None
+                os.remove(spath)
+            except (IOError, OSError) as exc:
+                return exc
+            return None
+
+        with _ThreadPool(workers) as pool:
+            errors = [exc for exc in _imap_unordered(pool, move_one, jobs())
+                      if exc is not None]
+        if errors:
+            raise errors[0]
+
+    def apply_metadata(self, mode=None, owner=None, times=None, filter=None,
+                       workers=None, ignore_errors=False):
+        """Sets permissions, ownership and/or times on this directory and
+        everything below it.
+
+        mode is as for Stats.mode, owner a (uid, gid) tuple (either may be
+        None or -1 to leave it alone) and times an (atime, mtime) tuple of
+        timestamps or datetimes, as for Stats.amtime. filter, if given, is
+        called with each object (as a Dir, File or Path) and only those it
+        returns True for are changed.
+
+        Links are neither followed nor changed. Entries that already have
+        the requested values, according to the stat() made while walking,
+        are skipped; the rest are changed on a pool of 'workers' threads.
+        Directories are changed once the walk is over, deepest first, so a
+        mode without search permission doesn't lock the walk out of them;
+        directories which can't already be listed aren't walked into,
+        though.
+
+        Returns a (checked, changed, errors) tuple of counts, directories
+        which couldn't be listed counting as errors. Unless ignore_errors
+        is True, the first error is raised once everything else has been
+        changed."""
+        if owner is not None:
+            owner = tuple(-1 if i is None else i for i in owner)
+        if times is not None:
+            times = tuple(int(round(1e9 * (Stats._totimestamp(t)
+                          if isinstance(t, datetime) else t))) for t in times)
+
+        def changes(pathstr, st):
+            # The syscalls needed to bring pathstr in line
+            calls = []
+            if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+                calls.append((os.chmod, (pathstr, mode), {}))
+            if owner is not None and (
+                    owner[0] not in (-1, st.st_uid) or
+                    owner[1] not in (-1, st.st_gid)):
+                calls.append((os.chown, (pathstr,) + owner, {}))
+            if times is not None and times != (st.st_atime_ns, st.st_mtime_ns):
+                calls.append((os.utime, (pathstr,), {'ns': times}))
+            return calls
+
+        errors = []
+        def entries():
+            root = str(self)
+            yield root, os.stat(root), self
+            for dirpath, entry in _scan_tree(root, onerror=errors.append):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                kind = _mode_kind(st.st_mode)
+                if kind == _LINK:
+                    continue
+                path = None
+                if filter is not None:
+                    path = self._Path(entry.path)
+                    if kind == _DIR:
+                        path = self._Dir(path)
+                    elif kind == _FILE:
+                        path = self._File(path)
+                yield entry.path, st, path
+
+        checked = [0]
+        dirs = {}
+        def todo():
+            for pathstr, st, path in entries():
+                if filter is not None and not filter(path):
+                    continue
+                checked[0] += 1
+                calls = changes(pathstr, st)
+                if not calls:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    # Left until the walk is done, by depth
+                    dirs.setdefault(pathstr.count(os.sep), []).append(
+                        (pathstr, calls))
+                else:
+                    yield pathstr, calls
+
+        def apply(item):
+            pathstr, calls = item
+            try:
+                for func, args, kwargs in calls:
+                    func(*args, **kwargs)
+            except OSError as exc:
+                return pathstr, exc
+            return pathstr, None
+
+        changed = 0
+        with _ThreadPool(workers) as pool:
+            def dir_results():
+                for depth in sorted(dirs, reverse=True):
+                    for result in pool.map(apply, dirs[depth]):
+                        yield result
+            for pathstr, exc in itertools.chain(
+                    _imap_unordered(pool, apply, todo()), dir_results()):
+                if exc is None:
+                    changed += 1
+                else:
+                    errors.append(exc)
+        if errors and not ignore_errors:
+            raise errors[0]
+        return MetadataResult(checked[0], changed, len(errors))
+
+    def estimate(self, budget=1000, confidence=0.95, by_subdir=False,
+                 seed=None):
+        """Estimates the number of files below this directory and their
+        total size, without walking all of it.
+
+        Random paths down the tree are sampled (with Knuth's tree size
+        estimator) until about budget syscalls have been made. Returns an
+        Estimate tuple of (files, bytes, files_margin, bytes_margin, probes,
+        syscalls, subdirs): the true values lie within the margins of the
+        estimates with the given confidence, roughly. When the budget is
+        enough to list the whole tree, the counts are exact and the margins
+        are 0, though sizes are still sampled in directories of many files.
+        Links are not followed.
+
+        With by_subdir, the budget is split between the subdirectories of
+        this one, each estimated on its own, and subdirs is a dict of their
+        Estimates by name.
+        """
+        rng = random.Random(seed)
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2.)
+        root = str(self)
+        if not by_subdir:
+            return self._estimate(_TreeEstimator(rng), root, budget, z)
+
+        estimator = _TreeEstimator(rng)
+        files, nbytes, subdirs = estimator.visit(root)
+        share = max(1, (budget - estimator.syscalls) // max(1, len(subdirs)))
+        estimates = dict(
+            (os.path.basename(d),
+             self._estimate(_TreeEstimator(rng), d, share, z))
+            for d in subdirs)
+        values = list(estimates.values())
+        return Estimate(
+            files + sum(e.files for e in values),
+            nbytes + sum(e.bytes for e in values),
+            sum(e.files_margin ** 2 for e in values) ** .5,
+            sum(e.bytes_margin ** 2 for e in values) ** .5,
+            sum(e.probes for e in values),
+            estimator.syscalls + sum(e.syscalls for e in values),
+            estimates)
+
+    @staticmethod
+    def _estimate(estimator, root, budget, z):
+        probes, exact = estimator.run(root, budget)
+        n = len(probes)
+        files = [p[0] for p in probes]
+        sizes = [p[1] for p in probes]
+        margins = [0., 0.]
+        if not exact and n > 1:
+            margins = [z * statistics.stdev(values) / n ** .5
+                       for values in (files, sizes)]
+        return Estimate(statistics.mean(files), statistics.mean(sizes),
+                        margins[0], margins[1], n, estimator.syscalls, None)
+
+    def scan_parallel(self, func=None, mode = 'fd', processes=None,
+                      batch=256):
+        """Walks the tree below this directory on a pool of processes,
+        yielding what walk(mode) would, in no particular order.
+
+        If func is given, it is called in the worker processes with each
+        object, and (object, func(object)) pairs are yielded instead; it
+        must be picklable if processes are spawned rather than forked.
+
+        The tree is split into work units (the path strings of
+        subdirectories) that this process hands out to the workers.
+        Whenever a worker is idle, busy workers split off their biggest
+        pending subtrees as new units. Results come back in batches of up
+        to batch objects. Unreadable directories are skipped.
+
+        An error raised by func, or in pickling what it returned, is raised
+        once the walk is over. If a worker dies (killed, or out of memory),
+        OSError is raised.
+        """
+        ctx = multiprocessing.get_context()
+        tasks, results = ctx.Queue(), ctx.Queue()
+        idle = ctx.Value('i', 0)
+        workers = [ctx.Process(target=_scan_worker,
+                               args=(tasks, results, idle, func, mode, batch))
+                   for n in range(processes or os.cpu_count() or 1)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        types = {_DIR: self._Dir, _FILE: self._File, _LINK: self._Link}
+        error = None
+        try:
+            tasks.put(str(self))
+            units = 1
+            while units:
+                try:
+                    kind, payload = results.get(timeout=1)
+                except queue.Empty:
+                    for worker in workers:
+                        if worker.exitcode is not None:
+                            raise OSError("A worker of scan_parallel died, "
+                                          "with exit code %s" % worker.exitcode)
+                    continue
+                if kind == 'split':
+                    for unit in payload:
+                        tasks.put(unit)
+                    units += len(payload)
+                elif kind == 'done':
+                    units -= 1
+                elif kind == 'error':
+                    error = error or pickle.loads(payload)
+                elif error is None:
+                    for pathstr, k, result in pickle.loads(payload):
+                        obj = types.get(k, self._Path)(pathstr)
+                        yield obj if func is None else (obj, result)
+        finally:
+            for worker in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join(1)
+                if worker.is_alive():
+                    worker.terminate()
+        if error is not None:
+            raise error
+
+    def build_index(self, db_path, full=False):
+        """Indexes this directory and everything below it in the SQLite
+        database at db_path, and returns the FileIndex.
+
+        If the database already indexes this directory, only what changed
+        since is scanned again (unless full is True); see FileIndex."""
+        index = FileIndex(db_path)
+        index.add_root(self)
+        index.refresh(full)
+        return index
+
+    # Formats and compressions stream_archive can write
+    _archive_formats = ('tar',)
+    _archive_compressions = (None, 'gz', 'bz2', 'xz')
+
+    def stream_archive(self, fileobj=None, format='tar', compression=None,
+                       arcname=None, workers=4, readahead=32 << 20,
+                       onerror=None):
+        """Writes an archive of this directory and everything below it to
+        fileobj, or returns an iterator over the chunks of bytes of the
+        archive if fileobj is None.
+
+        The archive is written as the tree is walked, without temporary
+        files, so fileobj can be any writable stream: a socket, a pipe, etc.
+        format must be 'tar'; compression may be None, 'gz', 'bz2' or 'xz'.
+        Entries are named from arcname (by default, the name of this
+        directory) down. Directories, files and links are archived; links
+        are not followed, and special objects are left out. A file with
+        several hard links in the tree is stored once, and as hard links to
+        that entry after.
+
+        A pool of 'workers' threads reads upcoming files ahead of the
+        writer, holding at most readahead bytes; files too big to be read
+        ahead are streamed from disk when their turn comes. A streamed file
+        which shrinks before it is read is padded with zeros to the size
+        it had, and a warning logged.
+
+        What can't be listed, stat()ed or read (such as a file removed
+        since its directory was listed) is left out, and the OSError passed
+        to onerror, in the thread writing the archive; by default, a
+        warning is logged.
+        """
+        if format not in self._archive_formats:
+            raise ValueError("Unsupported archive format: %r" % format)
+        if compression not in self._archive_compressions:
+            raise ValueError("Unsupported compression: %r" % compression)
+        if arcname is None:
+            arcname = ''
+            if self and not isinstance(self[-1], self._OSBaseRoot):
+                arcname = self[-1]
+        if onerror is None:
+            onerror = self._log_archive_error
+        if fileobj is not None:
+            return self._write_archive(fileobj, compression, arcname,
+                                       workers, readahead, onerror)
+        return self._archive_chunks(compression, arcname, workers, readahead,
+                                    onerror)
+
+    @staticmethod
+    def _log_archive_error(exc):
+        _log.warning("Left out of the archive: %s", exc)
+
+    def _archive_chunks(self, compression, arcname, workers, readahead,
+                        onerror):
+        sink = _ChunkQueue()
+        def produce():
+            try:
+                self._write_archive(sink, compression, arcname, workers,
+                                    readahead, onerror)
+            except Exception as exc:
+                sink.finish(exc)
+            else:
+                sink.finish()
+        thread = threading.Thread(target=contextvars.copy_context().run,
+                                  args=(produce,))
+        thread.daemon = True
+        thread.start()
+        try:
+            for chunk in sink:
+                yield chunk
+        finally:
+            sink.abandon()
+            thread.join()
+
+    def _archive_entries(self, arcname, onerror):
+        # Yields (TarInfo, path string) pairs for everything to be archived
+        root = str(self)
+        yield self._tarinfo(arcname or '.', self.stat()._stat()), root
+        prefix = [arcname] if arcname else []
+        # The names files with several hard links were first archived as,
+        # by (st_dev, st_ino)
+        linked = {}
+        for dirpath, entry in _scan_tree(root, onerror=onerror):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError as exc:
+                onerror(exc)
+                continue
+            if _mode_kind(st.st_mode) == _OTHER:
+                continue
+            name = '/'.join(prefix + entry.path[len(root):].lstrip(os.sep)
+                                                          .split(os.sep))
+            linkto = None
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                linkto = linked.setdefault((st.st_dev, st.st_ino), name)
+                if linkto == name:
+                    linkto = None
+            try:
+                info = self._tarinfo(name, st, entry.path, linkto)
+            except OSError as exc:
+                onerror(exc)
+                continue
+            yield info, entry.path
+
+    @staticmethod
+    def _tarinfo(name, st, path=None, linkto=None):
+        # Builds a TarInfo from the result of a stat() call; a hard link to
+        # the entry named linkto if given
+        info = tarfile.TarInfo(name)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.uid, info.gid = st.st_uid, st.st_gid
+        info.mtime = st.st_mtime
+        kind = _mode_kind(st.st_mode)
+        if linkto is not None:
+            info.type = tarfile.LNKTYPE
+            info.linkname = linkto
+        elif kind == _DIR:
+            info.type = tarfile.DIRTYPE
+        elif kind == _LINK:
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(str(path))
+        else:
+            info.type = tarfile.REGTYPE
+            info.size = st.st_size
+        return info
+
+    def _write_archive(self, fileobj, compression, arcname, workers,
+                       readahead, onerror):
+        # Files up to this size are read ahead, bigger ones streamed; at
+        # most window entries are looked ahead at.
+        biggest = readahead // 8
+        window = 1024
+
+        def read(pathstr):
+            with open(pathstr, 'rb') as f:
+                return f.read()
+
+        mode = 'w|' + (compression or '')
+        with _ThreadPool(workers) as pool:
+            with tarfile.open(fileobj=fileobj, mode=mode, bufsize=1 << 16,
+                              format=tarfile.PAX_FORMAT) as tar:
+                entries = self._archive_entries(arcname, onerror)
+                # (TarInfo, path, future of contents or None) in archive order
+                pending = deque()
+                buffered = 0
+                exhausted = False
+                while pending or not exhausted:
+                    while not exhausted and (not pending or (
+                            buffered < readahead and len(pending) < window)):
+                        try:
+                            info, path = next(entries)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        future = None
+                        if info.isreg() and info.size <= biggest:
+                            future = pool.submit(read, path)
+                            buffered += info.size
+                        pending.append((info, path, future))
+                    if not pending:
+                        break
+                    info, path, future = pending.popleft()
+                    if future is not None:
+                        buffered -= info.size
+                        try:
+                            data = future.result()
+                        except (IOError, OSError) as exc:
+                            onerror(exc)
+                            continue
+                        # The file may have changed since it was stat()ed
+                        info.size = len(data)
+                        tar.addfile(info, io.BytesIO(data))
+                    elif info.isreg():
+                        try:
+                            f = open(path, 'rb')
+                        except (IOError, OSError) as exc:
+                            onerror(exc)
+                            continue
+                        with f:
+                            # The header is out before the contents, so a
+                            # file which shrank since it was stat()ed can
+                            # only be padded
+                            padded = _PaddedReader(f, info.size)
+                            tar.addfile(info, padded)
+                        if padded.short:
+                            _log.warning("%s shrank while being archived; "
+                                         "padded with zeros", path)
+                    else:
+                        tar.addfile(info)
+
+    @staticmethod
+    def _glob_matcher(pattern):
+        # Returns a function telling whether a file, given as the elements
+        # of its path relative to a directory, matches the glob pattern: its
+        # name does, or with a '/' in the pattern, its relative path does
+        if '/' in pattern:
+            return lambda rel: fnmatch.fnmatch('/'.join(rel), pattern)
+        return lambda rel: fnmatch.fnmatch(rel[-1], pattern)
+
+    # How many files read_many opens ahead of those it reads
+    _read_ahead = 64
+
+    def read_many(self, files=None, pattern=None, workers=8,
+                  max_buffered=64 << 20, max_size=None, ignore_errors=False):
+        """Reads many files concurrently, yielding (File, contents) pairs as
+        each is read, in no particular order.
+
+        files is an iterable of the files to read; relative paths are taken
+        as relative to this directory. Otherwise every file under this
+        directory is read, or, if pattern is given, those whose name matches
+        it (a glob pattern, such as '*.json'; with a '/' in it, it is
+        matched against the path relative to this directory).
+
+        Files are read on a pool of 'workers' threads. Each is opened, and
+        the kernel told to read it ahead, up to 64 files before a worker
+        gets to it. At most max_buffered bytes of contents are held at
+        once, counting those yielded until the next pair is asked for; a
+        file bigger than that is read once nothing else is held. Files
+        bigger than max_size bytes are skipped.
+
+        Unless ignore_errors is True, the first error reading a file is
+        raised once all the others have been read."""
+        if files is not None:
+            files = (self._File(f) for f in files)
+            files = (f if f.isabs else self._File(self + tuple(f))
+                     for f in files)
+        else:
+            files = self.walk('f')
+            if pattern is not None:
+                start = len(self)
+                match = self._glob_matcher(pattern)
+                files = (f for f in files if match(f[start:]))
+        budget = _ByteBudget(max_buffered)
+        fadvise = getattr(os, 'posix_fadvise', None)
+
+        def opened(files):
+            # Opens each file as it is handed to the pool, telling the
+            # kernel to read it ahead of the worker reading it
+            for f in files:
+                try:
+                    fobj = open(str(f), 'rb')
+                    try:
+                        size = os.fstat(fobj.fileno()).st_size
+                        if max_size is not None and size > max_size:
+                            fobj.close()
+                            continue
+                        if fadvise is not None:
+                            fadvise(fobj.fileno(), 0, 0,
+                                    os.POSIX_FADV_WILLNEED)
+                    except BaseException:
+                        fobj.close()
+                        raise
+                except (IOError, OSError) as exc:
+                    yield f, None, 0, exc
+                    continue
+                yield f, fobj, size, None
+
+        def read(item):
+            f, fobj, size, exc = item
+            if exc is not None:
+                return f, None, 0, exc
+            with fobj:
+                if budget.closed:
+                    return None
+                held = min(size, max_buffered)
+                if not budget.acquire(held):
+                    # The reader went away
+                    return None
+                try:
+                    return f, fobj.read(), held, None
+                except (IOError, OSError) as exc:
+                    budget.release(held)
+                    return f, None, 0, exc
+                except BaseException:
+                    budget.release(held)
+                    raise
+
+        errors = []
+        with _ThreadPool(workers) as pool:
+            results = _imap_unordered(pool, read, opened(files),
+                                      self._read_ahead)
+            try:
+                for result in results:
+                    if result is None:
+                        continue
+                    f, data, held, exc = result
+                    if exc is not None:
+                        errors.append(exc)
+                        continue
+                    try:
+                        yield f, data
+                    finally:
+                        budget.release(held)
+            finally:
+                # If stopped early, unblock the workers waiting for room, and
+                # let those yet to start return at once
+                budget.close()
+                results.close()
+        if errors and not ignore_errors:
+            raise errors[0]
+
+    def writer(self, workers=8, durable=True, sweep=True):
+        """Returns a BatchWriter, writing many files below this directory
+        and publishing them together; use it as a context manager:
+
+            with Dir('out').writer() as batch:
+                for name, data in results:
+                    batch.write(name, data)
+        """
+        return BatchWriter(self, workers, durable, sweep)
+
+    def grep(self, pattern, glob=None, workers=8, exclude=(),
+             max_count=None, encoding='utf-8', blocksize=4 << 20,
+             ignore_errors=False):
+        """Searches the files under this directory for a regular
+        expression, yielding a (File, line number, line) tuple for each
+        line matching it, as grep -r does. Line numbers count from 1, and
+        lines are given without their line ending.
+
+        pattern may be a string or a compiled expression, matched against
+        each line on its own, with '^' and '$' at its start and end. If it is (or was compiled
+        from) bytes, the files are searched as bytes, and lines given as
+        bytes; otherwise they are decoded with encoding (undecodable bytes
+        replaced) and searched as text.
+
+        Only files whose name matches glob (a glob pattern, matched against
+        the path relative to this directory if it has a '/') are searched,
+        and directories whose name matches one of the glob patterns in
+        exclude are left out. Links are not followed. Files which look
+        binary (with a NUL byte in their first block) are skipped.
+
+        Files are searched on a pool of 'workers' threads, in blocks of
+        about blocksize bytes, and their matches yielded as soon as each is
+        done, in order within each file. At most max_count lines are given
+        per file.
+
+        Unless ignore_errors is True, the first error listing a directory
+        or reading a file is raised once all the others have been
+        searched."""
+        if isinstance(pattern, (str, bytes)):
+            pattern = re.compile(pattern)
+        decode = not isinstance(pattern.pattern, bytes)
+        regex = re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+        newline = '\n' if decode else b'\n'
+        if isinstance(exclude, str):
+            exclude = (exclude,)
+        match = None if glob is None else self._glob_matcher(glob)
+        root = str(self)
+
+        def prune(dirpath, entry):
+            return any(fnmatch.fnmatch(entry.name, e) for e in exclude)
+
+        errors = []
+        def files():
+            for dirpath, entry in _scan_tree(root, prune, errors.append):
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                except OSError:
+                    continue
+                if match is not None and not match(tuple(
+                        entry.path[len(root):].lstrip(os.sep).split(os.sep))):
+                    continue
+                yield entry.path
+
+        def search(path):
+            found = []
+            try:
+                with open(path, 'rb') as f:
+                    lineno = 0
+                    first = True
+                    while max_count is None or len(found) < max_count:
+                        block = f.read(blocksize)
+                        if not block:
+                            break
+                        if first and b'\0' in block:
+                            return path, found, None
+                        first = False
+                        if not block.endswith(b'\n'):
+                            # Search whole lines only
+                            block += f.readline()
+                        if decode:
+                            block = block.decode(encoding, 'replace')
+                        # The number of lines before pos
+                        pos = 0
+                        m = regex.search(block)
+                        while m is not None:
+                            if m.start() == len(block) and \
+                                    block.endswith(newline):
+                                # Past the newline ending the last line
+                                break
+                            # The line holding the start of the match,
+                            # searched again on its own in case the match
+                            # ran past its end
+                            start = block.rfind(newline, 0, m.start()) + 1
+                            end = block.find(newline, m.start())
+                            if end < 0:
+                                end = len(block)
+                            if m.end() <= end or \
+                                    regex.search(block, start, end):
+                                lineno += block.count(newline, pos, start)
+                                pos = start
+                                found.append((lineno + 1, block[start:end]))
+                                if max_count is not None and \
+                                        len(found) >= max_count:
+                                    break
+                            if end + 1 >= len(block):
+                                # That was the last line
+                                break
+                            m = regex.search(block, end + 1)
+                        lineno += block.count(newline, pos)
+            except (IOError, OSError) as exc:
+                return path, found, exc
+            return path, found, None
+
+        with _ThreadPool(workers) as pool:
+            for path, found, exc in _imap_unordered(pool, search, files()):
+                if exc is not None:
+                    errors.append(exc)
+                f = self._File(path)
+                for lineno, line in found:
+                    yield f, lineno, line
+        if errors and not ignore_errors:
+            raise errors[0]
+
+    def children(self, cache=None):
+        """Yields the paths of the entries in this directory.
+
+        cache may be a ListingCache, in which case the directory is only
+        listed again if it changed since it was last listed through it."""
+        if cache is not None:
+            for child, kind in cache.entries(self):
+                yield self + child
+            return
+        for child in os.listdir(str(self)):
             pchild = (self + child)
             yield pchild
         return
         
-    def walk(self, mode = 'fd'):
+    def walk_entries(self, mode = 'fd'):
+        """Yields a WalkEntry for each subdirectory and file in the path,
+        in the same order and with the same meaning of mode as walk.
+
+        No Path objects are made unless asked for, so scans which only look
+        at the names, types or stats of the entries and keep few of them
+        cost much less than with walk."""
+        dirs = 'd' in mode
+        files = 'f' in mode
+        skiplinks = 'L' in mode
+        links = 'l' in mode or skiplinks
+        other = 'o' in mode
+        follow = not links
+        # One (parent, iterator over its os.DirEntry list) per directory
+        with os.scandir(str(self)) as it:
+            stack = [(self, iter(list(it)))]
+        while stack:
+            parent, entries = stack[-1]
+            for entry in entries:
+                kind = _entry_kind(entry, followlinks=follow)
+                if kind is None:
+                    if other:
+                        yield WalkEntry(parent, entry, _OTHER, follow)
+                    continue
+                if kind == _DIR:
+                    child = WalkEntry(parent, entry, kind, follow)
+                    if dirs:
+                        yield child
+                    try:
+                        with os.scandir(entry.path) as it:
+                            stack.append((child, iter(list(it))))
+                    except OSError:
+                        continue
+                    break
+                elif kind == _FILE:
+                    if files:
+                        yield WalkEntry(parent, entry, kind, follow)
+                elif kind == _LINK:
+                    if links:
+                        yield WalkEntry(parent, entry, kind, follow)
+                else:
+                    yield WalkEntry(parent, entry, kind, follow)
+            else:
+                stack.pop()
+
+    def resumable_walk(self, mode = 'fd', resume_from=None):
+        """Returns a ResumableWalk over this directory: an iterator over the
+        same objects as walk, in sorted order, with a cursor() method for
+        picking up the walk again later (by passing its result as
+        resume_from)."""
+        return ResumableWalk(self, mode, resume_from)
+
+    def walk(self, mode = 'fd', cache=None, resume_from=None, tracer=None):
         """Yields subdirectories and files in the path.
         Objects are always yielded after their containing directory.
         
@@ -688,44 +2841,165 @@ class BaseDir(BasePath):
         'o': return unrecognized object as Path objects (otherwise skip)
 
         Special objects (block devices, etc.) are yielded as Path objects.
+
+        cache may be a ListingCache, used to list each directory. The
+        entry types it keeps save a stat() call on everything but links.
+
+        resume_from may be a cursor from a ResumableWalk (see
+        resumable_walk), in which case the walk goes on, in sorted order,
+        from where that one stopped.
+
+        tracer may be a WalkTracer, which is told how long listing and
+        stat()ing each directory took.
         """
+        if resume_from is not None:
+            for child in ResumableWalk(self, mode, resume_from):
+                yield child
+            return
         dirs = 'd' in mode
         files = 'f' in mode
         skiplinks = 'L' in mode
         links = 'l' in mode or skiplinks
         other = 'o' in mode
-        for child in self.children():
-            try:
-                s = child.stat(usecache=True, followlinks=not links)
-            except OSError:
-                if other:
+        if cache is None:
+            listing = ((child, None) for child in self.children())
+        else:
+            listing = ((self + name, kind)
+                       for name, kind in cache.entries(self))
+        trace = None
+        if tracer is not None:
+            start = time.perf_counter()
+            listing = list(listing)
+            trace = tracer._listed(self, start, len(listing))
+        try:
+            for child, kind in listing:
+                if kind is None or (kind == _LINK and not links):
+                    if trace is None:
+                        kind = _stat_kind(str(child), followlinks=not links)
+                    else:
+                        start = time.perf_counter()
+                        kind = _stat_kind(str(child), followlinks=not links)
+                        trace[3] += time.perf_counter() - start
+                if kind is None:
+                    if other:
+                        yield child
+                    continue
+                if kind == _DIR:
+                    child = self._Dir(child)
+                    if dirs:
+                        yield child
+                    for c in child.walk(mode, cache, tracer=tracer):
+                        yield c
+                elif kind == _FILE:
+                    if files:
+                        yield self._File(child)
+                    continue
+                elif kind == _LINK:
+                    if links:
+                        yield self._Link(child)
+                    continue
+                else:
+                    # what do you do if it isn't a file, link, or dir?
+                    # I think you yield it anyway, as a path
                     yield child
-                continue
-            if s.isdir:
-                child = self._Dir(child)
-                if dirs:
+        finally:
+            if trace is not None:
+                tracer._finished(trace)
+
+    def fwalk(self, mode = 'fd', maxfds=64):
+        """Yields subdirectories and files in the path, like walk, but
+        working through open directory descriptors.
+
+        Each directory is opened once, and listed and stat()ed through its
+        descriptor, so the kernel doesn't resolve the full path of every
+        entry, and renames higher up the tree don't disturb the walk.
+
+        The objects yielded keep the descriptor of their directory: their
+        stat() and (for files) open() go through it too. That only holds
+        while the walk keeps it open; once it is closed (when the walk
+        leaves their directory, or to keep within maxfds), they are used
+        by path, like any other.
+
+        At most maxfds descriptors are kept open. Deeper than that, those of
+        the outermost directories are closed, and opened again by path once
+        the walk gets back to them.
+        """
+        dirs = 'd' in mode
+        files = 'f' in mode
+        links = 'l' in mode or 'L' in mode
+        other = 'o' in mode
+        flags = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+
+        def listing(fd):
+            # Kinds are found while the descriptor is sure to be open
+            with os.scandir(fd) as it:
+                return iter([(e.name, _entry_kind(e, followlinks=not links))
+                             for e in it])
+
+        def close(frame):
+            # Closes the descriptor of frame, and stops the objects yielded
+            # from its directory from using it
+            os.close(frame[1])
+            frame[1] = None
+            frame[3][0] = None
+
+        # One [Dir, descriptor or None, listing, cell of the descriptor]
+        # frame per directory in the walk
+        stack = []
+        try:
+            fd = os.open(str(self), flags)
+            stack.append([self, fd, None, [fd]])
+            stack[-1][2] = listing(fd)
+            while stack:
+                frame = stack[-1]
+                if frame[1] is None:
+                    frame[1] = os.open(str(frame[0]), flags)
+                    frame[3] = [frame[1]]
+                d, fd, entries, cell = frame
+                name, kind = next(entries, (None, None))
+                if name is None:
+                    stack.pop()
+                    close(frame)
+                    continue
+                child = d + name
+                if kind is None:
+                    if other:
+                        yield child
+                    continue
+                if kind == _DIR:
+                    child = self._Dir(child)
+                elif kind == _FILE:
+                    child = self._File(child)
+                elif kind == _LINK:
+                    child = self._Link(child)
+                child._dirfd_cell = cell
+                if kind == _DIR:
+                    if dirs:
+                        yield child
+                    try:
+                        subfd = os.open(name, flags, dir_fd=fd)
+                    except OSError:
+                        continue
+                    stack.append([child, subfd, None, [subfd]])
+                    stack[-1][2] = listing(subfd)
+                    openfds = [f for f in stack[:-1] if f[1] is not None]
+                    for f in openfds[:max(0, len(openfds) + 1 - maxfds)]:
+                        close(f)
+                elif (kind == _FILE and files) or (kind == _LINK and links) \
+                        or kind == _OTHER:
+                    # Like walk, special objects are always yielded
                     yield child
-                for c in child.walk(mode):
-                    yield c
-            elif s.isfile:
-                if files:
-                    yield self._File(child)
-                continue
-            elif s.islink:
-                if links:
-                    yield self._Link(child)
-                continue
-            else:
-                # what do you do if it isn't a file, link, or dir?
-                # I think you yield it anyway, as a path
-                yield child
+        finally:
+            for frame in stack:
+                if frame[1] is not None:
+                    close(frame)
 
 class BaseLink(BasePath):
     def __init__(self, arg):
         return BasePath.__init__(self, arg)
 
     def __repr__(self):
-        return 'Link(%r)' % unicode(self)
+        return 'Link(%r)' % str(self)
     
     def _getnotend(self, tpl):
         """Allows subclasses to define what class is returned if the 
@@ -816,11 +3090,11 @@ class PosixPath(BasePath):
             uid = -1
         if gid is None:
             gid = -1
-        return os.chown(unicode(self), uid, gid)
+        return os.chown(str(self), uid, gid)
 
     def hardlink(self, newpath):
         """ Create a hard link at 'newpath', pointing to this file. """
-        os.link(unicode(self), unicode(newpath))
+        os.link(str(self), str(newpath))
 
 
 class PosixFile(PosixPath, BaseFile):
@@ -829,10 +3103,10 @@ class PosixFile(PosixPath, BaseFile):
     A File object is a Path object with extra methods specific
     to files, such as open()."""
     def mkfifo(self, *args):
-        return os.mkfifo(unicode(self), *args)
+        return os.mkfifo(str(self), *args)
 
     def mknod(self, *args):
-        return os.mknod(unicode(self), *args)
+        return os.mknod(str(self), *args)
 
 class PosixDir(PosixPath, BaseDir):
     pass
@@ -843,7 +3117,7 @@ class PosixLink(PosixPath, BaseLink):
         
         Normally returns a path relative to the link; use
         realpath = True to get a path to the main object"""
-        linkpath = self._Path(os.readlink(unicode(self)))
+        linkpath = self._Path(os.readlink(str(self)))
         if linkpath.isrel and realpath:
             return (self[:-1] + linkpath).realpath()
         else:
@@ -855,7 +3129,7 @@ class PosixLink(PosixPath, BaseLink):
             uid = -1
         if gid is None:
             gid = -1
-        return os.lchown(unicode(self), uid, gid)
+        return os.lchown(str(self), uid, gid)
 
     def writelink(self, src):
         """ Create a symbolic link at self, pointing to src.
@@ -864,7 +3138,7 @@ class PosixLink(PosixPath, BaseLink):
         relative path, it will be interpreted relative to self, not 
         relative to the current working directory.
         """
-        os.symlink(unicode(src), unicode(self))
+        os.symlink(str(src), str(self))
 
 PosixPath._Path = PosixPath
 PosixPath._Dir = PosixDir
@@ -898,14 +3172,14 @@ class _NTCurRootType(_NTBaseRoot):
 
     def abspath(self):
         from nt import _getfullpathname
-        return NTPath(_getfullpathname(unicode(self)))
+        return NTPath(_getfullpathname(str(self)))
 
 class NTDrive(_NTBaseRoot):
     """ Represents the root of a specific drive. """
     def __init__(self, letter):
         # Drive letter is normalized - we don't lose any information
-        letter = unicode(letter)
-        allletters = unicode(string.ascii_letters, 'ascii')
+        letter = str(letter)
+        allletters = string.ascii_letters
             # I think you can only use ASCII letters for drive names
         if len(letter) != 1 or not letter.isalpha():
             raise ValueError('Should get one letter')
@@ -947,7 +3221,7 @@ class NTUnrootedDrive(_NTBaseRoot):
 
     def abspath(self):
         from nt import _getfullpathname
-        return NTPath(_getfullpathname(unicode(self)))
+        return NTPath(_getfullpathname(str(self)))
 
 class NTUNCRoot(_NTBaseRoot):
     """ Represents a UNC mount point. """
@@ -1065,15 +3339,15 @@ class NTPath(BasePath):
     # --- Extra
 
     def startfile(self):
-        return os.startfile(unicode(self))
+        return os.startfile(str(self))
 
     def touch(self):
         """ Set the access/modified times of this file to the current time.
         Create the file if it does not exist.
         """
-        fd = os.open(unicode(self), os.O_WRONLY | os.O_CREAT)
+        fd = os.open(str(self), os.O_WRONLY | os.O_CREAT)
         os.close(fd)
-        os.utime(unicode(self), None)
+        os.utime(str(self), None)
     
 
 class NTFile(NTPath, BaseFile):
@@ -1102,4 +3376,1904 @@ else:
     raise NotImplementedError(
           "The path object is currently not implemented for OS %r" % os.name)
 
-__all__ = ('Path','File','Dir','Link','Stats')
+
+class RealpathCache(object):
+    """A cache of canonical (symlink-free) directory paths.
+
+    Pass one to Path.realpath, relpathto or relpathto_many to have each
+    directory prefix resolved once and shared by every path under it, instead
+    of resolving every link along every path again.
+
+    Cached resolutions are never revalidated; call invalidate() after
+    changing links in the cached directories. At most maxsize prefixes are
+    kept, and the least recently used are evicted first.
+    """
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def invalidate(self, path=None):
+        """Forgets the resolution of path and of every path below it, or
+        resolved to it or below it (through links elsewhere), or all
+        resolutions if path is None."""
+        if path is None:
+            self._cache.clear()
+            return
+        prefix = tuple(Path(path).abspath())
+        n = len(prefix)
+        for key in [k for k, v in self._cache.items()
+                    if k[:n] == prefix or v[:n] == prefix]:
+            del self._cache[key]
+
+    def resolve(self, path):
+        """Returns the canonical path to path, as path.realpath() would."""
+        cls = path.__class__ if isinstance(path, BasePath) else Path
+        elems = tuple(cls(path).abspath())
+        if len(elems) < 2:
+            return cls(elems)
+        # Only directories are cached, so that the cache isn't filled up
+        # with the files in them.
+        parent = self._resolve_dir(cls, elems[:-1])
+        return cls(self._step(cls, parent, elems[-1]))
+
+    def _resolve_dir(self, cls, elems):
+        cache = self._cache
+        resolved = None
+        i = len(elems)
+        while i > 1:
+            resolved = cache.get(elems[:i])
+            if resolved is not None:
+                cache.move_to_end(elems[:i])
+                break
+            i -= 1
+        if resolved is None:
+            # Nothing cached: start from the root
+            resolved = elems[:1]
+        for j in range(i, len(elems)):
+            resolved = self._step(cls, resolved, elems[j])
+            cache[elems[:j + 1]] = resolved
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+        return resolved
+
+    @staticmethod
+    def _step(cls, resolved, name):
+        # Returns the canonical form of resolved + name, given that resolved
+        # is already canonical.
+        if name == cls._pardir:
+            return resolved[:-1] if len(resolved) > 1 else resolved
+        elems = resolved + (name,)
+        pathstr = str(cls(elems))
+        try:
+            if not stat.S_ISLNK(os.lstat(pathstr).st_mode):
+                return elems
+        except OSError:
+            # Like os.path.realpath, missing paths are taken as they are.
+            return elems
+        return tuple(cls(os.path.realpath(pathstr)))
+
+
+class ListingCache(object):
+    """A cache of directory listings.
+
+    Pass one to Dir.children or Dir.walk to have directories listed only
+    when they changed. Each cached listing is revalidated with a single
+    stat() of its directory, comparing modification and change times, so
+    changes made within the timestamp granularity of the filesystem may go
+    unnoticed; use invalidate() when that matters.
+
+    Along with each name, the type of the entry reported by the listing is
+    kept (links not followed), sparing a stat() later on. At most maxsize
+    listings are kept, and the least recently used are evicted first.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def entries(self, path):
+        """Returns a list of (name, kind) pairs for the directory at path.
+
+        kind is one of 'd', 'f', 'l' or 'o' (for directories, files, links
+        and anything else), or None if the entry vanished while listing."""
+        key = str(path)
+        st = os.stat(key)
+        stamp = (st.st_mtime_ns, st.st_ctime_ns)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        # A change between the stat() above and the listing only makes the
+        # listing newer than its stamp, so it is just read again next time.
+        with os.scandir(key) as it:
+            entries = [(e.name, _entry_kind(e, followlinks=False)) for e in it]
+        self._cache[key] = (stamp, entries)
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return entries
+
+    def names(self, path):
+        """Returns a list of the names in the directory at path."""
+        return [name for name, kind in self.entries(path)]
+
+    def invalidate(self, path=None, recursive=False):
+        """Forgets the listing of the directory at path (and of all
+        directories below it, if recursive), or all listings if path is
+        None."""
+        if path is None:
+            self._cache.clear()
+            return
+        key = str(path)
+        self._cache.pop(key, None)
+        if recursive:
+            prefix = key.rstrip(os.sep) + os.sep
+            for k in [k for k in self._cache if k.startswith(prefix)]:
+                del self._cache[k]
+
+
+class WalkEntry(object):
+    """An entry yielded by Dir.walk_entries: the name, type and (on
+    demand) stats of something found by the walk, without its Path.
+
+    The Path (a Dir, File, Link or, for special objects, Path) is only
+    made when asked for, through path, or by using the entry as one:
+    indexing it, joining to it, or turning it into a string. Entries
+    compare and hash as their paths do.
+
+    stats come from the directory listing's os.DirEntry, which caches them:
+    the first access makes a stat() call (lstat() if the walk doesn't
+    follow links), and later ones none."""
+    __slots__ = ('_parent', '_entry', 'kind', '_follow', '_path')
+
+    def __init__(self, parent, entry, kind, follow=True):
+        # parent is the Dir or WalkEntry of the directory holding entry, an
+        # os.DirEntry
+        self._parent = parent
+        self._entry = entry
+        self.kind = kind
+        self._follow = follow
+        self._path = None
+
+    @property
+    def name(self):
+        return self._entry.name
+
+    @property
+    def extension(self):
+        return ''.join(self._entry.name.rsplit('.', 1)[1:])
+
+    @property
+    def isdir(self):
+        return self.kind == _DIR
+
+    @property
+    def isfile(self):
+        return self.kind == _FILE
+
+    @property
+    def islink(self):
+        return self.kind == _LINK
+
+    @property
+    def stats(self):
+        """A Stats object of the entry."""
+        return Stats._from_stat(self, self._entry.stat(
+            follow_symlinks=self._follow), self._follow)
+
+    @property
+    def parent(self):
+        """The Dir holding the entry."""
+        parent = self._parent
+        return parent.path if isinstance(parent, WalkEntry) else parent
+
+    @property
+    def path(self):
+        """The Path of the entry, made on first use."""
+        if self._path is None:
+            parent = self.parent
+            cls = {_DIR: parent._Dir, _FILE: parent._File,
+                   _LINK: parent._Link}.get(self.kind, parent._Path)
+            self._path = cls(parent + self._entry.name)
+        return self._path
+
+    def __str__(self):
+        return self._entry.path
+
+    def __fspath__(self):
+        return self._entry.path
+
+    def __repr__(self):
+        return 'WalkEntry(%r)' % self._entry.path
+
+    def __getitem__(self, key):
+        return self.path[key]
+
+    def __len__(self):
+        return len(self.path)
+
+    def __iter__(self):
+        return iter(self.path)
+
+    def __add__(self, other):
+        return self.path + other
+
+    def __eq__(self, other):
+        if isinstance(other, WalkEntry):
+            other = other.path
+        return self.path == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class LineIndex(object):
+    """The offsets of every 'every'th line of a file (starting with line 0,
+    at offset 0), as built by File.line_index.
+
+    lines is the number of lines in the file (a last line with no newline
+    counts), size its size when the index was built."""
+    _header = struct.Struct('<4sQQqQ')
+    _magic = b'FLI\x01'
+
+    def __init__(self, every, offsets, lines, size, mtime_ns=0):
+        self.every = every
+        self.offsets = offsets
+        self.lines = lines
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    def __repr__(self):
+        return 'LineIndex(every=%d, lines=%d, size=%d)' % (
+            self.every, self.lines, self.size)
+
+    @classmethod
+    def build(cls, f, every=1024, use_mmap=False, blocksize=1 << 20):
+        """Builds the index of the binary file object f, reading it in
+        blocks from its start, or through a memory map."""
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        offsets = array.array('Q', [0])
+        if use_mmap:
+            size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if size else b''
+            blocks = (data[pos:pos + blocksize]
+                      for pos in range(0, size, blocksize))
+        else:
+            data = None
+            blocks = iter(lambda: f.read(blocksize), b'')
+        # The number of newlines, and bytes, before the block
+        newlines = base = 0
+        last = b''
+        try:
+            for block in blocks:
+                parts = block.split(b'\n')
+                n = len(parts) - 1
+                # The newlines which end line every-1, 2*every-1, etc.
+                first = (-(newlines + 1)) % every
+                if first < n:
+                    # Each ends at the bytes of the parts before it, plus
+                    # one per newline
+                    ends = itertools.islice(itertools.accumulate(
+                        map(len, parts)), first, n, every)
+                    offsets.extend(map(operator.add, ends,
+                                       itertools.count(base + first + 1, every)))
+                newlines += n
+                base += len(block)
+                last = block[-1:]
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        lines = newlines + (1 if last and last != b'\n' else 0)
+        if offsets[-1] == base and len(offsets) > 1:
+            # The offset of the end of the file is no line's start
+            offsets.pop()
+        return cls(every, offsets, lines, base)
+
+    def seek(self, line):
+        """Returns (offset, skip): the offset to read from to get to line
+        number 'line', and the number of lines to skip from there."""
+        if not 0 <= line <= self.lines:
+            raise IndexError("line %d out of range" % line)
+        sample = min(line // self.every, len(self.offsets) - 1)
+        return self.offsets[sample], line - sample * self.every
+
+    def ranges(self, parts):
+        """Splits the lines into at most 'parts' ranges of about as many
+        lines, as (start, stop) pairs that can be handed to workers to
+        read with File.read_lines. Ranges start at indexed lines, so no
+        worker has to skip any."""
+        samples = len(self.offsets)
+        parts = max(1, min(parts, samples))
+        bounds = [self.every * (samples * i // parts) for i in range(parts)]
+        bounds.append(self.lines)
+        return [(start, stop) for start, stop in zip(bounds, bounds[1:])
+                if start < stop]
+
+    def dump(self, f):
+        """Writes the index to the binary file object f."""
+        offsets = self.offsets
+        if sys.byteorder != 'little':
+            offsets = array.array('Q', offsets)
+            offsets.byteswap()
+        f.write(self._header.pack(self._magic, self.size, self.mtime_ns,
+                                  self.every, self.lines))
+        f.write(offsets.tobytes())
+
+    @classmethod
+    def load(cls, f):
+        """Reads an index written by dump from the binary file object f."""
+        header = f.read(cls._header.size)
+        if len(header) != cls._header.size:
+            raise ValueError("Truncated line index")
+        magic, size, mtime_ns, every, lines = cls._header.unpack(header)
+        if magic != cls._magic:
+            raise ValueError("Not a line index")
+        offsets = array.array('Q')
+        data = f.read()
+        if len(data) % offsets.itemsize:
+            raise ValueError("Truncated line index")
+        offsets.frombytes(data)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        return cls(every, offsets, lines, size, mtime_ns)
+
+
+class BatchWriter(object):
+    """Writes many files below a directory and publishes them together, so
+    that making them durable costs little more for many files than for one.
+
+    Each file is written to a temporary name next to where it goes (or,
+    if its directory doesn't exist yet, in the nearest one above it that
+    does), with its space allocated up front. On commit(), the files still
+    open are fsync()ed on a pool of 'workers' threads (while writing goes
+    on, batches of them are already fsync()ed and closed in the
+    background, to keep at most max_open open), then the missing
+    directories are made, all files are renamed into place, and each
+    directory they went to is fsync()ed, once. A crash before commit()
+    returns leaves each file either as it was, or complete.
+
+    With durable = False, nothing is fsync()ed; files are still published
+    by atomic renames on commit().
+
+    Used as a context manager, the batch is committed at the end of the
+    with block, or aborted (the temporary files, and the directories made
+    for them which are still empty, removed) on an error.
+
+    Temporary files are named after the process writing them. With sweep
+    True, those left below root by processes which are gone (a writer
+    which crashed) are removed when the BatchWriter is made, which walks
+    root; on POSIX only."""
+    max_open = 256
+
+    # Matches the names of temporary files, capturing the writer's pid
+    _tmp_pattern = re.compile(r'^\..*\.fpath-tmp-(\d+)-\d+$')
+
+    def __init__(self, root, workers=8, durable=True, sweep=True):
+        self.root = Dir(root)
+        self.durable = durable
+        self.workers = workers
+        self._pool = _ThreadPool(workers)
+        self._reset()
+        if sweep and os.name == 'posix' and os.path.isdir(str(root)):
+            self.sweep()
+
+    def sweep(self):
+        """Removes the temporary files below root left by writers in
+        processes which are gone, and returns how many there were."""
+        dead = {}
+        removed = 0
+        for dirpath, entry in _scan_tree(str(self.root)):
+            match = self._tmp_pattern.match(entry.name)
+            if match is None:
+                continue
+            pid = int(match.group(1))
+            if pid not in dead:
+                dead[pid] = not self._alive(pid)
+            if dead[pid]:
+                try:
+                    os.unlink(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    @staticmethod
+    def _alive(pid):
+        # Whether the process pid exists (POSIX only: on Windows, os.kill
+        # would terminate it)
+        try:
+            os.kill(pid, 0)
+        except OSError as exc:
+            return exc.errno != errno.ESRCH
+        return True
+
+    def _reset(self):
+        # (temporary name, final name) pairs, in the order written
+        self._renames = []
+        # Descriptors of written files, not yet fsync()ed
+        self._open = []
+        # Futures of fsync()ing batches of them
+        self._syncing = []
+        # Directories which files or new directories go into
+        self._dirs = set()
+        # Directories made by commit(), parents first
+        self._made = []
+        self._count = 0
+
+    def __len__(self):
+        """The number of files written and not yet committed."""
+        return len(self._renames)
+
+    def _makedirs(self, dirpath):
+        # Makes dirpath and its missing parents, noting those made and the
+        # directories which then need to be fsync()ed
+        if os.path.isdir(dirpath):
+            return
+        parent = os.path.dirname(dirpath)
+        if parent and parent != dirpath:
+            self._makedirs(parent)
+        try:
+            os.mkdir(dirpath)
+            self._made.append(dirpath)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        self._dirs.add(parent or os.curdir)
+
+    def write(self, name, data, mode=0o666):
+        """Writes data (bytes, or a string, encoded as UTF-8) as the file
+        name, a path relative to the root, which is published on commit(),
+        along with the directories missing. Returns the File it will be."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        target = self.root + name
+        path = str(target)
+        dirpath = os.path.dirname(path)
+        # The temporary file goes where it can be renamed from once its
+        # directory is made: on the same filesystem
+        tmpdir = dirpath
+        while tmpdir and not os.path.isdir(tmpdir):
+            parent = os.path.dirname(tmpdir)
+            if parent == tmpdir:
+                break
+            tmpdir = parent
+        self._count += 1
+        tmp = os.path.join(tmpdir, '.%s.fpath-tmp-%d-%d' % (
+            os.path.basename(path), os.getpid(), self._count))
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        self._renames.append((tmp, path))
+        try:
+            if data and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, len(data))
+                except OSError as exc:
+                    if exc.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        except BaseException:
+            os.close(fd)
+            raise
+        self._dirs.add(dirpath or os.curdir)
+        if self.durable:
+            self._open.append(fd)
+            if len(self._open) >= self.max_open:
+                self._syncing.append(self._pool.submit(self._sync, self._open))
+                self._open = []
+        else:
+            os.close(fd)
+        return self.root._File(target)
+
+    @staticmethod
+    def _sync(fds):
+        # fsync()s and closes fds, raising the first error once all are closed
+        error = None
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            except OSError as exc:
+                error = error or exc
+            finally:
+                os.close(fd)
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _sync_dir(dirpath):
+        fd = os.open(dirpath, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _wait(self, futures):
+        # Waits for all futures, then raises the first error of any
+        errors = [f.exception() for f in futures]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise errors[0]
+
+    def commit(self):
+        """Makes the files written durable and publishes them, then starts
+        a new batch. Returns the number of files published."""
+        try:
+            if self.durable:
+                fds, self._open = self._open, []
+                self._syncing.extend(
+                    self._pool.submit(self._sync, fds[i::self.workers])
+                    for i in range(min(self.workers, len(fds))))
+                syncing, self._syncing = self._syncing, []
+                self._wait(syncing)
+            renames = self._renames
+            for dirpath in sorted(set(os.path.dirname(path)
+                                      for tmp, path in renames)):
+                self._makedirs(dirpath)
+            for n, (tmp, path) in enumerate(renames):
+                os.replace(tmp, path)
+                # Only what is left is to be removed on an error
+                self._renames = renames[n + 1:]
+            if self.durable:
+                self._wait([self._pool.submit(self._sync_dir, d)
+                            for d in self._dirs])
+        except BaseException:
+            self.abort()
+            raise
+        self._reset()
+        return len(renames)
+
+    def abort(self):
+        """Throws away the files written and not yet committed."""
+        for fd in self._open:
+            os.close(fd)
+        for future in self._syncing:
+            future.exception()
+        for tmp, path in self._renames:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+        for dirpath in reversed(self._made):
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                # Not empty: something was published in it
+                pass
+        self._reset()
+
+    def close(self):
+        """Aborts what wasn't committed, and stops the pool of threads."""
+        self.abort()
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.close()
+
+
+class WalkTracer(object):
+    """Records how long a walk spent on each directory, to find the ones
+    that stall it: those with huge listings, or on slow mounts.
+
+    Pass one to Dir.walk as tracer. For each directory listed, it keeps
+    the time taken to list it, the time taken to stat() its entries (where
+    the walk needs to), and the number of entries. It can then report a
+    histogram of those latencies and the slowest directories, or export a
+    Chrome trace (for chrome://tracing or Perfetto), in which each
+    directory spans the time until the walk left it, nesting its
+    subdirectories."""
+
+    # Upper bounds of the histogram buckets, in seconds
+    buckets = (1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0, float('inf'))
+
+    def __init__(self):
+        # [path, start, list seconds, stat seconds, entries, end, thread]
+        self._traces = []
+        self._origin = time.perf_counter()
+
+    def _listed(self, path, start, entries):
+        now = time.perf_counter()
+        trace = [path, start, now - start, 0.0, entries, None,
+                 threading.current_thread().ident]
+        self._traces.append(trace)
+        return trace
+
+    def _finished(self, trace):
+        trace[5] = time.perf_counter()
+
+    def __len__(self):
+        return len(self._traces)
+
+    def dirs(self):
+        """Returns a DirTrace(path, list_seconds, stat_seconds, entries)
+        for each directory listed, in the order they were listed."""
+        return [DirTrace(t[0], t[2], t[3], t[4]) for t in self._traces]
+
+    def histogram(self):
+        """Returns a list of (bound, count) pairs: the number of
+        directories which took up to bound seconds to list and stat(), but
+        more than the bound before, for each bound in buckets."""
+        counts = [0] * len(self.buckets)
+        for t in self._traces:
+            counts[bisect.bisect_left(self.buckets, t[2] + t[3])] += 1
+        return list(zip(self.buckets, counts))
+
+    def slowest(self, n=10):
+        """Returns the DirTraces of the n directories which took longest to
+        list and stat(), slowest first."""
+        return sorted(self.dirs(), key=lambda d: d.list_seconds +
+                      d.stat_seconds, reverse=True)[:n]
+
+    def report(self, n=10):
+        """Returns a text report of the histogram and the n slowest
+        directories."""
+        dirs = self.dirs()
+        lines = ['%d directories, %d entries, %.3f s listing, %.3f s stat' % (
+            len(dirs), sum(d.entries for d in dirs),
+            sum(d.list_seconds for d in dirs),
+            sum(d.stat_seconds for d in dirs)), 'latency      directories']
+        for bound, count in self.histogram():
+            label = '> %g s' % self.buckets[-2] if bound == float('inf') \
+                else '<= %g s' % bound
+            lines.append('%-12s %d' % (label, count))
+        lines.append('slowest:')
+        for d in self.slowest(n):
+            lines.append('%10.3f ms list %10.3f ms stat %9d entries  %s' % (
+                d.list_seconds * 1e3, d.stat_seconds * 1e3, d.entries,
+                str(d.path)))
+        return '\n'.join(lines)
+
+    def chrome_trace(self, fileobj=None):
+        """Returns the traces as a Chrome trace-event JSON object, or
+        writes it as JSON to fileobj if given.
+
+        Each directory is a complete event lasting until the walk left it
+        (including the time spent by whoever consumed the walk), holding a
+        'list' event for its listing."""
+        events = []
+        for path, start, listing, stats, entries, end, tid in self._traces:
+            ts = (start - self._origin) * 1e6
+            if end is None:
+                end = start + listing + stats
+            events.append({'name': str(path), 'cat': 'dir', 'ph': 'X',
+                           'ts': ts, 'dur': (end - start) * 1e6,
+                           'pid': os.getpid(), 'tid': tid,
+                           'args': {'entries': entries,
+                                    'list_ms': listing * 1e3,
+                                    'stat_ms': stats * 1e3}})
+            events.append({'name': 'list', 'cat': 'list', 'ph': 'X',
+                           'ts': ts, 'dur': listing * 1e6,
+                           'pid': os.getpid(), 'tid': tid})
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if fileobj is None:
+            return trace
+        json.dump(trace, fileobj)
+
+
+class ResumableWalk(object):
+    """An iterator over the same objects as Dir.walk, in sorted order, that
+    can be stopped and picked up again later, even in another process.
+
+    cursor() returns a small dict (of strings and lists, so it can be
+    serialised with json or pickle) recording the last object yielded and
+    the directories being walked. Passing it as resume_from to a new
+    ResumableWalk, or to Dir.walk, carries on right after that object,
+    with nothing yielded twice or skipped, provided the tree hasn't changed
+    in between.
+    """
+    _version = 1
+
+    def __init__(self, root, mode='fd', resume_from=None):
+        self.root = Dir(root)
+        self.mode = mode
+        # One [relative path, last name handled, sorted names or None,
+        # index of the next name] frame per directory being walked
+        if resume_from is None:
+            self._last = None
+            self._stack = [[(), None, None, 0]]
+        else:
+            cursor = resume_from
+            if cursor.get('version') != self._version:
+                raise ValueError("Unknown cursor version: %r"
+                                 % cursor.get('version'))
+            if Dir(cursor['root']) != self.root or cursor['mode'] != mode:
+                raise ValueError("The cursor is for a walk of %r in mode %r"
+                                 % (cursor['root'], cursor['mode']))
+            self._last = cursor['last']
+            self._stack = [[tuple(rel), last, None, 0]
+                           for rel, last in cursor['stack']]
+        self._walk = self._generate()
+
+    def cursor(self):
+        """Returns a cursor for resuming the walk after the last object it
+        yielded."""
+        return {'version': self._version, 'root': str(self.root),
+                'mode': self.mode, 'last': self._last,
+                'stack': [[list(frame[0]), frame[1]] for frame in self._stack]}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._walk)
+    next = __next__
+
+    def _generate(self):
+        dirs = 'd' in self.mode
+        files = 'f' in self.mode
+        links = 'l' in self.mode or 'L' in self.mode
+        other = 'o' in self.mode
+        stack = self._stack
+        root = self.root
+        while stack:
+            frame = stack[-1]
+            rel, last, names, i = frame
+            d = root._Dir(root + rel) if rel else root
+            if names is None:
+                names = frame[2] = sorted(os.listdir(str(d)))
+                if last is not None:
+                    i = frame[3] = bisect.bisect_right(names, last)
+            if i >= len(names):
+                stack.pop()
+                continue
+            name = frame[1] = names[i]
+            frame[3] = i + 1
+            child = d + name
+            kind = _stat_kind(str(child), followlinks=not links)
+            if kind == _DIR:
+                # Pushed before yielding, so that a cursor taken right after
+                # the directory still leads into it.
+                stack.append([rel + (name,), None, None, 0])
+                if dirs:
+                    self._last = list(rel + (name,))
+                    yield root._Dir(child)
+                continue
+            if kind is None:
+                if not other:
+                    continue
+            elif kind == _FILE:
+                if not files:
+                    continue
+                child = root._File(child)
+            elif kind == _LINK:
+                if not links:
+                    continue
+                child = root._Link(child)
+            # Like walk, special objects are always yielded
+            self._last = list(rel + (name,))
+            yield child
+
+
+# The compact binary format of PathWriter and PathReader: a header, then one
+# record per path, made of a tag byte (the low two bits for the type, see
+# _codec_types, and _CODEC_ROOTED if the first element is a root), the number
+# of leading elements shared with the previous path, the number of elements
+# that follow, and those elements, each as its length and UTF-8 bytes. Numbers
+# are unsigned LEB128 varints.
+_CODEC_HEADER = b'FPC\x01'
+_CODEC_ROOTED = 0x04
+
+def _codec_types():
+    # The types in tag order; subclasses are tagged as their base type
+    return (Path, File, Dir, Link)
+
+def _encode_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _decode_varint(buf, i):
+    # Returns the number starting at buf[i], and the index after it; raises
+    # IndexError if buf ends first
+    value = shift = 0
+    while True:
+        byte = buf[i]
+        i += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, i
+
+class PathWriter(object):
+    """Writes paths to a binary stream in a compact format, for sending
+    many of them to another process (through a pipe, socket, file, shared
+    memory...) to be read with PathReader.
+
+    Each path is stored as the number of leading elements it shares with
+    the previous one, followed by the rest of its elements, so sorted
+    paths, or paths from a walk, take a few bytes each. Whether each path
+    is a Path, File, Dir or Link is kept as well.
+    """
+    _buffer_size = 1 << 16
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._prev = ()
+        self._prevtag = 0
+        self._tags = {}
+        self._out = bytearray(_CODEC_HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def _encode(self, path):
+        cls = type(path)
+        tag = self._tags.get(cls)
+        if tag is None:
+            tag = 0
+            for i, base in enumerate(_codec_types()):
+                if issubclass(cls, base):
+                    tag = i
+            self._tags[cls] = tag
+        elements = tuple(path)
+        if elements and not isinstance(elements[0], str):
+            tag |= _CODEC_ROOTED
+            elements = (str(elements[0]),) + elements[1:]
+        prev = self._prev
+        shared = 0
+        limit = min(len(prev), len(elements))
+        while shared < limit and prev[shared] == elements[shared]:
+            shared += 1
+        if (tag ^ self._prevtag) & _CODEC_ROOTED:
+            shared = 0
+        out = self._out
+        count = len(elements) - shared
+        if shared < 0x80 and count < 0x80:
+            out += bytes((tag, shared, count))
+        else:
+            out.append(tag)
+            _encode_varint(out, shared)
+            _encode_varint(out, count)
+        for element in elements[shared:]:
+            data = element.encode('utf-8', 'surrogateescape')
+            if len(data) < 0x80:
+                out.append(len(data))
+            else:
+                _encode_varint(out, len(data))
+            out += data
+        self._prev = elements
+        self._prevtag = tag
+
+    def write(self, path):
+        """Writes one path (which must be a Path object)."""
+        self._encode(path)
+        if len(self._out) >= self._buffer_size:
+            self.flush()
+
+    def write_many(self, paths):
+        for path in paths:
+            self.write(path)
+
+    def flush(self):
+        """Writes out what is buffered, and flushes fileobj."""
+        if self._out:
+            self.fileobj.write(bytes(self._out))
+            del self._out[:]
+        if hasattr(self.fileobj, 'flush'):
+            self.fileobj.flush()
+
+
+class _PathDecoder(object):
+    """Decodes the records written by PathWriter, as they come in."""
+    def __init__(self):
+        self._buf = b''
+        self._header = False
+        self._prev = ()
+        self._types = _codec_types()
+        self._roots = {}
+
+    def feed(self, data):
+        """Returns a list of the paths completed by data."""
+        buf = self._buf + bytes(data)
+        if not self._header:
+            if len(buf) < len(_CODEC_HEADER):
+                self._buf = buf
+                return []
+            if buf[:len(_CODEC_HEADER)] != _CODEC_HEADER:
+                raise ValueError("Not a stream of paths")
+            buf = buf[len(_CODEC_HEADER):]
+            self._header = True
+        paths = []
+        pos = 0
+        end = len(buf)
+        prev = self._prev
+        types = self._types
+        while pos < end:
+            # Parse one record, giving up if it isn't complete yet
+            try:
+                tag = buf[pos]
+                shared = buf[pos + 1]
+                count = buf[pos + 2]
+                i = pos + 3
+                if shared >= 0x80 or count >= 0x80:
+                    shared, i = _decode_varint(buf, pos + 1)
+                    count, i = _decode_varint(buf, i)
+                elements = list(prev[:shared])
+                for n in range(count):
+                    length = buf[i]
+                    if length < 0x80:
+                        i += 1
+                    else:
+                        length, i = _decode_varint(buf, i)
+                    if i + length > end:
+                        raise IndexError
+                    elements.append(buf[i:i + length].decode('utf-8',
+                                                             'surrogateescape'))
+                    i += length
+            except IndexError:
+                break
+            pos = i
+            cls = types[tag & 0x03]
+            if tag & _CODEC_ROOTED and not shared:
+                # The root is kept in prev, for the paths sharing it
+                root = self._roots.get(elements[0])
+                if root is None:
+                    root = self._roots[elements[0]] = cls(elements[0])[0]
+                elements[0] = root
+            prev = elements
+            paths.append(cls._from_elements(elements))
+        self._prev = prev
+        self._buf = buf[pos:]
+        return paths
+
+    def close(self):
+        if self._buf:
+            raise ValueError("Truncated stream of paths")
+
+
+class PathReader(object):
+    """Iterates over the paths written to a binary stream by PathWriter,
+    reading it in chunks as it goes."""
+    _chunk_size = 1 << 16
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __iter__(self):
+        decoder = _PathDecoder()
+        while True:
+            chunk = self.fileobj.read(self._chunk_size)
+            if not chunk:
+                break
+            for path in decoder.feed(chunk):
+                yield path
+        decoder.close()
+
+def encode_paths(paths):
+    """Returns the paths encoded as bytes, as PathWriter writes them."""
+    out = io.BytesIO()
+    with PathWriter(out) as writer:
+        writer.write_many(paths)
+    return out.getvalue()
+
+def decode_paths(data):
+    """Returns a list of the paths encoded in data (bytes, or any buffer,
+    such as a memoryview of shared memory) by encode_paths."""
+    decoder = _PathDecoder()
+    paths = decoder.feed(data)
+    decoder.close()
+    return paths
+
+
+class FileIndex(object):
+    """An inventory of directory trees, kept in an SQLite database.
+
+    For each file, directory and link below the indexed roots, it keeps
+    the path, parent directory, name, extension, type ('d', 'f', 'l' or
+    'o'), size, modification time (in ns), owner and inode, indexed for
+    quick queries with query(). Make one with Dir.build_index, or open an
+    existing database with FileIndex(db_path).
+
+    refresh() brings the index up to date, listing again only the
+    directories whose modification time changed. Note that this time only
+    changes when entries are added, removed or renamed; files modified in
+    place keep their old size and time until their directory is rescanned
+    (or refresh(full=True) is used).
+    """
+    _schema = """
+        CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY,
+                                         mtime_ns INTEGER);
+        CREATE TABLE IF NOT EXISTS entries (
+            path TEXT PRIMARY KEY, parent TEXT NOT NULL, name TEXT NOT NULL,
+            ext TEXT NOT NULL, type TEXT NOT NULL, size INTEGER,
+            mtime_ns INTEGER, uid INTEGER, gid INTEGER, ino INTEGER);
+        CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+        CREATE INDEX IF NOT EXISTS entries_ext ON entries (ext, size);
+        CREATE INDEX IF NOT EXISTS entries_size ON entries (size);
+        CREATE INDEX IF NOT EXISTS entries_mtime ON entries (mtime_ns);
+        """
+    _orders = ('path', 'name', 'size', 'mtime_ns')
+
+    def __init__(self, db_path):
+        if sqlite3 is None:
+            raise ImportError("FileIndex needs the sqlite3 module")
+        self.db_path = str(db_path)
+        self._db = sqlite3.connect(self.db_path)
+        self._db.executescript(self._schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def add_root(self, path):
+        """Adds the directory at path to the trees indexed; it is scanned on
+        the next refresh()."""
+        self._db.execute('INSERT OR IGNORE INTO roots VALUES (?)',
+                         (str(Path(path).abspath()),))
+        self._db.commit()
+
+    @staticmethod
+    def _below(pathstr):
+        # The range of path strings strictly below pathstr
+        lo = pathstr.rstrip(os.sep) + os.sep
+        return lo, lo[:-1] + chr(ord(os.sep) + 1)
+
+    def _forget(self, pathstr):
+        # Drops everything known about pathstr and below
+        lo, hi = self._below(pathstr)
+        for table in ('entries', 'dirs'):
+            self._db.execute('DELETE FROM %s WHERE path = ? OR '
+                             '(path >= ? AND path < ?)' % table,
+                             (pathstr, lo, hi))
+
+    @staticmethod
+    def _listing(dirpath):
+        # One entries row for everything in dirpath
+        rows = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                name = entry.name
+                rows.append((entry.path, dirpath, name,
+                             ''.join(name.rsplit('.', 1)[1:]),
+                             _mode_kind(st.st_mode), st.st_size,
+                             st.st_mtime_ns, st.st_uid, st.st_gid,
+                             st.st_ino))
+        return rows
+
+    def refresh(self, full=False):
+        """Brings the index up to date, and returns the number of
+        directories listed.
+
+        Every indexed directory is stat()ed, but only those whose
+        modification time changed (or all of them, if full is True) are
+        listed again."""
+        db = self._db
+        listed = 0
+        stack = [row[0] for row in db.execute('SELECT path FROM roots')]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                mtime_ns = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                self._forget(dirpath)
+                continue
+            known = db.execute('SELECT mtime_ns FROM dirs WHERE path = ?',
+                               (dirpath,)).fetchone()
+            if not full and known is not None and known[0] == mtime_ns:
+                stack.extend(row[0] for row in db.execute(
+                    "SELECT path FROM entries WHERE parent = ? AND type = 'd'",
+                    (dirpath,)))
+                continue
+            try:
+                rows = self._listing(dirpath)
+            except OSError:
+                self._forget(dirpath)
+                continue
+            listed += 1
+            kinds = dict((row[0], row[4]) for row in rows)
+            for path, kind in db.execute('SELECT path, type FROM entries '
+                                         'WHERE parent = ?', (dirpath,)).fetchall():
+                if kinds.get(path) != kind:
+                    # Gone, or replaced by something else
+                    self._forget(path)
+            db.executemany('INSERT OR REPLACE INTO entries '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            # A change during the listing leaves an older time here, so
+            # the directory is just listed again next time.
+            db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                       (dirpath, mtime_ns))
+            stack.extend(row[0] for row in rows if row[4] == _DIR)
+        db.commit()
+        return listed
+
+    @staticmethod
+    def _timestamp_ns(t):
+        if isinstance(t, datetime):
+            t = Stats._totimestamp(t)
+        return int(t * 1e9)
+
+    def query(self, under=None, ext=None, type=None, min_size=None,
+              max_size=None, newer=None, older=None, owner=None,
+              order_by='path', descending=False, limit=None):
+        """Returns a list of the indexed objects matching all the given
+        conditions, as Dir, File, Link or Path objects.
+
+        under: only objects below this directory
+        ext: only objects with this extension (see Path.extension)
+        type: 'd', 'f', 'l' or 'o', for directories, files, links or others
+        min_size, max_size: bounds on the size in bytes (inclusive)
+        newer, older: bounds on the modification time, as timestamps or
+            datetimes (exclusive)
+        owner: a (uid, gid) tuple; either may be None to match any
+        order_by: 'path', 'name', 'size' or 'mtime_ns'
+        limit: the maximum number of objects returned
+
+        For example, the 100 largest .log files modified in the last week:
+            index.query(ext='log', type='f', order_by='size', descending=True,
+                        newer=datetime.now() - timedelta(7), limit=100)
+        """
+        if order_by not in self._orders:
+            raise ValueError("Can't order by %r" % order_by)
+        conds, args = [], []
+        if under is not None:
+            lo, hi = self._below(str(Path(under).abspath()))
+            conds.append('path >= ? AND path < ?')
+            args += [lo, hi]
+        for column, op, value in (
+                ('ext', '=', ext), ('type', '=', type),
+                ('size', '>=', min_size), ('size', '<=', max_size),
+                ('mtime_ns', '>', newer), ('mtime_ns', '<', older),
+                ('uid', '=', owner and owner[0]),
+                ('gid', '=', owner and owner[1])):
+            if value is None:
+                continue
+            if column == 'mtime_ns':
+                value = self._timestamp_ns(value)
+            conds.append('%s %s ?' % (column, op))
+            args.append(value)
+        sql = 'SELECT path, type FROM entries'
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        sql += ' ORDER BY %s %s' % (order_by, 'DESC' if descending else 'ASC')
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        types = {_DIR: Dir, _FILE: File, _LINK: Link}
+        return [types.get(kind, Path)(path)
+                for path, kind in self._db.execute(sql, args)]
+
+
+class CacheDir(Dir):
+    """A directory used as a size-bounded cache of blobs, stored by key.
+
+    Blobs are stored in files named by a hash of their key, in sharded
+    subdirectories, so looking one up is a single open() and never needs a
+    walk. Their sizes and last access times are kept in memory, ordered for
+    least-recently-used eviction whenever the cache goes over max_bytes or
+    max_count, and saved to an index file in the directory by flush() (or
+    on leaving a with block), to be read back by the next CacheDir on the
+    same directory.
+
+    Blobs are written to a temporary file and renamed into place, so several
+    processes can share a cache: readers see either a whole blob or none.
+    Whenever the index is loaded or flushed, it is reconciled with the blobs
+    actually on disk (a walk of the directory), while holding a lock file
+    where fcntl is available: blobs other processes stored are counted,
+    even if they died before flushing, and those they evicted forgotten.
+
+    Nothing is read or created on disk until the cache is first used.
+    """
+    _index_name = 'index.json'
+
+    def __new__(cls, arg=None, max_bytes=None, max_count=None):
+        # Always a new object, even from a CacheDir, as each has its own
+        # limits and index
+        return tuple.__new__(cls, Dir(arg))
+
+    def __init__(self, arg=None, max_bytes=None, max_count=None):
+        Dir.__init__(self, arg)
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self._entries = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'CacheDir(%r)' % str(self)
+
+    def _getatend(self, tpl):
+        return self._Dir(tpl)
+
+    def _getnotend(self, tpl):
+        return self._Dir(tpl)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    # --- The index
+
+    def _load(self):
+        # Returns the index of {name: [size, atime]}, oldest access first,
+        # reading it (or building it) the first time.
+        if self._entries is not None:
+            return self._entries
+        for sub in ('objects', 'tmp'):
+            if not os.path.isdir(str(self + sub)):
+                os.makedirs(str(self + sub))
+        with self._locked():
+            with self._lock:
+                self._reconcile({})
+        return self._entries
+
+    def _locked(self):
+        # Returns the lock file of the directory, shared by all processes,
+        # locked until it is closed
+        f = open(str(self + 'lock'), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                f.close()
+                raise
+        return f
+
+    def _read_index(self):
+        # Returns the [name, size, atime] entries of the index file, or []
+        try:
+            with open(str(self + self._index_name)) as f:
+                return json.load(f)['entries']
+        except (IOError, OSError, ValueError, KeyError):
+            return []
+
+    def _reconcile(self, known):
+        # Rebuilds the index from the blobs on disk, with their sizes and
+        # the latest access time of each in known ({name: [size, atime]}),
+        # the index file or (failing those) the mtime of the blob. Called
+        # with both locks held.
+        atimes = dict((name, atime) for name, size, atime in self._read_index())
+        for name, (size, atime) in known.items():
+            atimes[name] = max(atime, atimes.get(name, atime))
+        found = []
+        for dirpath, entry in _scan_tree(str(self + 'objects')):
+            try:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                # Evicted meanwhile
+                continue
+            found.append((atimes.get(entry.name, st.st_mtime), entry.name,
+                          st.st_size))
+        found.sort()
+        self._entries = OrderedDict(
+            (name, [size, atime]) for atime, name, size in found)
+        self._bytes = sum(size for atime, name, size in found)
+
+    def flush(self):
+        """Saves the index, for the next CacheDir on this directory.
+
+        The index is reconciled with the blobs on disk first, so blobs
+        stored and evicted by other processes sharing the directory are
+        accounted for, and from then on counted by this one."""
+        if self._entries is None:
+            return
+        with self._locked():
+            with self._lock:
+                self._reconcile(self._entries)
+                evicted = self._evict()
+                saved = [[name, size, atime]
+                         for name, (size, atime) in self._entries.items()]
+            self._remove(evicted)
+            fd, tmp = tempfile.mkstemp(dir=str(self + 'tmp'))
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'entries': saved}, f)
+            os.replace(tmp, str(self + self._index_name))
+
+    @property
+    def count(self):
+        """The number of blobs in the cache."""
+        return len(self._load())
+
+    @property
+    def total_bytes(self):
+        """The total size of the blobs in the cache."""
+        self._load()
+        return self._bytes
+
+    # --- Blobs
+
+    @staticmethod
+    def _name(key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def _blob(self, name):
+        return self._File(self + ('objects', name[:2], name[2:4], name))
+
+    def path(self, key):
+        """Returns the File the blob for key is (or would be) stored in."""
+        return self._blob(self._name(key))
+
+    def _touch(self, name, size):
+        # Records an access to name, and returns names to evict
+        entries = self._load()
+        with self._lock:
+            old = entries.pop(name, None)
+            if old is not None:
+                self._bytes -= old[0]
+            entries[name] = [size, time.time()]
+            self._bytes += size
+            return self._evict()
+
+    def _evict(self):
+        # Drops the oldest entries while over the limits, and returns their
+        # names; called with the lock held
+        entries = self._entries
+        evicted = []
+        while entries and (
+                (self.max_bytes is not None and
+                 self._bytes > self.max_bytes) or
+                (self.max_count is not None and
+                 len(entries) > self.max_count)):
+            oldest, (oldsize, atime) = entries.popitem(last=False)
+            self._bytes -= oldsize
+            evicted.append(oldest)
+        return evicted
+
+    def _forget(self, name):
+        entries = self._load()
+        with self._lock:
+            old = entries.pop(name, None)
+            if old is not None:
+                self._bytes -= old[0]
+
+    def _remove(self, names):
+        for name in names:
+            try:
+                os.remove(str(self._blob(name)))
+            except OSError:
+                # Already evicted by another process
+                pass
+
+    def open(self, key):
+        """Returns a binary file object reading the blob stored for key, or
+        None if there is none."""
+        name = self._name(key)
+        try:
+            f = open(str(self._blob(name)), 'rb')
+        except (IOError, OSError):
+            self._forget(name)
+            return None
+        self._remove(self._touch(name, os.fstat(f.fileno()).st_size))
+        return f
+
+    def get(self, key, default=None):
+        """Returns the blob stored for key, as bytes, or default."""
+        f = self.open(key)
+        if f is None:
+            return default
+        with f:
+            return f.read()
+
+    def put(self, key, data):
+        """Stores data (bytes, or a binary file object) as the blob for key,
+        evicting the least recently used blobs if that takes the cache over
+        its limits. Returns the File it is stored in."""
+        name = self._name(key)
+        blob = self._blob(name)
+        self._load()
+        fd, tmp = tempfile.mkstemp(dir=str(self + 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    shutil.copyfileobj(data, f)
+                size = f.tell()
+            try:
+                os.replace(tmp, str(blob))
+            except OSError:
+                os.makedirs(str(blob[:-1]), exist_ok=True)
+                os.replace(tmp, str(blob))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._remove(self._touch(name, size))
+        return blob
+
+    def discard(self, key):
+        """Removes the blob stored for key, if any."""
+        name = self._name(key)
+        self._forget(name)
+        self._remove([name])
+
+    def has(self, key):
+        """Returns True if a blob is stored for key."""
+        return os.path.exists(str(self.path(key)))
+
+
+# --- Instrumentation
+
+# The functions counted by Instrumentation, by module, along with the name
+# of the system call each is counted as
+_SYSCALLS = dict((name, name) for name in (
+    'stat lstat fstat listdir scandir open close read write rename replace '
+    'unlink remove rmdir mkdir makedirs chmod chown lchown utime symlink '
+    'readlink link fsync fdatasync ftruncate truncate access chdir getcwd '
+    'statvfs posix_fadvise posix_fallocate sendfile').split())
+_PATH_SYSCALLS = {'exists': 'stat', 'isdir': 'stat', 'isfile': 'stat',
+                  'getsize': 'stat', 'getmtime': 'stat', 'getatime': 'stat',
+                  'getctime': 'stat', 'samefile': 'stat', 'islink': 'lstat',
+                  'lexists': 'lstat', 'ismount': 'lstat',
+                  'realpath': 'realpath'}
+_SHUTIL_CALLS = dict((name, 'shutil.' + name) for name in (
+    'copyfile copyfileobj copymode copystat copy copy2 copytree move '
+    'rmtree').split())
+
+# The modules fpath uses, restored when instrumentation is turned off
+_MODULES = {'os': os, 'shutil': shutil}
+_globals = globals()
+# The Instrumentations enabled in the current context, and the public
+# function or method of fpath called from outside it that is running
+_active = contextvars.ContextVar('fpath_instruments', default=())
+_api = contextvars.ContextVar('fpath_api', default=None)
+# The number of enable()s not yet disabled, in any context, and the
+# original public functions and methods while they are wrapped
+_enabled = [0]
+_unwrapped = []
+_instruments_lock = threading.Lock()
+
+
+def _api_generator(gen, name):
+    # Iterates over gen, as the API call name
+    try:
+        while True:
+            token = _api.set(name)
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            finally:
+                _api.reset(token)
+            yield item
+    finally:
+        gen.close()
+
+
+def _api_wrapper(func):
+    # Returns func, recording itself as the API call when called from
+    # outside fpath, along with the generator it returns if any
+    name = func.__qualname__
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        if _api.get() is not None:
+            return func(*args, **kwargs)
+        token = _api.set(name)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _api.reset(token)
+        if isinstance(result, types.GeneratorType):
+            return _api_generator(result, name)
+        return result
+    return call
+
+
+def _wrap_apis():
+    # Replaces the public functions and methods of fpath with
+    # _api_wrapper()s of them, keeping the originals in _unwrapped
+    seen = set()
+    for export in __all__:
+        obj = _globals[export]
+        if isinstance(obj, types.FunctionType):
+            _unwrapped.append((_globals, export, obj))
+            _globals[export] = _api_wrapper(obj)
+            continue
+        if obj is Instrumentation:
+            continue
+        for klass in obj.__mro__:
+            if klass.__module__ != __name__ or klass in seen:
+                continue
+            seen.add(klass)
+            for name, value in list(vars(klass).items()):
+                if name.startswith('_'):
+                    continue
+                if isinstance(value, types.FunctionType):
+                    wrapped = _api_wrapper(value)
+                elif isinstance(value, (staticmethod, classmethod)):
+                    wrapped = type(value)(_api_wrapper(value.__func__))
+                elif isinstance(value, property) and value.fget is not None:
+                    wrapped = property(_api_wrapper(value.fget), value.fset,
+                                       value.fdel, value.__doc__)
+                else:
+                    continue
+                _unwrapped.append((klass, name, value))
+                setattr(klass, name, wrapped)
+
+
+def _unwrap_apis():
+    while _unwrapped:
+        owner, name, value = _unwrapped.pop()
+        if owner is _globals:
+            _globals[name] = value
+        else:
+            setattr(owner, name, value)
+
+
+def _instrumented_call(op, func, args, kwargs):
+    instruments = _active.get()
+    if not instruments:
+        return func(*args, **kwargs)
+    api = _api.get() or '?'
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        for instrument in instruments:
+            instrument._record(op, api, time.perf_counter() - start, True)
+        raise
+    elapsed = time.perf_counter() - start
+    read = written = 0
+    if op == 'read':
+        read = len(result)
+    elif op == 'write':
+        written = result
+    for instrument in instruments:
+        instrument._record(op, api, elapsed, False, read, written)
+    if func is _builtin_open:
+        return _counting_file(result, api)
+    return result
+
+
+class _Instrumented(object):
+    """Stands in for a module while instrumentation is on, counting calls
+    to the functions named in ops (mapping them to the name of the call
+    counted) and passing everything else through."""
+
+    def __init__(self, module, ops, **attrs):
+        self._module = module
+        self._ops = ops
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, name):
+        value = getattr(self._module, name)
+        op = self._ops.get(name)
+        if op is None:
+            return value
+        def call(*args, **kwargs):
+            return _instrumented_call(op, value, args, kwargs)
+        self.__dict__[name] = call
+        return call
+
+
+class _CountingFile(object):
+    """Wraps a file object opened while instrumentation is on, counting
+    what is read from and written to it. Use _counting_file(), which makes
+    it an instance of the io base class of the file too."""
+
+    def __init__(self, f, api):
+        self._file = f
+        self._api = api
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def _count(self, read=0, written=0):
+        for instrument in _active.get():
+            instrument._record(None, self._api, 0, False, read, written)
+
+    # What the io base classes would otherwise do themselves
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    @property
+    def encoding(self):
+        return self._file.encoding
+
+    @property
+    def errors(self):
+        return self._file.errors
+
+    @property
+    def newlines(self):
+        return self._file.newlines
+
+    def close(self):
+        self._file.close()
+
+    def detach(self):
+        return self._file.detach()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def flush(self):
+        self._file.flush()
+
+    def isatty(self):
+        return self._file.isatty()
+
+    def readable(self):
+        return self._file.readable()
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def writable(self):
+        return self._file.writable()
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def truncate(self, *args):
+        return self._file.truncate(*args)
+
+    def __enter__(self):
+        self._file.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._file.__exit__(*exc_info)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self._file)
+        self._count(len(line))
+        return line
+
+    def read(self, *args):
+        data = self._file.read(*args)
+        self._count(len(data))
+        return data
+
+    def read1(self, *args):
+        data = self._file.read1(*args)
+        self._count(len(data))
+        return data
+
+    def readall(self):
+        data = self._file.readall()
+        self._count(len(data))
+        return data
+
+    def readline(self, *args):
+        line = self._file.readline(*args)
+        self._count(len(line))
+        return line
+
+    def readlines(self, *args):
+        lines = self._file.readlines(*args)
+        self._count(sum(len(line) for line in lines))
+        return lines
+
+    def readinto(self, b):
+        n = self._file.readinto(b)
+        self._count(n or 0)
+        return n
+
+    def readinto1(self, b):
+        n = self._file.readinto1(b)
+        self._count(n or 0)
+        return n
+
+    def write(self, data):
+        n = self._file.write(data)
+        self._count(written=len(data) if n is None else n)
+        return n
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+
+class _CountingTextFile(_CountingFile, io.TextIOBase):
+    pass
+
+class _CountingBufferedFile(_CountingFile, io.BufferedIOBase):
+    pass
+
+class _CountingRawFile(_CountingFile, io.RawIOBase):
+    pass
+
+def _counting_file(f, api):
+    for base, cls in ((io.TextIOBase, _CountingTextFile),
+                      (io.BufferedIOBase, _CountingBufferedFile),
+                      (io.RawIOBase, _CountingRawFile)):
+        if isinstance(f, base):
+            return cls(f, api)
+    return _CountingFile(f, api)
+
+
+_builtin_open = builtins.open
+_INSTRUMENTED = {
+    'os': _Instrumented(os, _SYSCALLS,
+                        path=_Instrumented(os.path, _PATH_SYSCALLS)),
+    'shutil': _Instrumented(shutil, _SHUTIL_CALLS),
+    'open': lambda *args, **kwargs: _instrumented_call(
+        'open', _builtin_open, args, kwargs)}
+
+
+class Instrumentation(object):
+    """Counts the system calls fpath makes, by call and by the fpath
+    function or method called from outside that made them, along with how
+    long they took and the bytes read and written through files fpath
+    opened.
+
+    Nothing is counted, and nothing costs anything, until enable() is
+    called, which is done on entering a with block:
+
+        with Instrumentation() as counts:
+            for p in Dir('/data').walk():
+                pass
+        print(counts.prometheus())
+
+    Only calls made in the context (as in contextvars: the thread, or
+    asyncio task) that enabled it are counted, along with those fpath makes
+    on its behalf on its own threads. While any Instrumentation is
+    enabled, though, fpath uses stand-ins for os, os.path, shutil and open
+    in every thread, which pass calls straight through outside the
+    contexts of enabled Instrumentations, and its public functions and
+    methods are wrapped to record which was called. Calls made in other
+    processes (scan_parallel), by os.DirEntry objects, or inside shutil
+    functions (which are counted as a whole) aren't seen."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets everything counted so far."""
+        with self._lock:
+            # (call, api) -> [count, errors, seconds]
+            self._calls = {}
+            # api -> [read, written]
+            self._bytes = {}
+
+    @property
+    def enabled(self):
+        """Whether this is counting in the current context."""
+        return self in _active.get()
+
+    def enable(self):
+        """Starts counting, in the current context. Returns self."""
+        active = _active.get()
+        if self in active:
+            return self
+        _active.set(active + (self,))
+        with _instruments_lock:
+            if not _enabled[0]:
+                _globals.update(_INSTRUMENTED)
+                _wrap_apis()
+            _enabled[0] += 1
+        return self
+
+    def disable(self):
+        """Stops counting, in the current context."""
+        active = _active.get()
+        if self not in active:
+            return
+        _active.set(tuple(i for i in active if i is not self))
+        with _instruments_lock:
+            _enabled[0] -= 1
+            if not _enabled[0]:
+                _globals.update(_MODULES)
+                _globals.pop('open', None)
+                _unwrap_apis()
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def _record(self, op, api, seconds, error, read=0, written=0):
+        with self._lock:
+            if op is not None:
+                counts = self._calls.setdefault((op, api), [0, 0, 0.0])
+                counts[0] += 1
+                counts[1] += error
+                counts[2] += seconds
+            if read or written:
+                counts = self._bytes.setdefault(api, [0, 0])
+                counts[0] += read
+                counts[1] += written
+
+    def calls(self, op=None, api=None):
+        """Returns the number of calls counted, of the system call op (such
+        as 'stat' or 'shutil.copyfile'), made by api (such as
+        'BaseDir.walk'), or in total where those are None."""
+        with self._lock:
+            return sum(counts[0] for (o, a), counts in self._calls.items()
+                       if op in (None, o) and api in (None, a))
+
+    def as_dict(self):
+        """Returns what was counted as a dict:
+
+            {'calls': {op: {api: {'count': n, 'errors': n, 'seconds': s}}},
+             'bytes_read': {api: n}, 'bytes_written': {api: n}}
+
+        For files opened in text mode, characters are counted as bytes."""
+        with self._lock:
+            calls = {}
+            for (op, api), (count, errors, seconds) in self._calls.items():
+                calls.setdefault(op, {})[api] = {
+                    'count': count, 'errors': errors, 'seconds': seconds}
+            return {'calls': calls,
+                    'bytes_read': dict((api, n[0]) for api, n in
+                                       self._bytes.items() if n[0]),
+                    'bytes_written': dict((api, n[1]) for api, n in
+                                          self._bytes.items() if n[1])}
+
+    def prometheus(self, prefix='fpath'):
+        """Returns what was counted in the Prometheus text exposition
+        format, as counters named with prefix."""
+        def label(value):
+            return (value.replace('\\', '\\\\').replace('"', '\\"')
+                         .replace('\n', '\\n'))
+        data = self.as_dict()
+        lines = []
+        for name, index, help in (
+                ('syscalls_total', 'count', 'System calls made.'),
+                ('syscall_errors_total', 'errors',
+                 'System calls that raised an error.'),
+                ('syscall_seconds_total', 'seconds',
+                 'Time spent in system calls.')):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for op in sorted(data['calls']):
+                for api, counts in sorted(data['calls'][op].items()):
+                    lines.append('%s_%s{op="%s",api="%s"} %r' % (
+                        prefix, name, label(op), label(api), counts[index]))
+        for name, key in (('read_bytes_total', 'bytes_read'),
+                          ('written_bytes_total', 'bytes_written')):
+            lines.append('# HELP %s_%s Bytes %s files.' % (
+                prefix, name, 'read from' if key == 'bytes_read'
+                else 'written to'))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for api, n in sorted(data[key].items()):
+                lines.append('%s_%s{api="%s"} %d' % (prefix, name, label(api), n))
+        return '\n'.join(lines) + '\n'
+
+
+__all__ = ('Path','File','Dir','Link','Stats','RealpathCache','ListingCache',
+           'FileIndex','ResumableWalk','PathWriter','PathReader',
+           'encode_paths','decode_paths','CacheDir','Instrumentation',
+           'WalkTracer','LineIndex','BatchWriter','WalkEntry')
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 import os
 
 # Work around mbcs bug in distutils.
@@ -30,9 +30,10 @@ setup(name='fpath',
           'Operating System :: POSIX',
           'Operating System :: Microsoft',
           'License :: OSI Approved :: MIT License',
-          'Programming Language :: Python :: 2',
-          'Programming Language :: Python :: 3'
+          'Programming Language :: Python :: 3',
+          'Programming Language :: Python :: 3 :: Only'
         ],
+      python_requires='>=3.7',
       license='MIT',
       long_description=readme,
       url='https://pypi.python.org/pypi?name=fpath'
@@ -1,10 +1,35 @@
 import os
 
-from fpath import Path, File, Link, Dir
+from fpath import Path, File, Link, Dir, RealpathCache, ListingCache
+from fpath import PathWriter, PathReader, encode_paths, decode_paths, CacheDir
+from fpath import Instrumentation, WalkTracer, LineIndex
 
+import bz2
+import errno
+import gzip
+import io
+import json
+import lzma
+import multiprocessing
 import unittest
+from unittest import mock
 import string
 import shutil
+import tarfile
+import tempfile
+import threading
+import time
+
+def file_size(f):
+    # For Dir.scan_parallel, which needs a picklable function
+    return f.stat().size
+
+def unpicklable(f):
+    # For Dir.scan_parallel, returning what can't be sent back
+    return threading.Lock()
+
+def exit_worker(f):
+    os._exit(3)
 
 class PathManipulation(unittest.TestCase):
     ext = 'ext'
@@ -28,6 +53,21 @@ class PathManipulation(unittest.TestCase):
         oshome = os.path.expanduser('~')
         self.assertEqual(myhome, oshome)
 
+    def test_norm(self):
+        for s in ('a/../b', '../x', '/..', '/a/../../b', '.', 'a/..',
+                  '~/x/..', '/a/./b//c/', 'a/b/../../..'):
+            self.assertEqual(Path(s).norm(), Path(
+                os.path.normpath(os.path.expanduser(s))))
+        self.assertEqual(Path('/a/b/../c').norm(collapse=False),
+                         Path('/a/b/../c'))
+        self.assertEqual(Path('~nosuchuser/x').norm(), Path('~nosuchuser/x'))
+        self.assertTrue(isinstance(File('~/x/../y').norm(), File))
+
+    def test_norm_many(self):
+        paths = ['~/a/../b', '/x/y/..', 'z']
+        self.assertEqual(Path.norm_many(paths), [Path(p).norm() for p in paths])
+        self.assertEqual(Path.norm_many(['.'], real=True), [Dir.cwd()])
+
     def test_dir_init(self):
         dir_path = Path(self.path_str)
         self.assertEqual(Dir(self.path_str), Dir(dir_path))
@@ -87,6 +127,36 @@ class PathManipulation(unittest.TestCase):
         # Non-existent paths don't get transformed to File.
         self.assertTrue(isinstance(file_path.transform(), Path))
 
+class PathCodec(unittest.TestCase):
+    paths = [Path('/some/path/file.ext'), File('/some/path/other'),
+             Dir('/some/path'), Link('/some/link'), Path('relative/path'),
+             Path(), Path('/'), Dir('relative/dir'),
+             Path('/some/\u00e9l\u00e9ment'), Path('/' + 'x' * 300),
+             Path('/'.join(['e'] * 200)), File('/'.join(['e'] * 200) + '/f')]
+
+    def check(self, decoded):
+        self.assertEqual(decoded, self.paths)
+        self.assertEqual([type(p) for p in decoded],
+                         [type(p) for p in self.paths])
+        self.assertEqual([str(p) for p in decoded],
+                         [str(p) for p in self.paths])
+
+    def test_roundtrip(self):
+        data = encode_paths(self.paths)
+        self.check(decode_paths(data))
+        self.check(decode_paths(memoryview(data)))
+        self.assertRaises(ValueError, decode_paths, data[:-1])
+
+    def test_stream(self):
+        out = io.BytesIO()
+        writer = PathWriter(out)
+        writer.write_many(self.paths)
+        writer.flush()
+        out.seek(0)
+        reader = PathReader(out)
+        reader._chunk_size = 3
+        self.check(list(reader))
+
 class TempDir(unittest.TestCase):
     temp_dir = 'temp_fpath_tests'
     num_files = 10
@@ -120,6 +190,740 @@ class TempDir(unittest.TestCase):
         d = Dir(self.temp_dir)
         self.assertEqual(len(list(d.walk('f'))), self.num_files)
 
+    def test_children_cache(self):
+        d = Dir(self.temp_dir)
+        cache = ListingCache()
+        self.assertEqual(sorted(d.children(cache)), sorted(d.children()))
+        self.assertEqual(len(list(d.children(cache))),
+                         self.num_files + self.num_dirs)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        open(self.fname(self.num_files), 'w').close()
+        self.assertEqual(len(list(d.children(cache))),
+                         self.num_files + self.num_dirs + 1)
+        self.assertEqual(cache.misses, 2)
+        cache.invalidate(d)
+        self.assertEqual(len(cache), 0)
+
+    def test_walk_cache(self):
+        d = Dir(self.temp_dir)
+        cache = ListingCache(maxsize=2)
+        self.assertEqual(sorted(d.walk('fd', cache)), sorted(d.walk('fd')))
+        self.assertEqual(len(cache), 2)
+
+    def test_rmtree(self):
+        tree = self.temp_dir + '/tree'
+        os.makedirs(tree + '/a/b/c')
+        os.makedirs(tree + '/d')
+        for name in ('a/1', 'a/b/2', 'a/b/c/3', 'd/4', '5'):
+            open(tree + '/' + name, 'w').close()
+        # Links out of the tree are removed, not followed
+        os.symlink(os.path.abspath(self.dname(0)), tree + '/a/out')
+        open(self.dname(0) + '/kept', 'w').close()
+        progress = []
+        result = Dir(tree).rmtree(progress=lambda *counts: progress.append(counts))
+        self.assertEqual(result, (11, 0))
+        self.assertEqual(progress[-1], (11, 0))
+        self.assertFalse(os.path.exists(tree))
+        self.assertTrue(os.path.exists(self.dname(0) + '/kept'))
+
+    def test_rmtree_deep(self):
+        # A single deep subtree, split between the workers as it goes
+        tree = self.temp_dir + '/tree'
+        path = tree
+        for level in range(6):
+            for n in range(4):
+                os.makedirs('{}/{}'.format(path, n))
+                open('{}/{}/f'.format(path, n), 'w').close()
+            path += '/0'
+        self.assertEqual(Dir(tree).rmtree(workers=3), (6 * 4 * 2 + 1, 0))
+        self.assertFalse(os.path.exists(tree))
+
+    def test_rmtree_errors(self):
+        if os.geteuid() == 0:
+            self.skipTest("root can remove anything")
+        tree = self.temp_dir + '/tree'
+        os.makedirs(tree + '/a/b')
+        open(tree + '/a/b/kept', 'w').close()
+        open(tree + '/gone', 'w').close()
+        os.chmod(tree + '/a/b', 0o500)
+        try:
+            # Only the file counts, not the directories left around it
+            result = Dir(tree).rmtree(ignore_errors=True)
+            self.assertEqual(result, (1, 1))
+            self.assertTrue(os.path.exists(tree + '/a/b/kept'))
+            self.assertFalse(os.path.exists(tree + '/gone'))
+        finally:
+            os.chmod(tree + '/a/b', 0o700)
+
+    def test_rmtree_link(self):
+        os.symlink(os.path.abspath(self.dname(0)), self.temp_dir + '/link')
+        self.assertRaises(OSError, Dir(self.temp_dir + '/link').rmtree)
+        self.assertTrue(os.path.exists(self.dname(0)))
+
+    def test_fwalk(self):
+        os.makedirs(self.dname(0) + '/a/b/c')
+        with open(self.dname(0) + '/a/b/c/deep', 'w') as f:
+            f.write('contents')
+        d = Dir(self.temp_dir)
+        for maxfds in (1, 2, 64):
+            self.assertEqual(sorted(d.fwalk('fd', maxfds)), sorted(d.walk('fd')))
+        for f in d.fwalk('f', maxfds=1):
+            self.assertTrue(f.stat().isfile)
+            if f[-1] == 'deep':
+                self.assertEqual(f.open().read(), 'contents')
+
+    def test_fwalk_after(self):
+        # Once the walk is done, its descriptors are no longer used, even if
+        # their numbers are reused for other directories
+        os.makedirs(self.dname(0) + '/a')
+        with open(self.dname(0) + '/a/deep', 'w') as f:
+            f.write('contents')
+        for maxfds in (1, 64):
+            files = list(Dir(self.temp_dir).fwalk('f', maxfds))
+            fds = [os.open(self.temp_dir, os.O_RDONLY) for n in range(4)]
+            try:
+                deep = [f for f in files if f[-1] == 'deep'][0]
+                with deep.open() as f:
+                    self.assertEqual(f.read(), 'contents')
+                self.assertEqual(deep.stat().size, 8)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+    def test_fwalk_rename(self):
+        # Renaming the tree while walking it doesn't disturb the walk
+        d = Dir(self.temp_dir)
+        walk = d.fwalk('f')
+        first = next(walk)
+        os.rename(self.temp_dir, self.temp_dir + '_moved')
+        try:
+            sizes = [f.stat().size for f in walk]
+            self.assertEqual(sizes, [0] * (self.num_files - 1))
+        finally:
+            os.rename(self.temp_dir + '_moved', self.temp_dir)
+
+    def test_apply_metadata(self):
+        os.chmod(self.fname(0), 0o600)
+        dirmode = Dir(self.dname(0)).stat().mode
+        d = Dir(self.temp_dir)
+        result = d.apply_metadata(mode=0o640,
+                                  filter=lambda p: isinstance(p, File))
+        self.assertEqual(result, (self.num_files, self.num_files, 0))
+        self.assertEqual(File(self.fname(0)).stat().mode, 0o640)
+        self.assertEqual(Dir(self.dname(0)).stat().mode, dirmode)
+        # Nothing left to change
+        result = d.apply_metadata(mode=0o640, times=(1e9, 1.5e9),
+                                  filter=lambda p: isinstance(p, File))
+        self.assertEqual(result.changed, self.num_files)
+        result = d.apply_metadata(times=(1e9, 1.5e9))
+        self.assertEqual(result, (self.num_files + self.num_dirs + 1,
+                                  self.num_dirs + 1, 0))
+        self.assertEqual(File(self.fname(3)).stat().amtime, (1e9, 1.5e9))
+
+    def test_apply_metadata_dir_modes(self):
+        inner = self.dname(0) + '/inner'
+        open(inner, 'w').close()
+        d = Dir(self.temp_dir)
+        # Without search permission on the directories, their contents can
+        # only be changed before them
+        result = d.apply_metadata(mode=0o600)
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(result.changed, result.checked)
+        for path in [self.temp_dir] + [self.dname(n)
+                                       for n in range(self.num_dirs)]:
+            os.chmod(path, 0o700)
+        self.assertEqual(File(inner).stat().mode, 0o600)
+
+    def test_apply_metadata_unreadable(self):
+        if os.geteuid() == 0:
+            self.skipTest("root can read any directory")
+        d = Dir(self.temp_dir)
+        # An unreadable directory is counted, not fatal
+        os.chmod(self.dname(0), 0)
+        try:
+            files_only = lambda p: isinstance(p, File)
+            result = d.apply_metadata(mode=0o640, filter=files_only,
+                                      ignore_errors=True)
+            self.assertEqual(result.errors, 1)
+            self.assertEqual(result.changed, self.num_files)
+            self.assertRaises(OSError, d.apply_metadata, mode=0o644,
+                              filter=files_only)
+        finally:
+            os.chmod(self.dname(0), 0o700)
+
+    def test_stream_archive(self):
+        os.symlink('000i', self.temp_dir + '/link')
+        with open(self.fname(0), 'w') as f:
+            f.write('contents')
+        d = Dir(self.temp_dir)
+        for compression, big in ((None, 1 << 20), ('gz', 0)):
+            out = io.BytesIO()
+            d.stream_archive(out, compression=compression, readahead=big)
+            out.seek(0)
+            with tarfile.open(fileobj=out) as tar:
+                names = tar.getnames()
+                self.assertEqual(len(names),
+                                 1 + self.num_files + self.num_dirs + 1)
+                self.assertTrue(tar.getmember(self.temp_dir + '/link').issym())
+                self.assertEqual(tar.extractfile(self.fname(0)).read(),
+                                 b'contents')
+
+    def test_stream_archive_errors(self):
+        import fpath
+        failing = os.path.abspath(self.fname(3))
+        def fake_open(path, *args, **kwargs):
+            if os.path.abspath(path) == failing:
+                raise IOError(errno.EIO, 'Unreadable', path)
+            return open(path, *args, **kwargs)
+        d = Dir(self.temp_dir)
+        with open(failing, 'w') as f:
+            f.write('contents')
+        fpath.open = fake_open
+        try:
+            for readahead in (1 << 20, 0):
+                errors = []
+                out = io.BytesIO()
+                d.stream_archive(out, readahead=readahead,
+                                 onerror=errors.append)
+                self.assertEqual([os.path.abspath(e.filename)
+                                  for e in errors], [failing])
+                out.seek(0)
+                with tarfile.open(fileobj=out) as tar:
+                    self.assertEqual(len(tar.getnames()),
+                                     self.num_files + self.num_dirs)
+        finally:
+            del fpath.open
+
+    def test_stream_archive_hard_links(self):
+        with open(self.fname(0), 'w') as f:
+            f.write('contents')
+        os.link(self.fname(0), self.dname(0) + '/link')
+        out = io.BytesIO()
+        Dir(self.temp_dir).stream_archive(out)
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            members = [m for m in tar.getmembers()
+                       if m.name in (self.fname(0), self.dname(0) + '/link')]
+            self.assertEqual(sorted(m.islnk() for m in members),
+                             [False, True])
+            self.assertEqual(members[1].linkname, members[0].name)
+            self.assertEqual(tar.extractfile(members[1]).read(), b'contents')
+
+    def test_stream_archive_shrinking(self):
+        big = self.fname(0)
+        with open(big, 'wb') as f:
+            f.write(b'x' * (1 << 20))
+
+        class Truncating(io.BytesIO):
+            # Truncates the file once the archive starts coming out, while
+            # it is being read
+            def write(self, data):
+                if os.path.getsize(big) > 1000:
+                    os.truncate(big, 1000)
+                return io.BytesIO.write(self, data)
+
+        out = Truncating()
+        Dir(self.temp_dir).stream_archive(out, readahead=0)
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            data = tar.extractfile(big).read()
+        self.assertEqual(len(data), 1 << 20)
+        self.assertEqual(data[:1000], b'x' * 1000)
+        self.assertEqual(data[-1000:], b'\0' * 1000)
+
+    def test_stream_archive_chunks(self):
+        chunks = list(Dir(self.temp_dir).stream_archive(compression='xz',
+                                                        arcname='x'))
+        with tarfile.open(fileobj=io.BytesIO(b''.join(chunks))) as tar:
+            self.assertEqual(len(tar.getnames()),
+                             1 + self.num_files + self.num_dirs)
+            self.assertTrue('x/000i' in tar.getnames())
+
+    def test_build_index(self):
+        for n in range(3):
+            with open(self.dname(n) + '/data.log', 'w') as f:
+                f.write('x' * (n + 1))
+        db = self.temp_dir + '.sqlite'
+        try:
+            with Dir(self.temp_dir).build_index(db) as index:
+                self.assertEqual(len(index),
+                                 self.num_files + self.num_dirs + 3)
+                logs = index.query(ext='log', order_by='size',
+                                   descending=True, limit=2)
+                self.assertEqual(logs, [Path(self.dname(n) + '/data.log')
+                                        .abspath() for n in (2, 1)])
+                self.assertTrue(isinstance(logs[0], File))
+                self.assertEqual(len(index.query(type='d')), self.num_dirs)
+                self.assertEqual(len(index.query(under=self.dname(0))), 1)
+                # Only the changed directories are listed again
+                self.assertEqual(index.refresh(), 0)
+                os.remove(self.dname(0) + '/data.log')
+                shutil.rmtree(self.dname(1))
+                self.assertEqual(index.refresh(), 2)
+                self.assertEqual(len(index.query(ext='log')), 1)
+                self.assertEqual(len(index.query(type='f', min_size=1)), 1)
+        finally:
+            os.remove(db)
+
+    def test_estimate(self):
+        for n in range(self.num_dirs):
+            for m in range(n):
+                with open('{}/{}'.format(self.dname(n), m), 'w') as f:
+                    f.write('x' * 10)
+        files = self.num_files + sum(range(self.num_dirs))
+        d = Dir(self.temp_dir)
+        # A big enough budget lists everything
+        est = d.estimate(budget=1000)
+        self.assertEqual((est.files, est.bytes), (files, 10 * (files - 10)))
+        self.assertEqual(est.files_margin, 0)
+        est = d.estimate(budget=3, seed=1)
+        self.assertTrue(est.probes >= 1 and est.files >= self.num_files)
+        est = d.estimate(by_subdir=True)
+        self.assertEqual(est.files, files)
+        self.assertEqual(est.subdirs[os.path.basename(self.dname(3))].files, 3)
+
+    def test_estimate_unlikely_branches(self):
+        # A chain of directories, each one of 60 siblings: probes hardly
+        # ever get to the bottom
+        path = self.dname(0)
+        for level in range(4):
+            for n in range(60):
+                os.mkdir('{}/{}'.format(path, n))
+            path += '/0'
+        with open(path + '/deep', 'w') as f:
+            f.write('x' * 10)
+        files = self.num_files + 1
+        d = Dir(self.temp_dir)
+        est = d.estimate(budget=1000, seed=1)
+        self.assertEqual((est.files, est.bytes, est.files_margin),
+                         (files, 10, 0))
+        est = d.estimate(budget=100, seed=1)
+        self.assertTrue(est.probes >= 1 and est.syscalls <= 100)
+
+    def test_resumable_walk(self):
+        os.makedirs(self.dname(2) + '/a/b')
+        open(self.dname(2) + '/a/b/f', 'w').close()
+        d = Dir(self.temp_dir)
+        everything = list(d.resumable_walk())
+        self.assertEqual(sorted(everything), sorted(d.walk()))
+        for stop in range(len(everything) + 1):
+            walk = d.resumable_walk()
+            start = [next(walk) for n in range(stop)]
+            cursor = json.loads(json.dumps(walk.cursor()))
+            rest = list(d.walk(resume_from=cursor))
+            self.assertEqual(start + rest, everything)
+        self.assertRaises(ValueError, d.resumable_walk, 'f', cursor)
+
+    def test_scan_parallel(self):
+        for n in range(self.num_dirs):
+            os.makedirs('{}/a/b'.format(self.dname(n)))
+            with open('{}/a/b/f'.format(self.dname(n)), 'w') as f:
+                f.write('x' * n)
+        d = Dir(self.temp_dir)
+        self.assertEqual(sorted(d.scan_parallel(processes=3, batch=4)),
+                         sorted(d.walk()))
+        sizes = dict(d.scan_parallel(file_size, 'f', processes=2))
+        self.assertEqual(len(sizes), self.num_files + self.num_dirs)
+        self.assertEqual(sizes[File(self.dname(3) + '/a/b/f')], 3)
+        self.assertTrue(isinstance(list(sizes)[0], File))
+
+    def test_scan_parallel_errors(self):
+        d = Dir(self.temp_dir)
+        self.assertRaises(TypeError, list,
+                          d.scan_parallel(unpicklable, 'f', processes=2))
+        self.assertRaises(OSError, list,
+                          d.scan_parallel(exit_worker, 'f', processes=2))
+
+    def test_cache_dir(self):
+        root = self.temp_dir + '/cache'
+        with CacheDir(root, max_count=3) as cache:
+            self.assertFalse(os.path.exists(root))
+            for n in range(4):
+                cache.put('key%d' % n, b'x' * n)
+                cache.get('key0')
+            self.assertEqual(cache.get('key0'), b'')
+            self.assertEqual(cache.get('key1'), None)
+            self.assertTrue(cache.has('key3'))
+            self.assertEqual((cache.count, cache.total_bytes), (3, 5))
+            self.assertTrue(isinstance(cache[:-1], Dir))
+        # The index is read back
+        cache = CacheDir(root, max_bytes=3)
+        self.assertEqual((cache.count, cache.total_bytes), (3, 5))
+        cache.put('key4', io.BytesIO(b'abc'))
+        self.assertEqual(cache.get('key4'), b'abc')
+        self.assertEqual(cache.count, 2)
+        self.assertFalse(cache.has('key2'))
+        cache.discard('key0')
+        self.assertEqual(cache.count, 1)
+        os.remove(root + '/index.json')
+        self.assertEqual(CacheDir(root).count, 1)
+
+    def test_cache_dir_shared(self):
+        root = self.temp_dir + '/cache'
+        first = CacheDir(root, max_count=5)
+        first.put('a', b'1')
+        # Another CacheDir of the same object has its own state
+        self.assertEqual(CacheDir(first).max_count, None)
+        self.assertEqual(first.max_count, 5)
+        self.assertEqual(first.count, 1)
+        second = CacheDir(root)
+        second.put('b', b'22')
+        second.flush()
+        first.flush()
+        cache = CacheDir(root)
+        self.assertEqual((cache.count, cache.total_bytes), (2, 3))
+        # Evicted entries aren't brought back by the merge
+        first.max_count = 1
+        first.put('c', b'333')
+        first.flush()
+        self.assertEqual(CacheDir(root).count, 1)
+        self.assertEqual(CacheDir(root).get('c'), b'333')
+
+    def test_cache_dir_reconciled(self):
+        root = self.temp_dir + '/cache'
+        # A process which died without flushing
+        crashed = CacheDir(root)
+        for n in range(3):
+            crashed.put('key%d' % n, b'x' * 10)
+        cache = CacheDir(root, max_bytes=25)
+        self.assertEqual((cache.count, cache.total_bytes), (3, 30))
+        cache.put('key3', b'')
+        self.assertEqual((cache.count, cache.total_bytes), (3, 20))
+        self.assertFalse(cache.has('key0'))
+        # Blobs another process evicted aren't kept in the index
+        cache.flush()
+        CacheDir(root).discard('key1')
+        cache.flush()
+        with open(root + '/index.json') as f:
+            self.assertEqual(len(json.load(f)['entries']), 2)
+        self.assertEqual(cache.count, 2)
+        self.assertFalse(cache.has('key1'))
+
+    def test_move(self):
+        os.makedirs(self.dname(0) + '/a/b')
+        open(self.dname(0) + '/a/b/f', 'w').close()
+        moved = Dir(self.dname(0)).move(self.dname(1))
+        self.assertEqual(moved, os.path.join(self.dname(1),
+                                             os.path.basename(self.dname(0))))
+        self.assertTrue(os.path.exists(moved + '/a/b/f'))
+        self.assertFalse(os.path.exists(self.dname(0)))
+
+    @staticmethod
+    def across():
+        # Makes renames fail as they do between filesystems
+        return mock.patch('os.rename', side_effect=OSError(
+            errno.EXDEV, 'Invalid cross-device link'))
+
+    def test_move_across(self):
+        os.makedirs(self.dname(0) + '/a/b')
+        with open(self.dname(0) + '/a/b/f', 'w') as f:
+            f.write('contents')
+        os.symlink('b/f', self.dname(0) + '/a/link')
+        dst = self.temp_dir + '/dst'
+        src = Dir(self.dname(0))
+        target = dst + '/target'
+        # An interrupted move: one file copied, the marker left behind
+        os.makedirs(target + '/a/b')
+        shutil.copy(self.dname(0) + '/a/b/f', target + '/a/b/f')
+        with open(target + '/' + src._move_marker, 'w') as f:
+            f.write(str(src.abspath()))
+        with self.across():
+            self.assertEqual(src.move(target, checksum=True), target)
+        self.assertFalse(os.path.exists(self.dname(0)))
+        self.assertEqual(sorted(os.listdir(target + '/a')), ['b', 'link'])
+        with open(target + '/a/link') as f:
+            self.assertEqual(f.read(), 'contents')
+        # A fresh move
+        with self.across():
+            Dir(target).move(self.temp_dir)
+        self.assertTrue(os.path.exists(self.temp_dir + '/target/a/b/f'))
+        self.assertEqual(os.listdir(dst), [])
+
+    def test_move_across_existing(self):
+        with open(self.dname(0) + '/data', 'w') as f:
+            f.write('source')
+        dst = self.dname(1)
+        name = os.path.basename(self.dname(0))
+        os.mkdir(dst + '/' + name)
+        with open(dst + '/' + name + '/data', 'w') as f:
+            f.write('OTHER!')
+        with self.across():
+            self.assertRaises(OSError, Dir(self.dname(0)).move, dst)
+        with open(self.dname(0) + '/data') as f:
+            self.assertEqual(f.read(), 'source')
+        with open(dst + '/' + name + '/data') as f:
+            self.assertEqual(f.read(), 'OTHER!')
+
+    def test_move_across_failed(self):
+        os.makedirs(self.dname(0) + '/a/b')
+        os.makedirs(self.dname(0) + '/c')
+        os.mkfifo(self.dname(0) + '/a/b/fifo')
+        target = self.temp_dir + '/target'
+        with self.across():
+            self.assertRaises(IOError, Dir(self.dname(0)).move, target)
+        # Nothing was moved, so nothing is left at the destination
+        self.assertFalse(os.path.exists(target))
+        self.assertTrue(os.path.exists(self.dname(0) + '/a/b/fifo'))
+
+    def test_instrumentation(self):
+        import fpath
+        d = Dir(self.temp_dir)
+        with Instrumentation() as counts:
+            self.assertEqual(len(list(d.walk())),
+                             self.num_files + self.num_dirs)
+            File(self.fname(0)).copy(self.fname(self.num_files))
+            with File(self.fname(1)).open('w') as f:
+                f.write('written')
+        self.assertIs(fpath.os, os)
+        self.assertEqual(counts.calls('listdir', 'BaseDir.walk'),
+                         1 + self.num_dirs)
+        self.assertEqual(counts.calls('stat', 'BasePath.copy'), 1)
+        self.assertEqual(counts.calls('shutil.copyfile'), 1)
+        self.assertEqual(counts.as_dict()['bytes_written'],
+                         {'BaseFile.open': 7})
+        self.assertIn('fpath_syscalls_total{op="stat",api="BasePath.copy"} 1',
+                      counts.prometheus().splitlines())
+        list(d.walk())
+        self.assertEqual(counts.calls('listdir'), 1 + self.num_dirs)
+
+    def test_instrumentation_scope(self):
+        d = Dir(self.temp_dir)
+        with open(self.fname(0), 'w') as f:
+            f.write('one\ntwo\n')
+        with Instrumentation() as counts:
+            # Other threads aren't counted, fpath's own pools are
+            thread = threading.Thread(target=lambda: list(d.walk()))
+            thread.start()
+            thread.join()
+            self.assertEqual(counts.calls('listdir'), 0)
+            self.assertEqual(len(list(d.read_many())), self.num_files)
+            self.assertEqual(counts.calls('open', 'BaseDir.read_many'),
+                             self.num_files)
+            # Files opened pass for io objects
+            with File(self.fname(0)).open('rb') as f:
+                self.assertTrue(isinstance(f, io.BufferedIOBase))
+                self.assertEqual(next(f), b'one\n')
+                self.assertEqual(list(io.TextIOWrapper(f)), ['two\n'])
+        self.assertEqual(counts.as_dict()['bytes_read']['BaseFile.open'], 8)
+
+    def test_walk_tracer(self):
+        tracer = WalkTracer()
+        walked = list(Dir(self.temp_dir).walk(tracer=tracer))
+        self.assertEqual(walked, list(Dir(self.temp_dir).walk()))
+        dirs = tracer.dirs()
+        self.assertEqual(len(dirs), 1 + self.num_dirs)
+        self.assertEqual(dirs[0].path, Dir(self.temp_dir))
+        self.assertEqual(dirs[0].entries, self.num_files + self.num_dirs)
+        self.assertEqual(sum(n for bound, n in tracer.histogram()), len(dirs))
+        self.assertEqual(len(tracer.slowest(3)), 3)
+        self.assertIn(self.temp_dir, tracer.report())
+        out = io.StringIO()
+        tracer.chrome_trace(out)
+        events = json.loads(out.getvalue())['traceEvents']
+        self.assertEqual(len(events), 2 * len(dirs))
+        top = events[0]
+        self.assertEqual(top['args']['entries'], self.num_files + self.num_dirs)
+        for event in events[2::2]:
+            self.assertTrue(top['ts'] <= event['ts'] and event['ts'] +
+                            event['dur'] <= top['ts'] + top['dur'])
+
+    def test_read_many(self):
+        for n in range(self.num_files):
+            with open(self.fname(n), 'w') as f:
+                f.write('x' * n)
+        with open(self.dname(0) + '/inner', 'w') as f:
+            f.write('inner')
+        d = Dir(self.temp_dir)
+        contents = dict(d.read_many(workers=3, max_buffered=10))
+        self.assertEqual(len(contents), self.num_files + 1)
+        self.assertEqual(contents[File(self.fname(4))], b'xxxx')
+        self.assertEqual(contents[File(self.dname(0) + '/inner')], b'inner')
+        self.assertEqual(len(dict(d.read_many(pattern='inn*'))), 1)
+        self.assertEqual(len(dict(d.read_many(max_size=3))), 4)
+        named = dict(d.read_many([os.path.basename(self.fname(2)),
+                                  os.path.abspath(self.fname(3))]))
+        self.assertEqual(sorted(named.values()), [b'xx', b'xxx'])
+        # Stopping early doesn't leave workers waiting for room
+        many = d.read_many(workers=2, max_buffered=1)
+        next(many)
+        many.close()
+        self.assertRaises(OSError, list, d.read_many(['missing']))
+        self.assertEqual(list(d.read_many(['missing'], ignore_errors=True)),
+                         [])
+
+    def test_read_many_streams(self):
+        events = []
+        def files():
+            yield os.path.abspath(self.fname(0))
+            # Time for the first file to be read
+            time.sleep(0.1)
+            yield os.path.abspath(self.fname(1))
+            events.append('listed')
+            yield os.path.abspath(self.fname(2))
+        d = Dir(self.temp_dir)
+        for f, data in d.read_many(files(), workers=2):
+            events.append('read')
+        # Results come back as soon as they are read, not once the window
+        # of pending files is full
+        self.assertEqual(events, ['read', 'listed', 'read', 'read'])
+
+    def test_grep(self):
+        for n in range(self.num_files):
+            with open(self.fname(n), 'w') as f:
+                f.write('first\nneedle %d\nother\nneedle again\n' % n)
+        with open(self.dname(0) + '/inner.txt', 'w') as f:
+            f.write('no match\nneedle inside\n')
+        with open(self.dname(1) + '/binary', 'wb') as f:
+            f.write(b'needle\0')
+        d = Dir(self.temp_dir)
+        found = sorted(d.grep('^needle', workers=3, blocksize=8))
+        self.assertEqual(len(found), 2 * self.num_files + 1)
+        self.assertIn((File(self.fname(3)), 2, 'needle 3'), found)
+        self.assertIn((File(self.fname(3)), 4, 'needle again'), found)
+        self.assertIn((File(self.dname(0) + '/inner.txt'), 2, 'needle inside'),
+                      found)
+        self.assertEqual(len(list(d.grep('needle', max_count=1))),
+                         self.num_files + 1)
+        self.assertEqual(len(list(d.grep('needle', glob='*.txt'))), 1)
+        self.assertEqual(len(list(d.grep('needle',
+                                         exclude=os.path.basename(
+                                             self.dname(0))))),
+                         2 * self.num_files)
+        self.assertEqual(list(d.grep(b'inside$'))[0][2], b'needle inside')
+
+    def test_grep_unreadable(self):
+        if os.geteuid() == 0:
+            self.skipTest("root can read any directory")
+        open(self.dname(0) + '/hidden', 'w').close()
+        os.chmod(self.dname(0), 0)
+        try:
+            d = Dir(self.temp_dir)
+            self.assertRaises(OSError, list, d.grep('x'))
+            self.assertEqual(list(d.grep('x', ignore_errors=True)), [])
+        finally:
+            os.chmod(self.dname(0), 0o700)
+
+    def test_grep_unicode(self):
+        with open(self.fname(0), 'w', encoding='utf-8') as f:
+            f.write('caf\u00e9\nna\u00efve\n')
+        d = Dir(self.temp_dir)
+        for pattern in ('caf.$', r'na\w+ve', '(?i)CAF\u00c9', '[\u00e9]'):
+            self.assertEqual(len(list(d.grep(pattern))), 1, pattern)
+        self.assertEqual(list(d.grep('na.ve'))[0][2], 'na\u00efve')
+
+    def test_grep_empty_matches(self):
+        with open(self.fname(0), 'w') as f:
+            f.write('one\n\nthree\n')
+        with open(self.fname(1), 'w') as f:
+            f.write('no newline')
+        d = Dir(self.temp_dir)
+        self.assertEqual(list(d.grep('^$')), [(File(self.fname(0)), 2, '')])
+        self.assertEqual(sorted(lineno for f, lineno, line in d.grep('$')),
+                         [1, 1, 2, 3])
+        self.assertEqual(len(list(d.grep('x*', blocksize=2))), 4)
+
+    def test_grep_multiline_patterns(self):
+        with open(self.fname(0), 'w') as f:
+            f.write('a \nb\n\nc\nxx\n')
+        d = Dir(self.temp_dir)
+        f = File(self.fname(0))
+        self.assertEqual(list(d.grep(r'\s+')), [(f, 1, 'a ')])
+        self.assertEqual(list(d.grep('[^x]')),
+                         [(f, 1, 'a '), (f, 2, 'b'), (f, 4, 'c')])
+        self.assertEqual(list(d.grep(r'b\s*c')), [])
+        self.assertEqual(list(d.grep(br'\s+', blocksize=3)), [(f, 1, b'a ')])
+
+    def test_writer(self):
+        d = Dir(self.temp_dir)
+        with d.writer(workers=2) as batch:
+            batch.max_open = 3
+            for n in range(10):
+                f = batch.write('out/%d/data' % (n % 2), str(n) * n)
+            self.assertEqual(f, File(self.temp_dir + '/out/1/data'))
+            batch.write('top', b'top')
+            # Nothing is published before the batch is committed
+            self.assertFalse(os.path.exists(self.temp_dir + '/top'))
+            self.assertEqual(len(batch), 11)
+        with open(self.temp_dir + '/out/1/data') as f:
+            self.assertEqual(f.read(), '9' * 9)
+        self.assertEqual(os.listdir(self.temp_dir + '/out/0'), ['data'])
+        with open(self.temp_dir + '/top', 'rb') as f:
+            self.assertEqual(f.read(), b'top')
+        try:
+            with d.writer() as batch:
+                batch.write('top', 'replaced')
+                raise KeyError
+        except KeyError:
+            pass
+        with open(self.temp_dir + '/top', 'rb') as f:
+            self.assertEqual(f.read(), b'top')
+        self.assertEqual(len(os.listdir(self.temp_dir)),
+                         self.num_files + self.num_dirs + 2)
+
+    def test_writer_abort(self):
+        d = Dir(self.temp_dir)
+        batch = d.writer()
+        batch.write('new/sub/data', 'data')
+        batch.write(os.path.basename(self.dname(0)) + '/data', 'data')
+        # Directories are only made on commit(), and removed on abort()
+        self.assertFalse(os.path.exists(self.temp_dir + '/new'))
+        batch.abort()
+        batch.close()
+        self.assertFalse(os.path.exists(self.temp_dir + '/new'))
+        self.assertEqual(os.listdir(self.dname(0)), [])
+        self.assertEqual(len(os.listdir(self.temp_dir)),
+                         self.num_files + self.num_dirs)
+
+    def test_writer_sweep(self):
+        gone = multiprocessing.Process(target=int)
+        gone.start()
+        gone.join()
+        stale = '%s/.data.fpath-tmp-%d-1' % (self.dname(0), gone.pid)
+        live = '%s/.data.fpath-tmp-%d-1' % (self.dname(0), os.getpid())
+        for path in (stale, live):
+            open(path, 'w').close()
+        Dir(self.temp_dir).writer().close()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(live))
+
+    def test_walk_entries(self):
+        with open(self.dname(2) + '/inner.dat', 'w') as f:
+            f.write('12345')
+        d = Dir(self.temp_dir)
+        for mode in ('fd', 'f', 'd'):
+            entries = list(d.walk_entries(mode))
+            self.assertEqual([e.path for e in entries], list(d.walk(mode)))
+            self.assertEqual([type(e.path) for e in entries],
+                             [type(p) for p in d.walk(mode)])
+        entry = [e for e in d.walk_entries() if e.extension == 'dat'][0]
+        self.assertEqual(entry.name, 'inner.dat')
+        self.assertTrue(entry.isfile)
+        self.assertEqual(entry.stats.size, 5)
+        self.assertEqual(entry.parent, Dir(self.dname(2)))
+        self.assertEqual(entry, File(self.dname(2) + '/inner.dat'))
+        self.assertEqual(entry[-1], 'inner.dat')
+        self.assertEqual(str(entry), str(entry.path))
+
+    def test_exists_many(self):
+        names = ([self.fname(n) for n in range(self.num_files)] +
+                 [self.dname(n) for n in range(self.num_dirs)])
+        missing = [self.fname(n) + 'x' for n in range(3)]
+        # Enough paths in one directory to list it, and a few to stat
+        paths = missing + names + ['nonexistent/file', self.temp_dir]
+        expected = [False] * 3 + [True] * len(names) + [False, True]
+        self.assertEqual(Path.exists_many(paths), expected)
+        self.assertEqual(Path.exists_many(paths[:3] + paths[-2:]),
+                         [False] * 4 + [True])
+
+    def test_transform_many(self):
+        paths = ([self.dname(0), self.fname(0), self.fname(0) + 'x'] +
+                 [self.fname(n) for n in range(self.num_files)] * 2)
+        transformed = Path.transform_many(paths)
+        self.assertEqual(transformed, [Path(p) for p in paths])
+        self.assertTrue(isinstance(transformed[0], Dir))
+        self.assertTrue(isinstance(transformed[1], File))
+        self.assertFalse(isinstance(transformed[2], (Dir, File)))
+
     def test_transform_path_to_dir(self):
         dir_path = Path(self.temp_dir)
         self.assertEqual(dir_path.transform(), Dir(self.temp_dir))
@@ -134,6 +938,61 @@ class TempDir(unittest.TestCase):
         osabs = os.path.join(os.getcwd(), self.temp_dir)
         self.assertEqual(pathabs, osabs)
 
+class TempLinks(unittest.TestCase):
+    temp_dir = 'temp_fpath_links'
+
+    def setUp(self):
+        os.makedirs(self.temp_dir + '/real/sub')
+        os.mkdir(self.temp_dir + '/other')
+        os.symlink('real', self.temp_dir + '/link')
+        open(self.temp_dir + '/real/sub/file.txt', 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_realpath_cache(self):
+        cache = RealpathCache()
+        p = Path(self.temp_dir + '/link/sub/file.txt')
+        self.assertEqual(p.realpath(cache), os.path.realpath(str(p)))
+        self.assertEqual(p.realpath(cache), p.realpath())
+        self.assertTrue(len(cache) > 0)
+
+    def test_realpath_cache_invalidate(self):
+        cache = RealpathCache()
+        p = Path(self.temp_dir + '/link/sub')
+        before = p.realpath(cache)
+        os.rename(self.temp_dir + '/real', self.temp_dir + '/moved')
+        os.remove(self.temp_dir + '/link')
+        os.symlink('moved', self.temp_dir + '/link')
+        self.assertEqual(p.realpath(cache), before)
+        cache.invalidate(self.temp_dir)
+        self.assertEqual(p.realpath(cache), p.realpath())
+        self.assertNotEqual(p.realpath(cache), before)
+
+    def test_realpath_cache_invalidate_target(self):
+        cache = RealpathCache()
+        p = Path(self.temp_dir + '/link/sub/file.txt')
+        p.realpath(cache)
+        os.rename(self.temp_dir + '/real/sub', self.temp_dir + '/other/sub')
+        os.symlink('../other/sub', self.temp_dir + '/real/sub')
+        # What was resolved through link is forgotten with real
+        cache.invalidate(self.temp_dir + '/real')
+        self.assertEqual(p.realpath(cache), p.realpath())
+
+    def test_realpath_cache_maxsize(self):
+        cache = RealpathCache(maxsize=2)
+        Path(self.temp_dir + '/link/sub/file.txt').realpath(cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_relpathto_many(self):
+        base = Dir(self.temp_dir + '/other')
+        paths = [self.temp_dir + '/link/sub/file.txt',
+                 self.temp_dir + '/real/sub', self.temp_dir + '/other']
+        rel = base.relpathto_many(paths)
+        self.assertEqual(rel, [base.relpathto(p) for p in paths])
+        self.assertEqual(rel[0], Path('../real/sub/file.txt'))
+        self.assertEqual(rel[2], Path())
+
 class TempFile(unittest.TestCase):
     ext = 'ext'
     filename = 'file.ext'
@@ -163,6 +1022,98 @@ class TempFile(unittest.TestCase):
         # Recreate the file so that teardown doesn't raise an error.
         f.touch()
 
+    def test_open_compressed(self):
+        data = b''.join(b'line %d\n' % i for i in range(20000))
+        for ext, module in (('gz', gzip), ('bz2', bz2), ('xz', lzma)):
+            f = File(self.filename + '.' + ext)
+            try:
+                with f.open('wb', compression='auto', workers=3) as out:
+                    out._blocksize = 4096
+                    out.write(data)
+                with module.open(str(f)) as compressed:
+                    self.assertEqual(compressed.read(), data)
+                with f.open('rt', compression='auto') as lines:
+                    self.assertEqual(next(lines), 'line 0\n')
+                    self.assertEqual(len(lines.readlines()), 19999)
+            finally:
+                f.remove()
+
+    def test_open_compressed_sniff(self):
+        f = File(self.filename)
+        with gzip.open(self.filename, 'wb') as compressed:
+            compressed.write(b'sniffed')
+        with f.open('rb', compression='auto') as opened:
+            self.assertEqual(opened.read(), b'sniffed')
+        with f.open('w', compression='auto') as plain:
+            plain.write('plain')
+        with f.open(compression='auto') as opened:
+            self.assertEqual(opened.read(), 'plain')
+
+    def test_tail(self):
+        with open(self.filename, 'w') as f:
+            f.write(''.join('line %d\n' % i for i in range(1000)))
+        f = File(self.filename)
+        self.assertEqual(f.tail(2), ['line 998\n', 'line 999\n'])
+        self.assertEqual(f.tail(3, blocksize=4), f.tail(3))
+        self.assertEqual(len(f.tail(2000)), 1000)
+        self.assertEqual(f.tail(0), [])
+        with open(self.filename, 'a') as out:
+            out.write('no newline')
+        self.assertEqual(f.tail(2, encoding=None),
+                         [b'line 999\n', b'no newline'])
+
+    def test_follow_blocks(self):
+        with open(self.filename, 'w') as f:
+            f.write(''.join('l%d\n' % n for n in range(1, 6)))
+        lines = list(File(self.filename).follow(n=3, blocksize=4,
+                                                timeout=0.3))
+        self.assertEqual(lines, ['l3\n', 'l4\n', 'l5\n'])
+
+    def test_follow(self):
+        with open(self.filename, 'w') as f:
+            f.write('old\nlast\n')
+        lines = File(self.filename).follow(n=1, timeout=0.5)
+        self.assertEqual(next(lines), 'last\n')
+        with open(self.filename, 'a') as f:
+            f.write('new\n')
+        self.assertEqual(next(lines), 'new\n')
+        os.rename(self.filename, self.filename + '.1')
+        try:
+            with open(self.filename, 'w') as f:
+                f.write('rotated\n')
+            self.assertEqual(next(lines), 'rotated\n')
+            with open(self.filename, 'w') as f:
+                f.write('')
+            self.assertEqual(list(lines), [])
+        finally:
+            os.remove(self.filename + '.1')
+
+    def test_line_index(self):
+        lines = ['%d,%s\n' % (n, 'x' * (n % 7)) for n in range(100)]
+        with open(self.filename, 'w') as f:
+            f.write(''.join(lines))
+        f = File(self.filename)
+        sidecar = '.' + self.filename + '.lineidx'
+        try:
+            index = f.line_index(every=8)
+            self.assertEqual(index.lines, 100)
+            self.assertEqual(len(index.offsets), 13)
+            self.assertTrue(os.path.exists(sidecar))
+            mapped = f.line_index(every=8, use_mmap=True, rebuild=True)
+            self.assertEqual(mapped.offsets, index.offsets)
+            with open(sidecar, 'rb') as side:
+                self.assertEqual(LineIndex.load(side).offsets, index.offsets)
+            self.assertEqual(f.read_lines(42, 45, index=index), lines[42:45])
+            self.assertEqual(f.read_lines(99), lines[99:])
+            ranges = index.ranges(3)
+            self.assertEqual(sum((f.read_lines(start, stop, index=index)
+                                  for start, stop in ranges), []), lines)
+            with open(self.filename, 'a') as out:
+                out.write('appended')
+            self.assertEqual(f.read_lines(100), ['appended'])
+        finally:
+            os.remove(sidecar)
+
     def test_transform_path_to_file(self):
         file_path = Path(self.filename)
         self.assertEqual(file_path.transform(), File(self.filename))